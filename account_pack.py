@@ -0,0 +1,397 @@
+"""
+账号预打包与发货文件
+入库时把每个账号的文件压缩成独立的 zip 分片（打包缓存），发货时直接拼接分片里已压缩好的数据，
+只重写本地文件头和中央目录，不再逐个文件重新压缩；
+发货文件在内存缓冲中生成并直接上传，不在发货目录留下文件
+"""
+
+import os
+import copy
+import shutil
+import struct
+import logging
+import threading
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from mongo import INGEST_EXTRACT_WORKERS, DELIVERY_SPOOL_MAX_SIZE
+from account_store import find_account_files, stored_members, legacy_members
+
+
+# 打包缓存与账号源目录同级：./协议号/{nowuid}/xxx -> ./打包缓存/协议号/{nowuid}/xxx.zip
+BLOB_DIR_NAME = '打包缓存'
+
+# 支持预打包的商品类型
+PACKABLE_TYPES = ('协议号', '直登号')
+
+# zip 结构（与 zipfile 模块一致）
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_END_RECORD = struct.Struct('<4s4H2LH')
+_LOCAL_SIG = b'PK\x03\x04'
+_CENTRAL_SIG = b'PK\x01\x02'
+_END_SIG = b'PK\x05\x06'
+
+# 超出普通 zip 的上限时需要 ZIP64，改走 zipfile 重新打包
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_ENTRIES = 0xFFFF
+
+_COPY_BUFFER = 1024 * 1024
+
+
+# ================================ 账号文件 ================================
+
+def account_members(leixing: str, root: str, nowuid: str, account: str, files: list = None) -> list:
+    """账号的文件：已放入账号存储的取存储文件，旧库存取源目录
+
+    Args:
+        files: 账号的 hb.files，不传时按 (nowuid, 账号名) 查询
+
+    Returns:
+        list: [(文件路径, 压缩包内路径), ...]，压缩包内路径与原发货逻辑一致
+    """
+    if files is None:
+        files = find_account_files(nowuid, account)
+    if files:
+        return stored_members(files)
+    return legacy_members(leixing, root, nowuid, account)
+
+
+def blob_path(root: str, nowuid: str, account: str) -> str:
+    """账号预打包分片的路径"""
+    root = os.path.abspath(root)
+    return os.path.join(os.path.dirname(root), BLOB_DIR_NAME, os.path.basename(root), nowuid, account + '.zip')
+
+
+# ================================ 预打包 ================================
+
+def build_account_blob(leixing: str, root: str, nowuid: str, account: str, files: list = None):
+    """把单个账号的文件压缩为分片，源文件不存在时返回 None"""
+    members = account_members(leixing, root, nowuid, account, files)
+    if not members:
+        return None
+
+    path = blob_path(root, nowuid, account)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 先写临时文件再替换，发货线程不会读到写了一半的分片
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for file_path, arcname in members:
+                zipf.write(file_path, arcname)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def prepack_accounts(leixing: str, root: str, nowuid: str, accounts, progress_callback=None,
+                     max_workers: int = None, files_by_account: dict = None) -> int:
+    """入库阶段批量预打包（覆盖已有分片，重新上传的同名账号会使用新文件）
+
+    Args:
+        accounts: 账号名列表（可重复，自动去重）
+        progress_callback: 回调 progress_callback(已打包数, 总数)
+        files_by_account: {账号名: files}，入库时账号记录尚未写入，由调用方传入存储位置
+
+    Returns:
+        int: 成功生成的分片数量
+    """
+    if leixing not in PACKABLE_TYPES:
+        return 0
+    accounts = list(dict.fromkeys(accounts))
+    total = len(accounts)
+    if total == 0:
+        return 0
+
+    done = [0, 0]
+    lock = threading.Lock()
+
+    def worker(account):
+        try:
+            files = files_by_account.get(account) if files_by_account is not None else None
+            built = build_account_blob(leixing, root, nowuid, account, files) is not None
+        except Exception as e:
+            built = False
+            logging.error(f"❌ 预打包账号失败：nowuid={nowuid}, account={account} - {e}")
+        with lock:
+            done[0] += 1
+            done[1] += built
+            current = done[0]
+        if progress_callback and (current % 200 == 0 or current == total):
+            progress_callback(current, total)
+
+    # zlib 压缩时会释放 GIL，线程池即可并行
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers or INGEST_EXTRACT_WORKERS, total))) as executor:
+        list(executor.map(worker, accounts))
+
+    logging.info(f"📦 预打包完成：nowuid={nowuid}, {done[1]}/{total} 个账号")
+    return done[1]
+
+
+def discard_account_blobs(root: str, nowuid: str, accounts):
+    """删除账号的预打包分片（账号被取出/删除后调用）"""
+    for account in accounts:
+        try:
+            path = blob_path(root, nowuid, account)
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            logging.warning(f"⚠️ 删除预打包分片失败：nowuid={nowuid}, account={account} - {e}")
+
+
+def resolve_account_blob(leixing: str, roots: list, nowuid: str, account: str):
+    """按源目录顺序查找分片，都不存在时从源文件现场生成（兼容功能上线前入库的库存）"""
+    for root in roots:
+        path = blob_path(root, nowuid, account)
+        if os.path.exists(path):
+            return path
+    for root in roots:
+        path = build_account_blob(leixing, root, nowuid, account)
+        if path:
+            return path
+    return None
+
+
+# ================================ 拼接发货压缩包 ================================
+
+def _dos_datetime(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11 | minute << 5 | second // 2), ((year - 1980) << 9 | month << 5 | day)
+
+
+def _encode_name(info, prefix=''):
+    # 数据长度已知，去掉 data descriptor 标志；非 ASCII 文件名按 UTF-8 写入并置位 0x800
+    flags = info.flag_bits & ~0x08
+    filename = prefix + info.filename
+    try:
+        return filename.encode('ascii'), flags & ~0x800
+    except UnicodeEncodeError:
+        return filename.encode('utf-8'), flags | 0x800
+
+
+def _copy(src, dst, size):
+    while size > 0:
+        chunk = src.read(min(size, _COPY_BUFFER))
+        if not chunk:
+            raise IOError('预打包分片数据不完整')
+        dst.write(chunk)
+        size -= len(chunk)
+
+
+def _concat_blobs(blobs: list, out):
+    """拼接分片中的已压缩数据，写入新的中央目录"""
+    offset = 0
+    central = []
+    for path, infos, prefix in blobs:
+        with open(path, 'rb') as f:
+            for info in infos:
+                f.seek(info.header_offset)
+                header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+                f.seek(info.header_offset + _LOCAL_HEADER.size + header[10] + header[11])
+
+                name, flags = _encode_name(info, prefix)
+                dostime, dosdate = _dos_datetime(info.date_time)
+                local = _LOCAL_HEADER.pack(
+                    _LOCAL_SIG, info.extract_version, 0, flags, info.compress_type, dostime, dosdate,
+                    info.CRC, info.compress_size, info.file_size, len(name), 0
+                )
+                out.write(local)
+                out.write(name)
+                _copy(f, out, info.compress_size)
+                central.append((info, name, flags, dostime, dosdate, offset))
+                offset += len(local) + len(name) + info.compress_size
+
+    central_offset = offset
+    for info, name, flags, dostime, dosdate, header_offset in central:
+        record = _CENTRAL_HEADER.pack(
+            _CENTRAL_SIG, info.create_version, info.create_system, info.extract_version, 0,
+            flags, info.compress_type, dostime, dosdate, info.CRC, info.compress_size, info.file_size,
+            len(name), 0, 0, 0, info.internal_attr, info.external_attr, header_offset
+        )
+        out.write(record)
+        out.write(name)
+        offset += len(record) + len(name)
+
+    out.write(_END_RECORD.pack(_END_SIG, 0, 0, len(central), len(central), offset - central_offset,
+                               central_offset, 0))
+
+
+def _repack_blobs(blobs: list, out):
+    """超出普通 zip 上限时用 zipfile 重新打包（ZIP64）"""
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
+        for path, infos, prefix in blobs:
+            with zipfile.ZipFile(path, 'r') as blob:
+                for info in infos:
+                    data = blob.read(info)
+                    if prefix:
+                        info = copy.copy(info)
+                        info.filename = prefix + info.filename
+                    zipf.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def write_blob_zip(blobs, dest) -> int:
+    """把若干 zip 分片拼成一个压缩包
+
+    Args:
+        blobs: [(分片路径, 压缩包内路径前缀), ...]
+        dest: 输出文件路径，或已打开的可写文件对象
+
+    Returns:
+        int: 成功读取并写入的分片数量
+    """
+    loaded = []
+    total_size = 0
+    entries = 0
+    for path, prefix in blobs:
+        try:
+            with zipfile.ZipFile(path, 'r') as blob:
+                infos = blob.infolist()
+        except Exception as e:
+            logging.error(f"❌ 读取分片失败：{path} - {e}")
+            continue
+        loaded.append((path, infos, prefix))
+        total_size += os.path.getsize(path)
+        entries += len(infos)
+
+    needs_zip64 = total_size >= _ZIP64_LIMIT or entries >= _ZIP64_ENTRIES
+    write = _repack_blobs if needs_zip64 else _concat_blobs
+
+    if isinstance(dest, str):
+        with open(dest, 'wb') as out:
+            write(loaded, out)
+    else:
+        write(loaded, dest)
+    return len(loaded)
+
+
+def write_order_zip(leixing: str, roots, nowuid: str, accounts, dest) -> int:
+    """用预打包分片生成订单压缩包
+
+    Args:
+        roots: 账号源目录，按顺序查找（代理机器人传入总部目录和本地目录）
+        accounts: 账号名列表
+        dest: 输出文件路径，或已打开的可写文件对象
+
+    Returns:
+        int: 实际写入压缩包的账号数量
+    """
+    if isinstance(roots, str):
+        roots = [roots]
+
+    blobs = []
+    for account in accounts:
+        try:
+            path = resolve_account_blob(leixing, roots, nowuid, account)
+        except Exception as e:
+            logging.error(f"❌ 生成预打包分片失败：nowuid={nowuid}, account={account} - {e}")
+            continue
+        if not path:
+            logging.warning(f"⚠️ 账号文件不存在：nowuid={nowuid}, account={account}")
+            continue
+        blobs.append((path, ''))
+    return write_blob_zip(blobs, dest)
+
+
+# ================================ 发货文件 ================================
+
+class DeliveryArtifact:
+    """发货文件
+
+    内容写入 SpooledTemporaryFile，小于 DELIVERY_SPOOL_MAX_SIZE 时只在内存中，
+    超过后自动转存临时文件；close() / 退出 with 块时释放，不会遗留文件。
+
+    用法：
+        with order_zip_artifact('协议号', './协议号', nowuid, accounts, 'xxx.zip') as artifact:
+            bot.send_document(chat_id, document=artifact.open(), filename=artifact.filename)
+    """
+
+    def __init__(self, filename: str, max_size: int = None):
+        self.filename = filename
+        self.count = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size or DELIVERY_SPOOL_MAX_SIZE, mode='w+b')
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.file.write(data)
+
+    def open(self):
+        """回到开头并返回文件对象，用于 send_document / reply_document"""
+        self.file.seek(0)
+        return self.file
+
+    @property
+    def size(self) -> int:
+        position = self.file.tell()
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        self.file.seek(position)
+        return size
+
+    def close(self):
+        try:
+            self.file.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def order_zip_artifact(leixing: str, roots, nowuid: str, accounts, filename: str) -> DeliveryArtifact:
+    """按账号生成订单压缩包，artifact.count 为实际打包的账号数量"""
+    artifact = DeliveryArtifact(filename)
+    try:
+        artifact.count = write_order_zip(leixing, roots, nowuid, accounts, artifact.file)
+    except Exception:
+        artifact.close()
+        raise
+    return artifact
+
+
+def text_artifact(content: str, filename: str) -> DeliveryArtifact:
+    """文本类发货内容（txt 文件）"""
+    artifact = DeliveryArtifact(filename)
+    artifact.write(content)
+    return artifact
+
+
+def file_artifact(path: str, filename: str = None) -> DeliveryArtifact:
+    """读取磁盘上已有的文件（旧订单保存的压缩包）"""
+    artifact = DeliveryArtifact(filename or os.path.basename(path))
+    try:
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, artifact.file)
+    except Exception:
+        artifact.close()
+        raise
+    return artifact
+
+
+def directory_zip_artifact(entries, filename: str) -> DeliveryArtifact:
+    """把若干目录/文件打包为发货压缩包（用于 TData 等现场生成的内容）
+
+    Args:
+        entries: [(本地路径, 压缩包内路径), ...]，本地路径为目录时递归加入
+    """
+    artifact = DeliveryArtifact(filename)
+    try:
+        with zipfile.ZipFile(artifact.file, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for path, arcname in entries:
+                if os.path.isdir(path):
+                    for dirpath, _, files in os.walk(path):
+                        for file in files:
+                            file_path = os.path.join(dirpath, file)
+                            zipf.write(file_path, os.path.join(arcname, os.path.relpath(file_path, path)))
+                elif os.path.exists(path):
+                    zipf.write(path, arcname)
+    except Exception:
+        artifact.close()
+        raise
+    return artifact
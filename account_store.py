@@ -0,0 +1,243 @@
+"""
+账号文件存储（内容寻址）
+账号文件按内容 sha256 存放在分片目录 {ACCOUNT_STORE_DIR}/ab/cd/{sha256}{扩展名}，相同内容只存一份；
+hb 记录的 files 字段保存 [{'name': 压缩包内路径, 'sha256': ..., 'ext': 扩展名}, ...]。
+发货、检测、转换统一通过 open_account() 取账号文件，不再在多个根目录下逐个探测；
+没有 files 字段的旧库存回退到原来的 ./协议号/{nowuid}、./号包/{nowuid} 平铺目录，可用 migrate_legacy_accounts() 迁移
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
+
+from mongo import hb, ACCOUNT_STORE_DIR, INGEST_EXTRACT_WORKERS
+
+
+_HASH_BUFFER = 1024 * 1024
+
+# 各商品类型的旧平铺目录
+LEGACY_ROOTS = {'协议号': './协议号', '直登号': './号包'}
+
+
+# ================================ 存储路径 ================================
+
+def store_path(sha256: str, ext: str = '') -> str:
+    """文件在存储中的路径，两级分片：ab/cd/abcd...{ext}"""
+    return os.path.join(ACCOUNT_STORE_DIR, sha256[:2], sha256[2:4], sha256 + ext)
+
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_BUFFER), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def put_file(path: str, move: bool = False):
+    """把文件放入存储，内容相同的文件只保留一份
+
+    Args:
+        move: 放入后删除源文件（入库时源文件在临时解压目录）
+
+    Returns:
+        (sha256, ext)
+    """
+    sha256 = file_sha256(path)
+    # 保留 .session / .json 扩展名，Telethon 等按扩展名识别文件
+    ext = os.path.splitext(path)[1]
+    dest = store_path(sha256, ext)
+    if os.path.exists(dest):
+        if move:
+            os.remove(path)
+        return sha256, ext
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        if move:
+            shutil.move(path, tmp_path)
+        else:
+            shutil.copy2(path, tmp_path)
+        os.replace(tmp_path, dest)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return sha256, ext
+
+
+# ================================ 账号文件 ================================
+
+def legacy_members(leixing: str, root: str, nowuid: str, account: str) -> list:
+    """旧平铺目录中的账号文件 [(文件路径, 压缩包内路径), ...]"""
+    base = os.path.join(root, nowuid)
+    members = []
+    if leixing == '协议号':
+        for ext in ('.json', '.session'):
+            path = os.path.join(base, account + ext)
+            if os.path.exists(path):
+                members.append((path, os.path.basename(path)))
+    elif leixing == '直登号':
+        folder = os.path.join(base, account)
+        for dirpath, _, files in os.walk(folder):
+            for file in files:
+                path = os.path.join(dirpath, file)
+                members.append((path, os.path.join(account, os.path.relpath(path, folder))))
+    return members
+
+
+def stored_members(files: list) -> list:
+    """hb.files 对应的存储文件 [(文件路径, 压缩包内路径), ...]"""
+    return [(store_path(f['sha256'], f.get('ext', '')), f['name']) for f in files]
+
+
+def find_account_files(nowuid: str, account: str):
+    """按 (nowuid, 账号名) 查询 hb.files，旧库存返回 None"""
+    doc = hb.find_one({'nowuid': nowuid, 'projectname': account}, {'files': 1})
+    return doc.get('files') if doc else None
+
+
+class AccountFiles:
+    """一个账号的文件位置"""
+
+    def __init__(self, name: str, members: list):
+        self.name = name
+        self.members = members
+
+    def _find(self, ext):
+        for path, arcname in self.members:
+            if arcname.endswith(ext):
+                return path
+        return None
+
+    @property
+    def session(self):
+        """.session 文件路径（协议号）"""
+        return self._find('.session')
+
+    @property
+    def json(self):
+        """.json 文件路径（协议号）"""
+        return self._find('.json')
+
+    def __bool__(self):
+        return bool(self.members)
+
+
+def open_account(account, roots=None) -> AccountFiles:
+    """获取账号文件
+
+    Args:
+        account: hb 记录，或 hbid
+        roots: 旧库存的平铺目录（按顺序查找），默认按商品类型取 LEGACY_ROOTS
+
+    Returns:
+        AccountFiles: 文件不存在时 members 为空
+    """
+    doc = account if isinstance(account, dict) else hb.find_one({'hbid': account})
+    if not doc:
+        return AccountFiles(None, [])
+    name = doc.get('projectname')
+    if doc.get('files'):
+        return AccountFiles(name, stored_members(doc['files']))
+
+    leixing = doc.get('leixing', '协议号')
+    if roots is None:
+        roots = [LEGACY_ROOTS.get(leixing, './协议号')]
+    elif isinstance(roots, str):
+        roots = [roots]
+    for root in roots:
+        members = legacy_members(leixing, root, doc.get('nowuid'), name)
+        if members:
+            return AccountFiles(name, members)
+    return AccountFiles(name, [])
+
+
+# ================================ 入库与删除 ================================
+
+def store_accounts(leixing: str, root: str, nowuid: str, accounts, move: bool = True,
+                   max_workers: int = None) -> dict:
+    """把解压目录中的账号文件放入存储（入库时调用）
+
+    Returns:
+        dict: {账号名: files}，写入 hb.files
+    """
+    accounts = list(dict.fromkeys(accounts))
+    result = {}
+    lock = threading.Lock()
+
+    def worker(account):
+        try:
+            files = []
+            for path, arcname in legacy_members(leixing, root, nowuid, account):
+                sha256, ext = put_file(path, move=move)
+                files.append({'name': arcname, 'sha256': sha256, 'ext': ext})
+            if files:
+                with lock:
+                    result[account] = files
+        except Exception as e:
+            logging.error(f"❌ 账号文件入库失败：nowuid={nowuid}, account={account} - {e}")
+
+    if accounts:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers or INGEST_EXTRACT_WORKERS, len(accounts)))) as executor:
+            list(executor.map(worker, accounts))
+    return result
+
+
+def release_account_files(docs):
+    """删除账号后释放存储文件：没有其他 hb 记录引用的文件才删除
+
+    Args:
+        docs: 被删除（或即将删除）的 hb 记录
+    """
+    docs = [doc for doc in docs if doc.get('files')]
+    if not docs:
+        return
+    ids = [doc['_id'] for doc in docs if '_id' in doc]
+    for doc in docs:
+        for f in doc['files']:
+            try:
+                if hb.count_documents({'files.sha256': f['sha256'], '_id': {'$nin': ids}}, limit=1):
+                    continue
+                path = store_path(f['sha256'], f.get('ext', ''))
+                if os.path.exists(path):
+                    os.remove(path)
+            except Exception as e:
+                logging.warning(f"⚠️ 删除存储文件失败：{f.get('sha256')} - {e}")
+
+
+def migrate_legacy_accounts(leixing: str, root: str = None, nowuid: str = None, batch: int = 500) -> int:
+    """把旧平铺目录中的库存迁移到存储（只迁移未售出的库存，原文件移入存储）
+
+    Returns:
+        int: 迁移的账号数量
+    """
+    root = root or LEGACY_ROOTS.get(leixing)
+    query = {'leixing': leixing, 'state': 0, 'files': {'$exists': False}}
+    if nowuid:
+        query['nowuid'] = nowuid
+
+    migrated = 0
+    while True:
+        docs = list(hb.find(query, {'nowuid': 1, 'projectname': 1}).limit(batch))
+        if not docs:
+            break
+        by_product = {}
+        for doc in docs:
+            by_product.setdefault(doc['nowuid'], []).append(doc)
+
+        updates = []
+        for product, product_docs in by_product.items():
+            stored = store_accounts(leixing, root, product, [doc['projectname'] for doc in product_docs])
+            for doc in product_docs:
+                # 找不到文件的记录写入空列表，避免下一批重复处理
+                updates.append(UpdateOne({'_id': doc['_id']}, {'$set': {'files': stored.get(doc['projectname'], [])}}))
+                migrated += doc['projectname'] in stored
+        hb.bulk_write(updates, ordered=False)
+
+    logging.info(f"📦 旧库存迁移完成：{leixing} {migrated} 个账号")
+    return migrated
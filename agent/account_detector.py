@@ -6,9 +6,11 @@ After-sales account quality detection module
 1.连接代理
 2.登录账户
 3.向收藏夹发送随机消息检测账号状态
-4.并发检测（30线程）
+4.并发检测（单个事件循环，AIMD 自适应调整并发数，单代理并发有上限）
 5.超时保护，防止卡死
-6.保护原始session文件，检测用临时复制文件
+6.保护原始session文件：只读加载授权密钥到内存会话，不复制临时文件
+7.代理池按连接成功率和延迟加权选择，连续失败的代理熔断冷却，proxy.txt 修改后自动重新加载
+8.记录各检测阶段（连接、授权、获取用户信息、发消息、删消息）的耗时直方图，按代理和 DC 分组
 
 状态定义：
 - 存活(normal): 能连接且能发消息到收藏夹
@@ -24,9 +26,17 @@ import time
 import random
 import string
 import shutil
+import sqlite3
+import bisect
+from contextlib import contextmanager
+from urllib.request import pathname2url
 from typing import List, Dict, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import threading
+from concurrent.futures import Future
 from telethon import TelegramClient
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
 from telethon.errors import (
     SessionPasswordNeededError,
     PhoneNumberBannedError,
@@ -106,25 +116,112 @@ def generate_random_message():
     return f"{random_symbol}{random_str}{timestamp}"
 
 
+def load_memory_session(session_path: str):
+    """
+    只读读取 Telethon .session（SQLite）中的 DC 与授权密钥，构造内存会话
+    
+    检测时 Telethon 不会写原始文件，也不需要复制临时文件。
+    
+    Returns:
+        MemorySession，文件不是可识别的 Telethon session 时返回 None
+    """
+    try:
+        conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(session_path))}?mode=ro", uri=True)
+        try:
+            row = conn.execute("SELECT dc_id, server_address, port, auth_key FROM sessions").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.debug(f"读取session失败: {session_path}, {e}")
+        return None
+    if not row:
+        return None
+    
+    dc_id, server_address, port, auth_key = row
+    session = MemorySession()
+    session.set_dc(dc_id, server_address, port)
+    if auth_key:
+        session.auth_key = AuthKey(data=auth_key)
+    return session
+
+
+class ProxyConnectError(Exception):
+    """通过代理连接 Telegram 失败（与账号状态无关）"""
+
+
+def format_proxy(proxy: Dict) -> str:
+    """代理的可读形式（不含账号密码），用于记录检测所用代理"""
+    if not proxy:
+        return None
+    return f"{proxy['proxy_type']}://{proxy['addr']}:{proxy['port']}"
+
+
+class ProxyHealth:
+    """单个代理的健康统计"""
+    
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.flood_waits = 0
+        self.latency = None           # 连接耗时的指数移动平均（秒）
+        self.consecutive_failures = 0
+        self.cooldown = 0             # 当前熔断时长（秒）
+        self.open_until = 0           # 熔断结束时间（time.time()）
+        self.evicted = False
+    
+    @property
+    def success_rate(self) -> float:
+        """平滑后的成功率，没有样本时为 0.5"""
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+    
+    def weight(self) -> float:
+        """选择权重：成功率越高、延迟越低权重越大"""
+        latency = self.latency if self.latency is not None else 1.0
+        return self.success_rate ** 2 / max(latency, 0.05)
+
+
 class ProxyManager:
-    """代理管理器"""
+    """代理池：按健康度加权选择代理，连续失败的代理熔断冷却，代理文件修改后自动重新加载"""
     
-    def __init__(self, proxy_file='proxy.txt'):
+    def __init__(self, proxy_file='proxy.txt', failure_threshold: int = 3, cooldown: int = 60,
+                 max_cooldown: int = 900, evict_after: int = 10, reload_interval: int = 5,
+                 per_proxy_limit: int = 5):
+        """
+        Args:
+            per_proxy_limit: 每个代理同时进行的检测数上限
+            failure_threshold: 连续失败多少次后熔断
+            cooldown: 首次熔断时长（秒），再次失败时翻倍，最长 max_cooldown
+            evict_after: 连续失败多少次后移出代理池，直到代理文件被修改
+            reload_interval: 检查代理文件是否修改的间隔（秒）
+        """
         self.proxy_file = os.path.join(os.path.dirname(__file__), proxy_file)
         self.proxies = []
-        self.current_index = 0
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.evict_after = evict_after
+        self.reload_interval = reload_interval
+        self.per_proxy_limit = per_proxy_limit
+        self._health = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0
         self.load_proxies()
     
     def load_proxies(self):
-        """从文件加载代理"""
+        """从文件加载代理，已有代理的健康统计保留，被移出的代理重新加入"""
         if not os.path.exists(self.proxy_file):
             logging.warning(f"代理文件不存在: {self.proxy_file}")
             return
         
         try:
+            mtime = os.path.getmtime(self.proxy_file)
             with open(self.proxy_file, 'r', encoding='utf-8') as f:
                 lines = f.readlines()
             
+            proxies = []
             for line in lines: 
                 line = line.strip()
                 if not line or line.startswith('#'):
@@ -132,12 +229,36 @@ class ProxyManager:
                 
                 proxy = self.parse_proxy(line)
                 if proxy:
-                    self.proxies.append(proxy)
+                    proxies.append(proxy)
+            
+            with self._lock:
+                health = {}
+                for proxy in proxies:
+                    key = self.proxy_key(proxy)
+                    health[key] = self._health.get(key) or ProxyHealth()
+                    health[key].evicted = False
+                self.proxies = proxies
+                self._health = health
+                self._mtime = mtime
             
             logging.info(f"✅ 加载了 {len(self.proxies)} 个代理")
         except Exception as e:
             logging.error(f"❌ 加载代理失败: {e}")
     
+    def _maybe_reload(self):
+        """代理文件修改后重新加载（按 reload_interval 节流）"""
+        now = time.time()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.proxy_file)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            logging.info(f"🔄 代理文件已修改，重新加载: {self.proxy_file}")
+            self.load_proxies()
+    
     def parse_proxy(self, line:  str) -> Dict:
         """解析代理配置"""
         try:
@@ -179,17 +300,323 @@ class ProxyManager:
             logging.error(f"解析代理失败: {line}, 错误: {e}")
         return None
     
+    @staticmethod
+    def proxy_key(proxy: Dict) -> str:
+        """代理的唯一标识（同一地址不同账号视为不同代理）"""
+        return f"{proxy['proxy_type']}://{proxy.get('username') or ''}@{proxy['addr']}:{proxy['port']}"
+    
+    def _choose(self, respect_limit: bool) -> Dict:
+        """按健康度加权随机选择一个代理；全部熔断时选最早恢复的代理（调用方持有锁）"""
+        now = time.time()
+        entries = [(proxy, self._health[self.proxy_key(proxy)]) for proxy in self.proxies]
+        available = [(proxy, health) for proxy, health in entries
+                     if not health.evicted and health.open_until <= now]
+        if respect_limit:
+            # 优先选未达到单代理并发上限的；全部满载时在可用代理里选负载最低的
+            idle = [(proxy, health) for proxy, health in available
+                    if self._in_flight.get(self.proxy_key(proxy), 0) < self.per_proxy_limit]
+            if idle:
+                available = idle
+            elif available:
+                return min(available, key=lambda item: self._in_flight.get(self.proxy_key(item[0]), 0))[0]
+        if available:
+            return random.choices(
+                [proxy for proxy, _ in available],
+                weights=[health.weight() for _, health in available]
+            )[0]
+        # 没有可用代理：不直连，选最早结束熔断的（全部被移出时选连续失败最少的）
+        candidates = [(proxy, health) for proxy, health in entries if not health.evicted] or entries
+        return min(candidates, key=lambda item: (item[1].open_until, item[1].consecutive_failures))[0]
+    
     def get_next_proxy(self) -> Dict:
-        """获取下一个代理（轮询）"""
-        if not self.proxies:
-            return None
-        proxy = self.proxies[self.current_index]
-        self.current_index = (self.current_index + 1) % len(self.proxies)
-        return proxy
+        """按健康度加权随机选择一个代理；全部熔断时选最早恢复的代理"""
+        self._maybe_reload()
+        with self._lock:
+            if not self.proxies:
+                return None
+            return self._choose(respect_limit=False)
+    
+    def acquire_proxy(self) -> Dict:
+        """选择一个代理并占用一个并发名额，用完后调用 release_proxy()"""
+        self._maybe_reload()
+        with self._lock:
+            if not self.proxies:
+                return None
+            proxy = self._choose(respect_limit=True)
+            key = self.proxy_key(proxy)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            return proxy
+    
+    def release_proxy(self, proxy: Dict):
+        if not proxy:
+            return
+        with self._lock:
+            key = self.proxy_key(proxy)
+            if self._in_flight.get(key, 0) > 0:
+                self._in_flight[key] -= 1
+    
+    def capacity(self) -> int:
+        """代理池能承受的总并发：未被移出的代理数 × 单代理上限，没有代理时为 None"""
+        with self._lock:
+            if not self.proxies:
+                return None
+            usable = sum(1 for health in self._health.values() if not health.evicted) or len(self.proxies)
+            return usable * self.per_proxy_limit
+    
+    def report(self, proxy: Dict, outcome: str, latency: float = None):
+        """
+        记录一次代理使用结果
+        
+        Args:
+            outcome: 'ok' 连接成功, 'timeout' 连接超时, 'error' 连接失败, 'flood' 连接成功但触发 FloodWait
+            latency: 连接耗时（秒），仅 'ok' 时记录
+        """
+        if not proxy:
+            return
+        with self._lock:
+            health = self._health.get(self.proxy_key(proxy))
+            if health is None:
+                return
+            if outcome == 'flood':
+                health.flood_waits += 1
+                return
+            if outcome == 'ok':
+                health.successes += 1
+                health.consecutive_failures = 0
+                health.cooldown = 0
+                health.open_until = 0
+                if latency is not None:
+                    health.latency = latency if health.latency is None else health.latency * 0.7 + latency * 0.3
+                return
+            
+            health.failures += 1
+            if outcome == 'timeout':
+                health.timeouts += 1
+            health.consecutive_failures += 1
+            if health.consecutive_failures >= self.evict_after:
+                if not health.evicted:
+                    health.evicted = True
+                    logging.warning(f"🚫 代理连续失败 {health.consecutive_failures} 次，移出代理池: {format_proxy(proxy)}")
+            elif health.consecutive_failures >= self.failure_threshold:
+                health.cooldown = min(self.max_cooldown, health.cooldown * 2 if health.cooldown else self.cooldown)
+                health.open_until = time.time() + health.cooldown
+                logging.warning(f"⛔ 代理熔断 {health.cooldown} 秒: {format_proxy(proxy)}")
     
     def get_all_proxies(self) -> List[Dict]:
         """获取所有代理"""
         return self.proxies.copy()
+    
+    def stats(self) -> List[Dict]:
+        """代理池统计快照，按权重降序"""
+        now = time.time()
+        with self._lock:
+            snapshot = []
+            for proxy in self.proxies:
+                health = self._health[self.proxy_key(proxy)]
+                if health.evicted:
+                    state = 'evicted'
+                elif health.open_until > now:
+                    state = 'open'
+                else:
+                    state = 'ok'
+                snapshot.append({
+                    'proxy': format_proxy(proxy),
+                    'state': state,
+                    'successes': health.successes,
+                    'failures': health.failures,
+                    'timeouts': health.timeouts,
+                    'flood_waits': health.flood_waits,
+                    'success_rate': round(health.success_rate, 3),
+                    'latency': round(health.latency, 3) if health.latency is not None else None,
+                    'cooldown_left': max(0, int(health.open_until - now)),
+                    'in_flight': self._in_flight.get(self.proxy_key(proxy), 0),
+                    'weight': health.weight()
+                })
+        snapshot.sort(key=lambda item: -item['weight'])
+        return snapshot
+    
+    def summary(self) -> str:
+        """一行统计：可用 / 熔断 / 移出"""
+        counts = {'ok': 0, 'open': 0, 'evicted': 0}
+        for item in self.stats():
+            counts[item['state']] += 1
+        return f"可用 {counts['ok']} / 熔断 {counts['open']} / 移出 {counts['evicted']}"
+
+
+# 同一代理文件共用一个代理池，健康统计在多次批量检测之间保留
+_proxy_managers = {}
+_proxy_managers_lock = threading.Lock()
+
+
+def get_proxy_manager(proxy_file: str = 'proxy.txt') -> ProxyManager:
+    with _proxy_managers_lock:
+        manager = _proxy_managers.get(proxy_file)
+        if manager is None:
+            manager = _proxy_managers[proxy_file] = ProxyManager(proxy_file)
+        return manager
+
+
+# ================================ 检测阶段耗时 ================================
+
+# 检测阶段，依次对应：读取 session、client.connect、is_user_authorized、get_me、send_message('me')、sent.delete、disconnect
+DETECTION_STAGES = ('load_session', 'connect', 'authorize', 'get_me', 'send_message', 'delete_message', 'disconnect')
+# 直方图桶上界（秒），覆盖各阶段的超时设置（10/5/5/10/3 秒）和单账号总超时
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 30)
+
+
+class LatencyHistogram:
+    """固定桶的耗时直方图，分位数按桶内线性插值估算"""
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶为超出上界的样本
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for i, n in enumerate(self.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.max
+            if n and cumulative + n >= rank:
+                return min(lower + (upper - lower) * (rank - cumulative) / n, self.max)
+            cumulative += n
+            lower = upper
+        return self.max
+    
+    def snapshot(self) -> Dict:
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': self.max if self.count else None,
+            'buckets': dict(zip([*self.buckets, float('inf')], self.counts))
+        }
+
+
+class StageStats:
+    """一个阶段的耗时直方图和结果计数"""
+    
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.outcomes = {}
+    
+    def observe(self, seconds: float, outcome: str):
+        self.latency.observe(seconds)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+
+class StageTimer:
+    """记录一次检测中各阶段的耗时和结果：with timer('connect'): ...
+
+    结果：'ok'、'timeout'（asyncio 超时）、'flood'（FloodWait）、'cancelled'（被总超时取消）、'error'（其他异常）；
+    异常照常向外抛出，由原有的处理逻辑判断账号状态
+    """
+    
+    def __init__(self, timings: list, proxy: str = None):
+        self.timings = timings
+        self.proxy = proxy
+        self.dc = None  # 创建 client 后填入 session 的 DC
+    
+    @contextmanager
+    def __call__(self, stage: str):
+        started = time.monotonic()
+        outcome = 'ok'
+        try:
+            yield
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise
+        except FloodWaitError:
+            outcome = 'flood'
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            self.timings.append((stage, time.monotonic() - started, outcome, self.proxy, self.dc))
+
+
+class DetectionMetrics:
+    """检测阶段耗时统计：按阶段、按 (代理, 阶段)、按 (DC, 阶段) 分别累计直方图"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self._groups = {'stage': {}, 'proxy': {}, 'dc': {}}
+            self.since = time.time()
+    
+    def _observe(self, group: str, key, seconds: float, outcome: str):
+        stats = self._groups[group].get(key)
+        if stats is None:
+            stats = self._groups[group][key] = StageStats()
+        stats.observe(seconds, outcome)
+    
+    def record(self, timings: list):
+        """
+        Args:
+            timings: [(stage, seconds, outcome, proxy, dc), ...]，proxy 为 None 表示直连，dc 为 None 表示未知
+        """
+        with self._lock:
+            for stage, seconds, outcome, proxy, dc in timings:
+                self._observe('stage', stage, seconds, outcome)
+                self._observe('proxy', (proxy or 'direct', stage), seconds, outcome)
+                if dc is not None:
+                    self._observe('dc', (f'DC{dc}', stage), seconds, outcome)
+    
+    def snapshot(self, by: str = 'stage') -> List[Dict]:
+        """
+        统计快照
+        
+        Args:
+            by: 'stage' 按阶段，'proxy' 按代理和阶段，'dc' 按 DC 和阶段
+        
+        Returns:
+            [{'stage', 'proxy'/'dc'（分组时）, 'count', 'avg', 'p50', 'p95', 'p99', 'max', 'buckets', 'outcomes'}, ...]
+        """
+        order = {stage: i for i, stage in enumerate(DETECTION_STAGES + ('total',))}
+        with self._lock:
+            items = []
+            for key, stats in self._groups[by].items():
+                item = {'stage': key} if by == 'stage' else {by: key[0], 'stage': key[1]}
+                item.update(stats.latency.snapshot())
+                item['outcomes'] = dict(stats.outcomes)
+                items.append(item)
+        items.sort(key=lambda item: (item[by] if by != 'stage' else '', order.get(item['stage'], len(order))))
+        return items
+    
+    def summary_lines(self) -> List[str]:
+        """各阶段一行：次数、p50/p95/p99/最大耗时、非正常结果计数"""
+        lines = []
+        for item in self.snapshot():
+            failures = ', '.join(f"{outcome} {n}" for outcome, n in item['outcomes'].items() if outcome != 'ok')
+            lines.append(
+                f"{item['stage']}: {item['count']}次 p50 {item['p50']:.2f}s p95 {item['p95']:.2f}s "
+                f"p99 {item['p99']:.2f}s max {item['max']:.2f}s" + (f" ({failures})" if failures else '')
+            )
+        return lines
+
+
+# 进程内累计的检测阶段耗时，管理员命令 /detect_stats 读取
+detection_metrics = DetectionMetrics()
 
 
 class AccountDetector:
@@ -205,28 +632,55 @@ class AccountDetector:
         检测单个账号
         
         检测逻辑：
-        1.复制session文件用于检测（保护原始文件）
-        2.尝试连接 -> 失败则封禁
-        3.尝试发消息到收藏夹 -> 成功则存活，失败则冻结
+        1.只读加载session授权密钥到内存会话（不修改原始文件）；无法按Telethon格式读取时回退为复制临时文件检测
+        2.尝试连接 -> 连接失败换代理重试，仍失败则未知；未授权/会话失效则封禁
+        3.尝试发消息到收藏夹 -> 成功则存活，失败则冻结（超时、频率受限为未知）
         
         Returns:
             (status, message)
             status: 'normal', 'banned', 'frozen', 'unknown'
         """
+        status, message, _ = await self.check_account_detail(session_file, json_file, max_proxy_retries)
+        return status, message
+    
+    async def check_account_detail(self, session_file: str, json_file: str, max_proxy_retries: int = 2,
+                                   events: list = None, timings: list = None) -> Tuple[str, str, str]:
+        """
+        检测单个账号，同时返回最后使用的代理
+        
+        Args:
+            events: 传入列表时追加检测过程中的拥塞信号：'timeout'、'flood'、'proxy_error'
+            timings: 传入列表时追加各阶段耗时 (stage, seconds, outcome, proxy, dc)，见 StageTimer
+        
+        Returns:
+            (status, message, proxy): proxy 为 format_proxy() 的结果，直连时为 None
+        """
         logging.debug(f"📝 开始检测账号:  {session_file}")
+        events = events if events is not None else []
+        timings = timings if timings is not None else []
         
+        proxy = None
         for retry in range(max_proxy_retries):
-            proxy = self.proxy_manager.get_next_proxy() if self.proxy_manager.proxies else None
+            proxy = self.proxy_manager.acquire_proxy() if self.proxy_manager.proxies else None
             
             try:
-                result = await self._check_with_proxy(session_file, json_file, proxy)
-                return result
+                status, message = await self._check_with_proxy(session_file, json_file, proxy, events, timings)
+                return status, message, format_proxy(proxy)
+            except ProxyConnectError as e:
+                # 代理连不上与账号无关，换一个代理重试
+                events.append('proxy_error')
+                logging.warning(f"⚠️ 代理连接失败 (retry {retry+1}/{max_proxy_retries}): {format_proxy(proxy)} {e}")
+                if retry >= max_proxy_retries - 1:
+                    return 'unknown', str(e), format_proxy(proxy)
             except Exception as e: 
                 logging.warning(f"⚠️ 检测失败 (retry {retry+1}/{max_proxy_retries}): {e}")
                 if retry >= max_proxy_retries - 1:
-                    return self._classify_error(str(e))
+                    status, message = self._classify_error(str(e))
+                    return status, message, format_proxy(proxy)
+            finally:
+                self.proxy_manager.release_proxy(proxy)
         
-        return 'unknown', '连接失败'
+        return 'unknown', '连接失败', format_proxy(proxy)
     
     def _classify_error(self, error_msg: str) -> Tuple[str, str]:
         """根据错误信息分类状态"""
@@ -242,56 +696,78 @@ class AccountDetector:
         
         return 'unknown', error_msg
     
-    async def _check_with_proxy(self, session_file: str, json_file: str, proxy: Dict = None) -> Tuple[str, str]:
-        """使用指定代理检测账号 - 带超时保护，使用临时session文件"""
+    async def _check_with_proxy(self, session_file: str, json_file: str, proxy: Dict = None,
+                                events: list = None, timings: list = None) -> Tuple[str, str]:
+        """使用指定代理检测账号 - 带超时保护，session 只读加载到内存"""
+        events = events if events is not None else []
+        stage = StageTimer(timings if timings is not None else [], format_proxy(proxy))
         client = None
-        temp_session = None
         temp_session_path = None
         
         try: 
-            # 复制session文件用于检测，保护原始文件不被Telethon修改
             original_session_path = session_file + '.session'
-            temp_session = session_file + f'_detect_{int(time.time() * 1000)}'
-            temp_session_path = temp_session + '.session'
+            if not os.path.exists(original_session_path):
+                # 原始文件不存在
+                return 'banned', f'Session文件不存在: {original_session_path}'
             
-            try:
-                if os.path.exists(original_session_path):
-                    shutil.copy2(original_session_path, temp_session_path)
-                else:
-                    # 原始文件不存在
-                    return 'banned', f'Session文件不存在: {original_session_path}'
-            except Exception as copy_err:
-                logging.warning(f"复制session失败: {copy_err}, 使用原文件")
-                temp_session = session_file
-                temp_session_path = None
+            # 授权密钥只读加载到内存会话，保护原始文件不被Telethon修改，也不产生临时文件
+            with stage('load_session'):
+                session = load_memory_session(original_session_path)
+                if session is None:
+                    # 无法按 Telethon 格式读取时回退为复制临时文件检测
+                    session = session_file + f'_detect_{int(time.time() * 1000)}'
+                    temp_session_path = session + '.session'
+                    try:
+                        shutil.copy2(original_session_path, temp_session_path)
+                    except Exception as copy_err:
+                        logging.warning(f"复制session失败: {copy_err}, 使用原文件")
+                        session = session_file
+                        temp_session_path = None
             
             client = TelegramClient(
-                temp_session,
+                session,
                 self.api_id,
                 self.api_hash,
                 proxy=proxy,
                 timeout=10,
                 connection_retries=1
             )
+            stage.dc = getattr(client.session, 'dc_id', None) or None
             
-            # 连接超时10秒
-            await asyncio.wait_for(client.connect(), timeout=10)
+            # 连接超时10秒；连接结果计入代理健康统计
+            connect_started = time.monotonic()
+            try:
+                with stage('connect'):
+                    await asyncio.wait_for(client.connect(), timeout=10)
+            except asyncio.TimeoutError:
+                self.proxy_manager.report(proxy, 'timeout')
+                events.append('timeout')
+                raise ProxyConnectError('连接超时')
+            except Exception as e:
+                # connect() 只建立传输连接，不涉及账号状态，这里的异常都是网络/代理问题
+                self.proxy_manager.report(proxy, 'error')
+                raise ProxyConnectError(f'连接失败: {str(e)}')
+            self.proxy_manager.report(proxy, 'ok', time.monotonic() - connect_started)
             
             # 检查授权超时5秒
             try:
-                authorized = await asyncio.wait_for(client.is_user_authorized(), timeout=5)
+                with stage('authorize'):
+                    authorized = await asyncio.wait_for(client.is_user_authorized(), timeout=5)
                 if not authorized: 
                     return 'banned', 'Session未授权，账号可能已封禁'
             except asyncio.TimeoutError:
+                events.append('timeout')
                 return 'unknown', '授权检查超时'
             
             # 获取用户信息超时5秒
             try: 
-                me = await asyncio.wait_for(client.get_me(), timeout=5)
+                with stage('get_me'):
+                    me = await asyncio.wait_for(client.get_me(), timeout=5)
             except asyncio.TimeoutError:
+                events.append('timeout')
                 return 'unknown', '获取用户信息超时'
             except UserDeactivatedError as e:
-                return 'frozen', f'账号已冻结: {str(e)}'
+                return 'banned', f'账号已停用: {str(e)}'
             except UserDeactivatedBanError as e:
                 return 'banned', f'账号已封禁: {str(e)}'
             except AuthKeyUnregisteredError as e: 
@@ -305,23 +781,29 @@ class AccountDetector:
             try:
                 test_msg = generate_random_message()
                 
-                sent = await asyncio.wait_for(
-                    client.send_message('me', test_msg),
-                    timeout=10
-                )
+                with stage('send_message'):
+                    sent = await asyncio.wait_for(
+                        client.send_message('me', test_msg),
+                        timeout=10
+                    )
                 
                 # 删除消息（不阻塞）
                 try:
-                    await asyncio.wait_for(sent.delete(), timeout=3)
+                    with stage('delete_message'):
+                        await asyncio.wait_for(sent.delete(), timeout=3)
                 except: 
                     pass
                 
                 return 'normal', '账号正常，可发送消息'
                 
+            # 超时和频率限制是暂时性的，记为未知，由下次巡检或购买检测重新确认
             except asyncio.TimeoutError:
-                return 'frozen', '发送消息超时'
+                events.append('timeout')
+                return 'unknown', '发送消息超时'
             except FloodWaitError as e:
-                return 'frozen', f'发送频率受限，需等待 {e.seconds} 秒'
+                self.proxy_manager.report(proxy, 'flood')
+                events.append('flood')
+                return 'unknown', f'发送频率受限，需等待 {e.seconds} 秒'
             except ChatWriteForbiddenError as e:
                 return 'frozen', f'无法发送消息:  {str(e)}'
             except UserBannedInChannelError as e:
@@ -339,10 +821,13 @@ class AccountDetector:
                 
                 return 'frozen', f'无法发送消息: {str(send_err)}'
         
+        except ProxyConnectError:
+            raise
         except asyncio.TimeoutError:
+            events.append('timeout')
             return 'unknown', '连接超时'
         except UserDeactivatedError as e: 
-            return 'frozen', f'账号已冻结: {str(e)}'
+            return 'banned', f'账号已停用: {str(e)}'
         except UserDeactivatedBanError as e:
             return 'banned', f'账号已封禁: {str(e)}'
         except AuthKeyUnregisteredError as e:
@@ -356,7 +841,8 @@ class AccountDetector:
             # 断开连接
             if client: 
                 try:
-                    await asyncio.wait_for(client.disconnect(), timeout=3)
+                    with stage('disconnect'):
+                        await asyncio.wait_for(client.disconnect(), timeout=3)
                 except:
                     pass
             
@@ -368,23 +854,230 @@ class AccountDetector:
                     pass
 
 
+# ================================ 共享事件循环 ================================
+
+class DetectionLoop:
+    """检测专用的常驻事件循环
+
+    所有批量检测共用同一个循环线程，检测任务以协程方式并发执行，
+    不再为每个账号单独创建线程和事件循环
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _run(self, ready):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            try:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            except:
+                pass
+            loop.close()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        """获取（必要时启动）事件循环"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                ready = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(ready,), name='account-detector-loop', daemon=True)
+                self._thread.start()
+                ready.wait()
+            return self._loop
+
+    def submit(self, coro) -> Future:
+        """把协程提交到检测循环，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+
+
+detection_loop = DetectionLoop()
+
+
+# ================================ 自适应并发 ================================
+
+class AdaptiveLimiter:
+    """
+    AIMD 并发控制（加性增、乘性减）
+    
+    检测顺利且耗时在目标内时逐步放大并发（慢启动阶段每个成功 +1，之后每轮 +1）；
+    出现超时、FloodWait、代理连接失败时并发减半，同一检测耗时内只减一次，避免一批超时把并发压到底。
+    只在检测事件循环中使用。
+    """
+    
+    def __init__(self, initial: int = 10, minimum: int = 1, maximum: int = 100,
+                 latency_target: float = 10.0, decrease_factor: float = 0.5):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.threshold = float(self.maximum)  # 慢启动阈值
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self._last_decrease = 0
+        self._condition = None
+        self._loop = None
+    
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_event_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+    
+    def set_maximum(self, maximum: int):
+        """调整上限（例如代理池容量变化），当前并发超出时收缩到上限"""
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.limit, self.maximum)
+        self.threshold = min(self.threshold, self.maximum)
+    
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            while self.in_flight >= int(self.limit):
+                await condition.wait()
+            self.in_flight += 1
+    
+    async def release(self, congested: bool, latency: float = None):
+        """
+        归还名额并根据本次检测结果调整并发
+        
+        Args:
+            congested: 检测中出现了超时、FloodWait 或代理连接失败
+            latency: 本次检测耗时（秒）
+        """
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if congested:
+                if now - self._last_decrease >= self.latency_target:
+                    self.threshold = max(self.minimum, self.limit * self.decrease_factor)
+                    self.limit = self.threshold
+                    self._last_decrease = now
+                    self.decreases += 1
+                    logging.info(f"📉 检测并发下调至 {int(self.limit)}")
+            elif latency is None or latency <= self.latency_target:
+                step = 1.0 if self.limit < self.threshold else 1.0 / self.limit
+                self.limit = min(self.maximum, self.limit + step)
+                self.increases += 1
+            condition.notify_all()
+    
+    def stats(self) -> Dict:
+        return {
+            'limit': int(self.limit),
+            'maximum': self.maximum,
+            'in_flight': self.in_flight,
+            'increases': self.increases,
+            'decreases': self.decreases
+        }
+
+
+# ================================ 批量检测 ================================
+
 class BatchDetector:
     """批量检测器"""
     
-    def __init__(self, api_id: int, api_hash: str, proxy_file: str = 'proxy.txt', max_workers: int = 30):
+    def __init__(self, api_id: int, api_hash: str, proxy_file: str = 'proxy.txt', max_workers: int = 30,
+                 account_timeout: float = 30, initial_workers: int = None, latency_target: float = None):
+        """
+        Args:
+            max_workers: 同时进行的检测数量上限（协程并发，不再对应线程数）
+            account_timeout: 单个账号的检测超时（秒）
+            initial_workers: 起始并发，默认 min(10, max_workers)，之后按检测情况自适应调整
+            latency_target: 单个账号检测的目标耗时（秒），默认 account_timeout 的三分之一
+        """
         self.api_id = api_id
         self.api_hash = api_hash
-        self.proxy_manager = ProxyManager(proxy_file)
+        self.proxy_manager = get_proxy_manager(proxy_file)
         self.max_workers = max_workers
+        self.account_timeout = account_timeout
         self.detector = AccountDetector(api_id, api_hash, self.proxy_manager)
+        # 同一个检测器的多次批量检测共用并发状态
+        self.limiter = AdaptiveLimiter(
+            initial=initial_workers or min(10, max_workers),
+            maximum=max_workers,
+            latency_target=latency_target or account_timeout / 3
+        )
+    
+    def _concurrency_cap(self) -> int:
+        """并发上限：max_workers 与代理池容量（代理数 × 单代理上限）取小"""
+        capacity = self.proxy_manager.capacity()
+        return max(1, min(self.max_workers, capacity) if capacity else self.max_workers)
     
-    def detect_accounts(self, accounts: List[Dict], progress_callback=None) -> Dict:
+    async def _detect_one(self, account: Dict, metrics: 'DetectionMetrics' = None) -> Tuple[Dict, str, str, str]:
+        """在自适应并发上限内检测单个账号 - 带超时保护
+
+        Args:
+            metrics: 本批次的阶段耗时统计，各阶段耗时同时计入进程内的 detection_metrics
         """
-        并发检测多个账号
+        proxy = None
+        events = []
+        timings = []
+        await self.limiter.acquire()
+        started = time.monotonic()
+        try:
+            # 单个账号最多 account_timeout 秒
+            status, message, proxy = await asyncio.wait_for(
+                self.detector.check_account_detail(account['session'], account['json'], events=events, timings=timings),
+                timeout=self.account_timeout
+            )
+        except asyncio.TimeoutError:
+            logging.warning(f"⏱️ 检测超时:  {account['session']}")
+            events.append('timeout')
+            status, message = 'unknown', f'检测超时({self.account_timeout:g}秒)'
+        except Exception as e:
+            logging.error(f"❌ 检测异常: {e}")
+            status, message = 'unknown', f'检测异常: {str(e)}'
+        finally:
+            elapsed = time.monotonic() - started
+            await self.limiter.release(bool(events), elapsed)
+            # 整个账号的检测耗时（不含排队），结果为超时或检测出的状态
+            timings.append(('total', elapsed, 'timeout' if 'timeout' in events else 'ok', None, None))
+            detection_metrics.record(timings)
+            if metrics is not None:
+                metrics.record(timings)
+        return account, status, message, proxy
+    
+    async def iter_detect(self, accounts: List[Dict], metrics: 'DetectionMetrics' = None):
+        """
+        并发检测多个账号，按完成顺序逐个产出结果（必须在事件循环中使用）
+        
+        Args:
+            metrics: 传入时记录本批次的阶段耗时
+        
+        Yields:
+            (account, status, message, proxy)
+        """
+        self.limiter.set_maximum(self._concurrency_cap())
+        tasks = [asyncio.ensure_future(self._detect_one(account, metrics)) for account in accounts]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # 调用方提前结束迭代时取消剩余检测
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def detect_accounts(self, accounts: List[Dict], progress_callback=None, result_callback=None) -> Dict:
+        """
+        并发检测多个账号（同步接口，检测在共享事件循环中执行）
         
         Args:
             accounts: [{'phone': '+86xxx', 'session': 'path/to/session', 'json': 'path/to/json'}, ...]
-            progress_callback: 进度回调函数 (current, total, results)
+                      其他字段原样带入检测结果
+            progress_callback: 进度回调函数 (current, total, results)，在调用方线程中执行
+            result_callback: 每出一个结果调用一次 (status, result_item)，在调用方线程中执行，
+                             可用于检测未结束时就开始处理存活账号
         
         Returns: 
             {
@@ -404,64 +1097,68 @@ class BatchDetector:
         total = len(accounts)
         current = 0
         
-        logging.info(f"🚀 开始批量检测 {total} 个账号，并发数: {self.max_workers}")
-        logging.info(f"📊 代理池大小: {len(self.proxy_manager.proxies)}")
+        logging.info(f"🚀 开始批量检测 {total} 个账号，并发: 当前 {int(self.limiter.limit)} / 上限 {self._concurrency_cap()}")
+        logging.info(f"📊 代理池大小: {len(self.proxy_manager.proxies)} ({self.proxy_manager.summary()})")
         
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_account = {}
-            for account in accounts:
-                future = executor.submit(
-                    self._detect_sync,
-                    account['session'],
-                    account['json']
-                )
-                future_to_account[future] = account
+        # 检测结果经队列回到调用方线程，进度回调（编辑 Telegram 消息）不会阻塞事件循环
+        done_queue = queue.Queue()
+        reported = set()
+        batch_metrics = DetectionMetrics()
+        
+        async def produce():
+            async for item in self.iter_detect(accounts, batch_metrics):
+                done_queue.put(item)
+        
+        future = detection_loop.submit(produce())
+        
+        while current < total:
+            try:
+                account, status, message, proxy = done_queue.get(timeout=1)
+            except queue.Empty:
+                if future.done():
+                    # 检测协程异常结束，剩余账号记为未知
+                    error = future.exception()
+                    logging.error(f"❌ 批量检测中断: {error}")
+                    break
+                continue
             
-            for future in as_completed(future_to_account):
-                account = future_to_account[future]
-                current += 1
-                
+            current += 1
+            reported.add(id(account))
+            
+            # 保留调用方附带的字段（db_id、nowuid、files 等）
+            result_item = dict(account)
+            result_item['message'] = message
+            result_item['proxy'] = proxy
+            results.get(status, results['unknown']).append(result_item)
+            
+            status_emoji = {
+                'normal': '✅',
+                'banned':  '❌',
+                'frozen':  '⚠️',
+                'unknown': '❓'
+            }.get(status, '❓')
+            
+            logging.info(f"[{current}/{total}] {status_emoji} {account['phone']}: {status}")
+            
+            if result_callback:
                 try:
-                    status, message = future.result(timeout=60)
-                    
-                    result_item = {
-                        'phone': account['phone'],
-                        'session': account['session'],
-                        'json': account['json'],
-                        'message': message
-                    }
-                    if 'db_id' in account:
-                        result_item['db_id'] = account['db_id']
-                    
-                    results[status].append(result_item)
-                    
-                    status_emoji = {
-                        'normal': '✅',
-                        'banned':  '❌',
-                        'frozen':  '⚠️',
-                        'unknown': '❓'
-                    }.get(status, '❓')
-                    
-                    logging.info(f"[{current}/{total}] {status_emoji} {account['phone']}: {status}")
-                    
+                    result_callback(status if status in results else 'unknown', result_item)
                 except Exception as e:
-                    logging.error(f"❌ 检测失败 [{current}/{total}] {account['phone']}: {e}")
-                    result_item = {
-                        'phone': account['phone'],
-                        'session': account['session'],
-                        'json': account['json'],
-                        'message':  str(e)
-                    }
-                    if 'db_id' in account:
-                        result_item['db_id'] = account['db_id']
+                    logging.error(f"❌ 检测结果回调失败: {e}")
+            
+            # 进度回调
+            if progress_callback:
+                try:
+                    progress_callback(current, total, results)
+                except: 
+                    pass
+        
+        if current < total:
+            for account in accounts:
+                if id(account) not in reported:
+                    result_item = dict(account)
+                    result_item['message'] = '检测中断'
                     results['unknown'].append(result_item)
-                
-                # 进度回调
-                if progress_callback:
-                    try:
-                        progress_callback(current, total, results)
-                    except: 
-                        pass
         
         logging.info(f"{'='*60}")
         logging.info(f"📊 批量检测完成！总计:  {total} 个账号")
@@ -469,43 +1166,14 @@ class BatchDetector:
         logging.info(f"❌ 封禁: {len(results['banned'])} 个 (无法连接)")
         logging.info(f"⚠️ 冻结: {len(results['frozen'])} 个 (能连接但无法发消息)")
         logging.info(f"❓ 未知: {len(results['unknown'])} 个")
+        logging.info(f"⚙️ 检测并发: {self.limiter.stats()}")
+        if self.proxy_manager.proxies:
+            logging.info(f"🌐 代理池: {self.proxy_manager.summary()}")
+        for line in batch_metrics.summary_lines():
+            logging.info(f"⏱️ {line}")
         logging.info(f"{'='*60}")
         
         return results
-    
-    def _detect_sync(self, session_file: str, json_file: str) -> Tuple[str, str]:
-        """同步包装的异步检测方法 - 带超时保护"""
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            # 单个账号最多30秒超时
-            return loop.run_until_complete(
-                asyncio.wait_for(
-                    self.detector.check_account(session_file, json_file),
-                    timeout=30
-                )
-            )
-        except asyncio.TimeoutError:
-            logging.warning(f"⏱️ 检测超时:  {session_file}")
-            return 'unknown', '检测超时(30秒)'
-        except Exception as e:
-            logging.error(f"❌ 检测异常: {e}")
-            return 'unknown', f'检测异常: {str(e)}'
-        finally:
-            try:
-                pending = asyncio.all_tasks(loop)
-                for task in pending: 
-                    task.cancel()
-                if pending:
-                    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
-                loop.run_until_complete(loop.shutdown_asyncgens())
-            except:
-                pass
-            try:
-                loop.close()
-            except:
-                pass
-            asyncio.set_event_loop(None)
 
 
 if __name__ == '__main__':
@@ -7,22 +7,21 @@ import os
 import sys
 import logging
 import threading
-import zipfile
 import time
 import re
+import html
 import qrcode
 import pickle
-import shutil
 from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ForceReply, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, CallbackContext
 
 # opentele (for TData format support)
 try:
-    from opentele.tl import TelegramClient as OpenTeleClient
-    from opentele.api import API, UseCurrentSession
+    from opentele.api import API
     TGCONVERTOR_AVAILABLE = True
 except ImportError:
     TGCONVERTOR_AVAILABLE = False
@@ -45,6 +44,13 @@ except ImportError:
                 })()
         translator = MockTranslate()
         Translate = MockTranslate
+
+# 加载环境变量 - 只加载代理Bot目录下的配置文件（不读取父目录）
+agent_dir = os.path.dirname(os.path.abspath(__file__))
+load_dotenv(os.path.join(agent_dir, '.env.agent'), override=True)
+load_dotenv(os.path.join(agent_dir, '.env'), override=True)
+# 不调用 load_dotenv() 避免读取父目录的 .env；需在导入 mongo 之前加载，库存/存储目录等配置才对 mongo.Config 生效
+
 # 添加项目根目录到路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -64,6 +70,19 @@ from mongo import (
     update_agent_bot_user_balance,
     get_agent_stats,
     get_real_time_stock,
+    get_stock_map,
+    get_catalog,
+    reserve_stock,
+    commit_reservation,
+    release_reservation,
+    quarantine_reserved,
+    STOCK_STATE_QUARANTINED,
+    HEALTHY_STOCK_FILTER,
+    release_quarantined,
+    release_expired_reservations,
+    record_sale,
+    is_health_fresh,
+    record_account_health,
     hb,
     ejfl,
     fenlei,
@@ -72,17 +91,16 @@ from mongo import (
     get_beijing_now,
     standard_num,
     sftw,
-    sifatuwen
+    sifatuwen,
+    TDATA_WARM_INTERVAL
 )
-
-
-
-
-# 加载环境变量 - 只加载代理Bot目录下的配置文件（不读取父目录）
-agent_dir = os.path.dirname(os.path.abspath(__file__))
-load_dotenv(os.path.join(agent_dir, '.env.agent'), override=True)
-load_dotenv(os.path.join(agent_dir, '.env'), override=True)
-# 不调用 load_dotenv() 避免读取父目录的 .env
+from product_search import search_products, resolve_dial_code
+from account_pack import order_zip_artifact, directory_zip_artifact, discard_account_blobs
+from delivery import (
+    JobContext, enqueue_delivery_job, mark_delivery_packaged, start_delivery_workers, send_cached_document,
+    set_delivery_progress, add_delivered_count
+)
+from tdata_cache import tdata_order_artifact, warm_popular_tdata, start_tdata_converter
 
 # 导入支付系统
 try:
@@ -94,7 +112,8 @@ except ImportError as e:
 
 # 导入账号检测系统
 try:
-    from account_detector import BatchDetector
+    from account_detector import BatchDetector, detection_metrics
+    from health_sweeper import detection_account, start_health_sweeper, sweeper_paused, recheck_quarantined
     ACCOUNT_DETECTOR_AVAILABLE = True
 except ImportError as e:
     logging.warning(f"⚠️ 账号检测系统导入失败: {e}")
@@ -129,12 +148,26 @@ AGENT_ORDER_NOTIFY_GROUP = os.getenv('AGENT_ORDER_NOTIFY_GROUP', '')
 # 文件路径配置
 BASE_PROTOCOL_PATH = os.getenv('BASE_PROTOCOL_PATH', '/www/haopubot/haopu-main/协议号')
 FALLBACK_PROTOCOL_PATH = os.getenv('FALLBACK_PROTOCOL_PATH', './协议号')
+# 查找账号文件的顺序：总部目录优先，其次本地目录
+PROTOCOL_ROOTS = [BASE_PROTOCOL_PATH, FALLBACK_PROTOCOL_PATH]
 
 # 账号检测配置
 API_ID = int(os.getenv('API_ID', '0'))
 API_HASH = os.getenv('API_HASH', '')
 BAD_ACCOUNT_GROUP_ID = os.getenv('BAD_ACCOUNT_GROUP_ID', '')
 ENABLE_ACCOUNT_DETECTION = os.getenv('ENABLE_ACCOUNT_DETECTION', 'true').lower() == 'true'
+DETECT_CONCURRENCY = int(os.getenv('DETECT_CONCURRENCY', '100'))  # 同时检测的账号数上限（自适应调整，不占线程）
+# 库存巡检：空闲时预先检测在售协议号，封禁/冻结的账号隔离下架
+ENABLE_HEALTH_SWEEPER = os.getenv('ENABLE_HEALTH_SWEEPER', 'true').lower() == 'true'
+HEALTH_SWEEP_RATE = int(os.getenv('HEALTH_SWEEP_RATE', '60'))  # 每分钟最多检测的账号数
+HEALTH_SWEEP_BATCH = int(os.getenv('HEALTH_SWEEP_BATCH', '20'))  # 每轮认领的账号数
+HEALTH_SWEEP_CONCURRENCY = int(os.getenv('HEALTH_SWEEP_CONCURRENCY', '10'))  # 每轮同时检测的账号数
+HEALTH_SWEEP_MAX_AGE = int(os.getenv('HEALTH_SWEEP_MAX_AGE', '21600'))  # 上次检测超过该秒数的账号重新巡检
+# 边检测边发货：每检测出该数量的存活账号就打包发送一批，0 表示检测完成后一次性发送
+DETECT_DELIVERY_CHUNK = int(os.getenv('DETECT_DELIVERY_CHUNK', '50'))
+# 自动补号：检测出的坏号从同一商品库存中补足，补不足的部分再退款；轮数为 0 时不补号直接退款
+DETECT_REPLACE_ROUNDS = int(os.getenv('DETECT_REPLACE_ROUNDS', '3'))  # 每个订单最多补号轮数
+DETECT_REPLACE_BATCH = int(os.getenv('DETECT_REPLACE_BATCH', '20'))  # 每轮最多补检的账号数（即补号检测的并发上限）
 
 # 日志配置
 os.makedirs('logs', exist_ok=True)
@@ -551,64 +584,6 @@ def send_media_message(context, chat_id, media_url, caption, parse_mode, reply_m
         )
 
 
-# ===================== 国家/区号映射表 =====================
-
-COUNTRY_MAP = {
-    "英国": "+44",
-    "美国": "+1",
-    "日本": "+81",
-    "韩国": "+82",
-    "中国": "+86",
-    "香港": "+852",
-    "台湾": "+886",
-    "新加坡": "+65",
-    "马来西亚": "+60",
-    "泰国": "+66",
-    "越南": "+84",
-    "印度": "+91",
-    "印尼": "+62",
-    "菲律宾": "+63",
-    "澳大利亚": "+61",
-    "加拿大": "+1",
-    "法国": "+33",
-    "德国": "+49",
-    "意大利": "+39",
-    "西班牙": "+34",
-    "俄罗斯": "+7",
-    "巴西": "+55",
-    "墨西哥": "+52",
-    "阿根廷": "+54",
-    "土耳其": "+90",
-    "沙特": "+966",
-    "阿联酋": "+971",
-    "埃及": "+20",
-    "南非": "+27",
-    "尼日利亚": "+234",
-    "波兰": "+48",
-    "荷兰": "+31",
-    "比利时": "+32",
-    "瑞士": "+41",
-    "奥地利": "+43",
-    "瑞典": "+46",
-    "挪威": "+47",
-    "丹麦": "+45",
-    "芬兰": "+358",
-    "葡萄牙": "+351",
-    "希腊": "+30",
-    "捷克": "+420",
-    "匈牙利": "+36",
-    "罗马尼亚": "+40",
-    "乌克兰": "+380",
-    "以色列": "+972",
-    "巴基斯坦": "+92",
-    "孟加拉": "+880",
-    "缅甸": "+95",
-    "柬埔寨": "+855",
-    "老挝": "+856",
-    "新西兰": "+64",
-}
-
-
 # ===================== 主要功能处理器 =====================
 
 
@@ -618,7 +593,8 @@ def show_product_detail_from_start(update: Update, context: CallbackContext, use
     用于处理 /start buy_{nowuid} 参数
     """
     # 获取商品信息
-    product = ejfl.find_one({'nowuid': nowuid})
+    catalog = get_catalog()
+    product = catalog.product(nowuid)
     if not product:
         update.message.reply_text("❌ 商品不存在或已下架")
         return
@@ -634,7 +610,7 @@ def show_product_detail_from_start(update: Update, context: CallbackContext, use
     
     # 获取分类
     uid = product.get('uid')
-    category = fenlei.find_one({'uid': uid})
+    category = catalog.category(uid)
     category_name = category.get('projectname', '未知分类') if category else '未知分类'
     
     text = f"""
@@ -811,7 +787,8 @@ def show_product_list(update:  Update, context: CallbackContext):
     lang = agent_user.get('lang', 'zh') if agent_user else 'zh'
     
     # 获取所有一级分类
-    categories = list(fenlei.find({}).sort('row', 1))
+    catalog = get_catalog()
+    categories = catalog.categories
     
     if not categories:
         query.edit_message_text(t("暂无商品分类", lang))
@@ -830,16 +807,19 @@ def show_product_list(update:  Update, context: CallbackContext):
 
 ❗ Long unused accounts may have issues, contact support"""
     
+    # 一次性读取库存计数器
+    stock_map = get_stock_map()
+    
     keyboard = []
     for category in categories: 
         uid = category.get('uid')
         category_name = category.get('projectname', '未知分类')
         
         # 获取该分类下的所有商品
-        products = list(ejfl.find({'uid': uid}))
+        products = catalog.category_products(uid)
         
         # 统计该分类下所有商品的总库存数量
-        total_stock = sum(get_real_time_stock(product.get('nowuid')) for product in products if product.get('nowuid'))
+        total_stock = sum(stock_map.get(product.get('nowuid'), 0) for product in products if product.get('nowuid'))
         
         if total_stock > 0:
             # 翻译分类名称
@@ -881,7 +861,8 @@ def show_category_products(update: Update, context: CallbackContext):
     category_uid = query.data.replace("category_", "")
     
     # 获取分类信息
-    category = fenlei.find_one({'uid': category_uid})
+    catalog = get_catalog()
+    category = catalog.category(category_uid)
     if not category:
         query.edit_message_text(t("分类不存在", lang))
         return
@@ -890,7 +871,7 @@ def show_category_products(update: Update, context: CallbackContext):
     display_category = t(category_name, lang) if lang != 'zh' else category_name
     
     # 获取该分类下的所有商品
-    products = list(ejfl.find({'uid': category_uid}).sort('row', 1))
+    products = catalog.category_products(category_uid)
     
     if not products:
         msg = f"{display_category} 暂无商品" if lang == 'zh' else f"No products in {display_category}"
@@ -910,6 +891,8 @@ def show_category_products(update: Update, context: CallbackContext):
 
 ❗️Please check account immediately after purchase.Provide proof for after-sales.Timeout at your own risk!"""
     
+    stock_map = get_stock_map([product.get('nowuid') for product in products])
+    
     keyboard = []
     for product in products:
         nowuid = product.get('nowuid')
@@ -920,7 +903,7 @@ def show_category_products(update: Update, context: CallbackContext):
         agent_price = hq_price * (1 + COMMISSION_RATE)
         
         # 获取库存
-        stock = get_real_time_stock(nowuid)
+        stock = stock_map.get(nowuid, 0)
         
         # 显示商品
         if stock > 0:
@@ -956,7 +939,8 @@ def show_product_detail(update: Update, context:  CallbackContext):
     nowuid = query.data.replace("product_", "")
     
     # 获取商品信息
-    product = ejfl.find_one({'nowuid': nowuid})
+    catalog = get_catalog()
+    product = catalog.product(nowuid)
     if not product:
         query.edit_message_text(t("商品不存在", lang))
         return
@@ -973,7 +957,7 @@ def show_product_detail(update: Update, context:  CallbackContext):
     
     # 获取分类
     uid = product.get('uid')
-    category = fenlei.find_one({'uid': uid})
+    category = catalog.category(uid)
     category_name = category.get('projectname', '未知分类') if category else '未知分类'
     
     # 翻译商品名
@@ -1055,7 +1039,7 @@ def buy_product(update:  Update, context: CallbackContext):
     nowuid = query.data.replace("buy_", "")
     
     # 获取商品信息
-    product = ejfl.find_one({'nowuid': nowuid})
+    product = get_catalog().product(nowuid)
     if not product:
         query.answer(t("商品不存在", 'zh'), show_alert=True)
         return
@@ -1127,7 +1111,7 @@ def show_usage_instruction(update:  Update, context: CallbackContext):
     nowuid = query.data.replace("usage_", "")
     
     # 获取商品信息
-    product = ejfl.find_one({'nowuid': nowuid})
+    product = get_catalog().product(nowuid)
     if not product:
         msg = "Product not found" if lang != 'zh' else "商品不存在"
         query.answer(msg, show_alert=True)
@@ -1443,23 +1427,17 @@ Total: {total_price} USDT
     )
 
 
-def send_account_files(context: CallbackContext, user_id: int, nowuid: str, quantity: int):
-    """打包并发送账号文件"""
+def send_account_files(context: CallbackContext, user_id: int, nowuid: str, quantity: int, order_id: str = None):
+    """打包并发送账号文件（传入 order_id 时在订单上保存 file_id，供重新下载复用）"""
     # 获取用户语言
     lang = get_user_lang(user_id)
     
-    # 从数据库获取指定数量的账号
-    query_condition = {"nowuid":  nowuid, "state": 0}
-    pipeline = [
-        {"$match": query_condition},
-        {"$limit": quantity}
-    ]
-    
-    cursor = hb.aggregate(pipeline)
-    accounts = list(cursor)
+    # 原子预留指定数量的账号
+    reserve_token, accounts = reserve_stock(nowuid, quantity, owner_id=user_id)
     
     if len(accounts) < quantity:
         logging.error(f"库存不足: 需要{quantity}个，实际只有{len(accounts)}个")
+        release_reservation(nowuid, reserve_token)
         msg = "❌ Out of stock, purchase failed" if lang != 'zh' else "❌ 库存不足，购买失败"
         context.bot.send_message(
             chat_id=user_id,
@@ -1470,31 +1448,12 @@ def send_account_files(context: CallbackContext, user_id: int, nowuid: str, quan
     # 获取账号文件名
     folder_names = [doc['projectname'] for doc in accounts]
     
-    # 创建zip文件
+    # 打包文件（内存缓冲，不落发货目录）
     timestamp = int(time.time())
-    zip_filename = f"./协议号发货/{user_id}_{timestamp}.zip"
-    
-    # 确保目录存在
-    os.makedirs('./协议号发货', exist_ok=True)
-    
-    # 打包文件
+    artifact = None
     try:
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file_name in folder_names:
-                # 从总部账号目录读取
-                json_file = os.path.join(BASE_PROTOCOL_PATH, nowuid, file_name + ".json")
-                session_file = os.path.join(BASE_PROTOCOL_PATH, nowuid, file_name + ".session")
-                
-                # 如果总部路径不存在，尝试本地路径
-                if not os.path.exists(json_file):
-                    json_file = os.path.join(FALLBACK_PROTOCOL_PATH, nowuid, file_name + ".json")
-                if not os.path.exists(session_file):
-                    session_file = os.path.join(FALLBACK_PROTOCOL_PATH, nowuid, file_name + ".session")
-                
-                if os.path.exists(json_file):
-                    zipf.write(json_file, os.path.basename(json_file))
-                if os.path.exists(session_file):
-                    zipf.write(session_file, os.path.basename(session_file))
+        # 优先使用总部账号目录的预打包分片，其次本地目录
+        artifact = order_zip_artifact('协议号', PROTOCOL_ROOTS, nowuid, folder_names, f"{user_id}_{timestamp}.zip")
         
         # 发送成功消息
         if lang == 'zh':
@@ -1533,20 +1492,13 @@ def send_account_files(context: CallbackContext, user_id: int, nowuid: str, quan
         )
         
         # 发送文件
-        with open(zip_filename, "rb") as f:
-            context.bot.send_document(chat_id=user_id, document=f)
+        message = context.bot.send_document(chat_id=user_id, document=artifact.open(), filename=artifact.filename)
+        if order_id:
+            agent_orders.update_one({'order_id': order_id}, {'$set': {'file_id': message.document.file_id}})
         
         # 标记账号为已售出
-        timer = beijing_now_str()
-        document_ids = [doc['_id'] for doc in accounts]
-        update_data = {"$set":  {'state': 1, 'yssj': timer, 'gmid': user_id}}
-        hb.update_many({"_id": {"$in":  document_ids}}, update_data)
-        
-        # 清理临时文件
-        try:
-            os.remove(zip_filename)
-        except Exception as e:
-            logging.warning(f"清理临时文件失败: {e}")
+        commit_reservation(nowuid, reserve_token, user_id, beijing_now_str())
+        add_delivered_count(order_id, len(accounts))
         
         return True
         
@@ -1554,30 +1506,195 @@ def send_account_files(context: CallbackContext, user_id: int, nowuid: str, quan
         logging.error(f"打包发送文件失败: {e}")
         import traceback
         traceback.print_exc()
+        release_reservation(nowuid, reserve_token)
         msg = "❌ Failed to package files, please contact support" if lang != 'zh' else "❌ 打包文件失败，请联系客服"
         context.bot.send_message(
             chat_id=user_id,
             text=msg
         )
         return False
+    finally:
+        if artifact:
+            artifact.close()
 
 
-def pack_accounts_to_session_zip(zipf: zipfile.ZipFile, accounts: list):
+def pack_accounts_to_session_zip(nowuid: str, accounts: list, filename: str):
     """
     Helper function to pack accounts in Session + JSON format
     
     Args:
-        zipf: ZipFile object to write to
-        accounts: List of account dictionaries with 'session' and 'json' keys
+        nowuid: Product ID the accounts belong to
+        accounts: List of account dictionaries with 'phone' (account file name) keys
+        filename: File name shown to the receiver
+    
+    Returns:
+        DeliveryArtifact: In-memory zip, caller must close it
     """
-    for account in accounts:
-        session_file = account['session'] + '.session'
-        json_file = account['json']
+    return order_zip_artifact('协议号', PROTOCOL_ROOTS, nowuid, [account['phone'] for account in accounts], filename)
+
+
+# 购买检测共用一个批量检测器，自适应并发在订单之间延续
+_purchase_detector = None
+_purchase_detector_lock = threading.Lock()
+
+
+def get_purchase_detector():
+    global _purchase_detector
+    with _purchase_detector_lock:
+        if _purchase_detector is None:
+            _purchase_detector = BatchDetector(API_ID, API_HASH, max_workers=DETECT_CONCURRENCY)
+        return _purchase_detector
+
+
+class ProgressiveDelivery:
+    """边检测边发货
+
+    检测结果逐个传入 add()，存活账号每满 chunk_size 个就在后台线程打包发送一批并立即标记已售出，
+    用户不必等整单检测结束；finish() 发送剩余账号。
+    批次按顺序发送（单线程），打包和上传不阻塞检测结果的处理。
+    """
+
+    def __init__(self, context: CallbackContext, user_id: int, nowuid: str, order_id: str, reserve_token: str,
+                 delivery_format: str, lang: str, chunk_size: int = 0):
+        self.bot = context.bot
+        self.user_id = user_id
+        self.order_id = order_id
+        self.nowuid = nowuid
+        self.reserve_token = reserve_token
+        self.tdata = delivery_format == 'tdata' and TGCONVERTOR_AVAILABLE
+        self.lang = lang
+        self.chunk_size = max(0, chunk_size)
+        self.pending = []
+        self.file_ids = []
+        self.delivered = 0  # 已发送并标记售出的账号数
+        self.parts = 0
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='progressive-delivery')
+
+    def add(self, account: dict):
+        self.pending.append(account)
+        if self.chunk_size and len(self.pending) >= self.chunk_size:
+            self._flush(final=False)
+
+    def _flush(self, final: bool):
+        if not self.pending:
+            return
+        chunk, self.pending = self.pending, []
+        self.parts += 1
+        self._futures.append(self._executor.submit(self._send_part, chunk, self.parts, final))
+
+    def _filename(self, count: int, index: int, final: bool) -> str:
+        suffix = '_tdata' if self.tdata else ''
+        if final and index == 1:
+            name = f"存活账号-{count}" if self.lang == 'zh' else f"normal_accounts-{count}"
+        else:
+            name = f"存活账号-第{index}批-{count}" if self.lang == 'zh' else f"normal_accounts-part{index}-{count}"
+        return f"{name}{suffix}.zip"
+
+    def _send_part(self, chunk: list, index: int, final: bool):
+        timestamp = int(time.time())
+        filename = f"{self.user_id}_{timestamp}_normal_{index}.zip"
+        if self.tdata:
+            artifact = tdata_order_artifact(chunk, filename, PROTOCOL_ROOTS)
+            logging.info(f"✅ TData打包完成: 第{index}批 {artifact.count}/{len(chunk)} 个账号")
+        else:
+            artifact = pack_accounts_to_session_zip(self.nowuid, chunk, filename)
+
+        if final:
+            caption = None if index == 1 else (
+                f"📦 第{index}批（最后一批）：{len(chunk)} 个存活账号" if self.lang == 'zh'
+                else f"📦 Part {index} (last): {len(chunk)} normal accounts"
+            )
+        else:
+            caption = (f"📦 第{index}批：{len(chunk)} 个存活账号，其余账号仍在检测中..." if self.lang == 'zh'
+                       else f"📦 Part {index}: {len(chunk)} normal accounts, the rest are still being checked...")
+
+        if index == 1:
+            mark_delivery_packaged(self.order_id)
+        with artifact:
+            message = self.bot.send_document(
+                chat_id=self.user_id,
+                document=artifact.open(),
+                filename=self._filename(len(chunk), index, final),
+                caption=caption
+            )
+        self.file_ids.append(message.document.file_id)
+
+        # 已送达的账号立即标记已售出，之后检测失败回退时不会重复发货
+        commit_reservation(self.nowuid, self.reserve_token, self.user_id, beijing_now_str(),
+                           ids=[account['db_id'] for account in chunk if account.get('db_id') is not None])
+        add_delivered_count(self.order_id, len(chunk))
+        self.delivered += len(chunk)
+        logging.info(f"📤 第{index}批存活账号已发送: user={self.user_id}, {len(chunk)} 个 (累计 {self.delivered})")
+
+    def close(self) -> int:
+        """等待已提交的批次发送完毕（不发送剩余账号），返回已发送的账号数"""
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            if future.exception():
+                logging.error(f"❌ 分批发货失败: {future.exception()}")
+        return self.delivered
+
+    def finish(self):
+        """发送剩余的存活账号并等待全部批次完成
+
+        发送失败的批次只记录日志，这些账号不标记售出（仍在预留中），delivered 只统计实际送达的账号。
+
+        Returns:
+            str: 只发送了一个文件时返回其 file_id（供重新下载复用），否则返回 None
+        """
+        self._flush(final=True)
+        self.close()
+        return self.file_ids[0] if len(self.file_ids) == 1 else None
+
+
+def detect_replacements(nowuid: str, user_id: int, reserve_token: str, shortage: int, result_callback=None) -> dict:
+    """
+    补号：从同一商品库存中预留替换账号并检测，直到补足、库存不足或达到轮数上限
+    
+    替换账号追加在订单的预留令牌下，存活账号随订单一起确认售出，坏号随订单一起隔离。
+    
+    Args:
+        shortage: 需要补足的账号数
+        result_callback: 同 BatchDetector.detect_accounts，近期检测存活（缓存）的替换账号也会回调
+    
+    Returns:
+        dict: 所有替换账号的检测结果 {'normal': [...], 'banned': [...], 'frozen': [...], 'unknown': [...]}
+    """
+    results = {'normal': [], 'banned': [], 'frozen': [], 'unknown': []}
+    for round_no in range(1, DETECT_REPLACE_ROUNDS + 1):
+        if shortage <= 0:
+            break
+        _, docs = reserve_stock(nowuid, min(shortage, DETECT_REPLACE_BATCH), owner_id=user_id,
+                                extra_filter=HEALTHY_STOCK_FILTER, sort=[('health.checked_at', -1)],
+                                token=reserve_token)
+        if not docs:
+            logging.info(f"🔁 补号结束：库存不足, 仍缺 {shortage} 个")
+            break
         
-        if os.path.exists(json_file):
-            zipf.write(json_file, os.path.basename(json_file))
-        if os.path.exists(session_file):
-            zipf.write(session_file, os.path.basename(session_file))
+        round_results = {'normal': [], 'banned': [], 'frozen': [], 'unknown': []}
+        detection_accounts = []
+        for doc in docs:
+            item = detection_account(doc, PROTOCOL_ROOTS)
+            if is_health_fresh(doc):
+                item.update(message='近期检测存活（缓存）', proxy=doc['health'].get('proxy'), health_cached=True)
+                round_results['normal'].append(item)
+                if result_callback:
+                    result_callback('normal', item)
+            else:
+                detection_accounts.append(item)
+        if detection_accounts:
+            detected = get_purchase_detector().detect_accounts(detection_accounts, result_callback=result_callback)
+            for status, items in detected.items():
+                round_results[status].extend(items)
+        record_account_health(nowuid, round_results)
+        
+        filled = len(round_results['normal']) + len(round_results['unknown'])
+        shortage -= filled
+        for status, items in round_results.items():
+            results[status].extend(items)
+        logging.info(f"🔁 第{round_no}轮补号: 预留 {len(docs)} 个, 补足 {filled} 个, 仍缺 {max(0, shortage)} 个")
+    return results
 
 
 def send_account_files_with_detection(context: CallbackContext, user_id: int, nowuid: str, quantity: int, 
@@ -1598,48 +1715,36 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
     # 检查是否启用检测
     if not ENABLE_ACCOUNT_DETECTION or not ACCOUNT_DETECTOR_AVAILABLE or not API_ID or not API_HASH:
         logging.warning("账号检测未启用或配置不完整，使用普通发货")
-        return send_account_files(context, user_id, nowuid, quantity), 0.0, {'normal': quantity, 'banned': 0, 'frozen': 0, 'unknown': 0}
+        return send_account_files(context, user_id, nowuid, quantity, order_id), 0.0, {'normal': quantity, 'banned': 0, 'frozen': 0, 'unknown': 0}
     
-    # 从数据库获取指定数量的账号
-    query_condition = {"nowuid": nowuid, "state": 0}
-    pipeline = [
-        {"$match": query_condition},
-        {"$limit": quantity}
-    ]
-    
-    cursor = hb.aggregate(pipeline)
-    accounts = list(cursor)
+    # 原子预留指定数量的账号，检测期间其他订单无法取到这些账号；优先取最近检测过的账号，减少需要登录检测的数量，
+    # 最近检测为坏号的账号不取（否则检测时间最新的坏号会被优先取到）
+    reserve_token, accounts = reserve_stock(nowuid, quantity, owner_id=user_id, extra_filter=HEALTHY_STOCK_FILTER,
+                                            sort=[('health.checked_at', -1)])
     
     if len(accounts) < quantity:
         logging.error(f"库存不足: 需要{quantity}个，实际只有{len(accounts)}个")
+        release_reservation(nowuid, reserve_token)
         msg = "❌ Out of stock, purchase failed" if lang != 'zh' else "❌ 库存不足，购买失败"
         context.bot.send_message(chat_id=user_id, text=msg)
         return False, 0.0, {'normal': 0, 'banned':  0, 'frozen': 0, 'unknown': 0}
+    # 记录预留令牌：本次发货中断后重试时先把未送达的预留退回库存
+    set_delivery_progress(order_id, reserve_token=reserve_token)
     
-    # 准备检测账号列表
+    # 准备检测账号列表（近期检测为存活的账号直接使用缓存结果，不再登录检测）
     detection_accounts = []
+    cached_normal = []
     for account in accounts:
-        file_name = account['projectname']
-        
-        # 查找session和json文件
-        json_file = os.path.join(BASE_PROTOCOL_PATH, nowuid, file_name + ".json")
-        session_file = os.path.join(BASE_PROTOCOL_PATH, nowuid, file_name + ".session")
-        
-        # 如果总部路径不存在，尝试本地路径
-        if not os.path.exists(json_file):
-            json_file = os.path.join(FALLBACK_PROTOCOL_PATH, nowuid, file_name + ".json")
-        if not os.path.exists(session_file):
-            session_file = os.path.join(FALLBACK_PROTOCOL_PATH, nowuid, file_name + ".session")
-        
-        detection_accounts.append({
-            'phone': file_name,
-            'session': session_file.replace('.session', ''),  # Telethon不需要.session后缀
-            'json': json_file,
-            'db_id': account['_id']
-        })
+        # 查找session和json文件（账号存储，旧库存依次查找总部路径和本地路径）
+        item = detection_account(account, PROTOCOL_ROOTS)
+        if is_health_fresh(account):
+            item.update(message='近期检测存活（缓存）', proxy=account['health'].get('proxy'), health_cached=True)
+            cached_normal.append(item)
+        else:
+            detection_accounts.append(item)
     
     # 发送检测开始消息
-    logging.info(f"🔍 开始账号质量检测: 用户={user_id}, 数量={quantity}")
+    logging.info(f"🔍 开始账号质量检测: 用户={user_id}, 数量={quantity}, 缓存跳过={len(cached_normal)}")
     
     if lang == 'zh':
         progress_text = """🔍 正在检测账号质量...
@@ -1673,6 +1778,12 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
         text=progress_text
     )
     
+    # 存活账号边检测边发货，缓存跳过的账号不必等待检测
+    delivery = ProgressiveDelivery(context, user_id, nowuid, order_id, reserve_token, delivery_format, lang,
+                                   chunk_size=DETECT_DELIVERY_CHUNK)
+    for item in cached_normal:
+        delivery.add(item)
+    
     # 进度回调函数
     last_progress_update = [0]  # 用列表存储，方便在闭包中修改
     
@@ -1736,18 +1847,60 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
     
     # 执行批量检测
     try:
-        logging.info(f"🚀 启动批量检测器: max_workers=30")
-        detector = BatchDetector(API_ID, API_HASH, max_workers=30)
-        results = detector.detect_accounts(detection_accounts, progress_callback=update_progress)
-        logging.info(f"✅ 批量检测完成")
+        if detection_accounts:
+            detector = get_purchase_detector()
+            # 进度按整单计算，缓存跳过的账号计入存活；检测期间暂停库存巡检
+            with sweeper_paused():
+                results = detector.detect_accounts(
+                    detection_accounts,
+                    progress_callback=lambda current, total, partial: update_progress(
+                        current + len(cached_normal), quantity,
+                        dict(partial, normal=cached_normal + partial['normal'])
+                    ),
+                    result_callback=lambda status, item: delivery.add(item) if status == 'normal' else None
+                )
+            logging.info(f"✅ 批量检测完成")
+        else:
+            results = {'normal': [], 'banned': [], 'frozen': [], 'unknown': []}
+        results['normal'] = cached_normal + results['normal']
+        record_account_health(nowuid, results)
     except Exception as e:
         logging.error(f"❌ 账号检测失败: {e}")
-        # 检测失败，回退到普通发货
+        # 检测失败，释放预留后回退到普通发货
         try:
             context.bot.delete_message(chat_id=user_id, message_id=progress_msg.message_id)
         except:
             pass
-        return send_account_files(context, user_id, nowuid, quantity), 0.0, {'normal': quantity, 'banned':  0, 'frozen': 0, 'unknown': 0}
+        # 已分批送达的账号不再重复发货，只补发剩余数量
+        delivered = delivery.close()
+        release_reservation(nowuid, reserve_token)
+        if delivered >= quantity:
+            return True, 0.0, {'normal': delivered, 'banned': 0, 'frozen': 0, 'unknown': 0}
+        if send_account_files(context, user_id, nowuid, quantity - delivered, order_id):
+            return True, 0.0, {'normal': quantity, 'banned': 0, 'frozen': 0, 'unknown': 0}
+        if delivered:
+            # 补发失败但已有部分送达：按实际送达数量结算，只退未送达的部分
+            refund_amount = (quantity - delivered) * agent_price
+            logging.warning(f"⚠️ 补发失败: 已送达 {delivered}/{quantity}, 退回 {refund_amount:.2f} USDT")
+            return True, refund_amount, {'normal': delivered, 'banned': 0, 'frozen': 0, 'unknown': 0}
+        return False, 0.0, {'normal': 0, 'banned': 0, 'frozen': 0, 'unknown': 0}
+    
+    # 坏号先从库存补号，补号失败或库存不足时剩余部分按坏号退款
+    replaced_count = 0
+    shortage = len(results['banned']) + len(results['frozen'])
+    if shortage and DETECT_REPLACE_ROUNDS > 0:
+        logging.info(f"🔁 开始补号: 需要 {shortage} 个")
+        try:
+            with sweeper_paused():
+                replacement = detect_replacements(
+                    nowuid, user_id, reserve_token, shortage,
+                    result_callback=lambda status, item: delivery.add(item) if status == 'normal' else None
+                )
+            for status, items in replacement.items():
+                results[status].extend(items)
+            replaced_count = len(replacement['normal']) + len(replacement['unknown'])
+        except Exception as e:
+            logging.error(f"❌ 补号失败: {e}")
     
     # 处理检测结果
     normal_count = len(results.get('normal', []))
@@ -1761,230 +1914,16 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
     logging.info(f"   ⚠️ 冻结: {frozen_count}")
     logging.info(f"   ❓ 未知: {unknown_count}")
     
-    # 计算退款金额
-    refund_count = banned_count + frozen_count
-    refund_amount = refund_count * agent_price
-    
-    logging.info(f"💰 退款计算: {refund_count} 个坏号 × {agent_price:.2f} = {refund_amount:.2f} USDT")
-    
-    # 创建存活账号zip
-    normal_zip_path = None
-    if normal_count > 0:
-        logging.info(f"📦 开始打包 {normal_count} 个存活账号 (格式: {delivery_format})")
-        timestamp = int(time.time())
-        normal_zip_path = f"./协议号发货/{user_id}_{timestamp}_normal.zip"
-        os.makedirs('./协议号发货', exist_ok=True)
-        
-        if delivery_format == 'tdata' and TGCONVERTOR_AVAILABLE:
-            logging.info(f"🔄 使用TData格式转换 (并发)")
-            
-            from concurrent.futures import ThreadPoolExecutor, as_completed
-            import threading
-            
-            # 单个账号转换函数
-            def convert_single_account(account, user_id, timestamp):
-                session_file = account['session'] + '.session'
-                json_file = account['json']
-                phone = account['phone']
-                folder_name = re.sub(r'[^\w\-]', '', phone.replace('+', ''))
-                
-                result = {
-                    'phone': phone,
-                    'folder_name': folder_name,
-                    'success':  False,
-                    'tdata_path': None,
-                    'session_file': session_file,
-                    'json_file':  json_file
-                }
-                
-                if not os.path.exists(session_file):
-                    logging.warning(f"⚠️ {phone} session文件不存在:  {session_file}")
-                    return result
-                
-                clean_session_base = None
-                temp_tdata_dir = None
-                
-                try:
-                    temp_tdata_dir = f"./协议号发货/temp_tdata_{user_id}_{timestamp}_{folder_name}_{threading.current_thread().ident}"
-                    os.makedirs(temp_tdata_dir, exist_ok=True)
-                    
-                    import sqlite3
-                    import shutil
-                    
-                    # 正确的文件路径处理
-                    # session_file = xxx.session
-                    # clean_session_base = xxx_clean_12345 (不带.session)
-                    # clean_session_path = xxx_clean_12345.session (带.session)
-                    clean_session_base = session_file.replace('.session', '') + f"_clean_{threading.current_thread().ident}"
-                    clean_session_path = clean_session_base + '.session'
-                    
-                    # 复制原始session到临时文件
-                    shutil.copy2(session_file, clean_session_path)
-                    
-                    # 清理多余的表
-                    try:
-                        conn = sqlite3.connect(clean_session_path)
-                        cursor = conn.cursor()
-                        expected_tables = {'sessions', 'entities', 'sent_files', 'update_state', 'version'}
-                        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-                        current_tables = {row[0] for row in cursor.fetchall()}
-                        for table in (current_tables - expected_tables):
-                            cursor.execute(f"DROP TABLE IF EXISTS {table}")
-                        conn.commit()
-                        conn.close()
-                    except Exception as db_err: 
-                        logging.warning(f"⚠️ {phone} 清理session表失败:  {db_err}")
-                    
-                    import asyncio
-                    
-                    async def do_convert():
-                        client = None
-                        try:
-                            # OpenTeleClient 会自动加 .session 后缀，所以传不带后缀的路径
-                            client = OpenTeleClient(clean_session_base)
-                            
-                            await asyncio.wait_for(client.connect(), timeout=15)
-                            
-                            is_auth = await asyncio.wait_for(client.is_user_authorized(), timeout=5)
-                            if not is_auth:
-                                logging.warning(f"⚠️ {phone} Session未授权，跳过转换")
-                                return None
-                            
-                            tdata_path = os.path.join(temp_tdata_dir, "tdata")
-                            tdesk = await client.ToTDesktop(flag=UseCurrentSession)
-                            tdesk.SaveTData(tdata_path)
-                            
-                            return tdata_path
-                        except Exception as e:
-                            logging.error(f"⚠️ {phone} 转换内部错误: {e}")
-                            return None
-                        finally:
-                            if client: 
-                                try:
-                                    await asyncio.wait_for(client.disconnect(), timeout=5)
-                                except:
-                                    pass
-                    
-                    try:
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        tdata_path = loop.run_until_complete(
-                            asyncio.wait_for(do_convert(), timeout=30)
-                        )
-                        if tdata_path:
-                            result['success'] = True
-                            result['tdata_path'] = tdata_path
-                            result['temp_dir'] = temp_tdata_dir
-                        else:
-                            logging.warning(f"⚠️ {phone} 转换返回空")
-                    except asyncio.TimeoutError:
-                        logging.error(f"转换 {phone} 超时(30秒)")
-                    except Exception as conv_err:
-                        logging.error(f"转换 {phone} 异步错误: {conv_err}")
-                    finally:
-                        try:
-                            pending = asyncio.all_tasks(loop)
-                            for task in pending: 
-                                task.cancel()
-                            if pending:
-                                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
-                            loop.run_until_complete(loop.shutdown_asyncgens())
-                        except:
-                            pass
-                        try:
-                            loop.close()
-                        except:
-                            pass
-                        asyncio.set_event_loop(None)
-                        
-                except Exception as e: 
-                    logging.error(f"转换 {phone} 失败: {e}")
-                
-                finally:
-                    # 清理临时session文件
-                    if clean_session_base:
-                        try:
-                            os.remove(clean_session_base + '.session')
-                        except:
-                            pass
-                
-                return result
-            
-            # 并发转换 (最多20个线程)
-            max_workers = min(20, normal_count)
-            converted_results = []
-            
-            logging.info(f"🚀 启动 {max_workers} 个转换线程")
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = {
-                    executor.submit(convert_single_account, acc, user_id, timestamp): acc 
-                    for acc in results['normal']
-                }
-                for idx, future in enumerate(as_completed(futures), 1):
-                    try:
-                        res = future.result(timeout=60)
-                        converted_results.append(res)
-                        if res['success']:
-                            logging.info(f"  [{idx}/{normal_count}] ✅ {res['phone']} 转换成功")
-                        else: 
-                            logging.warning(f"  [{idx}/{normal_count}] ❌ {res['phone']} 转换失败")
-                    except Exception as e:
-                        logging.error(f"  [{idx}/{normal_count}] ❌ 转换异常: {e}")
-            
-            # 打包成功转换的账号
-            logging.info(f"📦 开始打包...")
-            with zipfile.ZipFile(normal_zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                for res in converted_results: 
-                    if res['success'] and res['tdata_path']:
-                        folder_name = res['folder_name']
-                        tdata_path = res['tdata_path']
-                        session_file = res['session_file']
-                        json_file = res['json_file']
-                        
-                        # 添加 tdata 文件
-                        for root, dirs, files in os.walk(tdata_path):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                arcname = os.path.join(folder_name, "tdata", os.path.relpath(file_path, tdata_path))
-                                zipf.write(file_path, arcname)
-                        
-                        # 添加原始文件
-                        if os.path.exists(session_file):
-                            zipf.write(session_file, os.path.join(folder_name, os.path.basename(session_file)))
-                        if os.path.exists(json_file):
-                            zipf.write(json_file, os.path.join(folder_name, os.path.basename(json_file)))
-                        
-                        # 清理临时目录
-                        try:
-                            shutil.rmtree(res.get('temp_dir', ''), ignore_errors=True)
-                        except:
-                            pass
-            
-            logging.info(f"✅ TData并发转换完成")
-        else:
-            # Session 格式（默认）或 TGConvertor 不可用时回退
-            if delivery_format == 'tdata' and not TGCONVERTOR_AVAILABLE:
-                logging.warning("⚠️ TGConvertor 未安装，回退到 Session 格式")
-            else:
-                logging.info(f"📦 使用Session + JSON格式")
-            
-            with zipfile.ZipFile(normal_zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                pack_accounts_to_session_zip(zipf, results['normal'])
-        
-        logging.info(f"✅ 存活账号打包完成: {normal_zip_path}")
-    
     # 创建未知错误账号zip
-    unknown_zip_path = None
+    unknown_artifact = None
     if unknown_count > 0:
         logging.info(f"📦 开始打包 {unknown_count} 个未知错误账号")
         timestamp = int(time.time())
-        unknown_zip_path = f"./协议号发货/{user_id}_{timestamp}_unknown.zip"
-        os.makedirs('./协议号发货', exist_ok=True)
-        
-        with zipfile.ZipFile(unknown_zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            pack_accounts_to_session_zip(zipf, results['unknown'])
+        unknown_artifact = pack_accounts_to_session_zip(nowuid, results['unknown'], f"{user_id}_{timestamp}_unknown.zip")
         
-        logging.info(f"✅ 未知错误账号打包完成: {unknown_zip_path}")
+        logging.info(f"✅ 未知错误账号打包完成: {unknown_artifact.filename}")
+    
+    mark_delivery_packaged(order_id)
     
     # 发送坏号到群组并删除
     if (banned_count > 0 or frozen_count > 0) and BAD_ACCOUNT_GROUP_ID:
@@ -1993,27 +1932,21 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
             bad_accounts = results.get('banned', []) + results.get('frozen', [])
             
             # 创建坏号 zip 文件
-            timestamp = int(time.time())
-            bad_zip_path = f"./协议号发货/{user_id}_{timestamp}_bad.zip"
-            os.makedirs('./协议号发货', exist_ok=True)
-            
-            with zipfile.ZipFile(bad_zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                for account in bad_accounts:
-                    session_file = account['session'] + '.session'
-                    json_file = account['json']
-                    phone = account['phone']
-                    
-                    # 为每个账号创建安全的文件夹名称（移除所有特殊字符）
-                    folder_name = re.sub(r'[^\w\-]', '', phone.replace('+', ''))
-                    
-                    # 添加文件到对应文件夹
-                    if os.path.exists(json_file):
-                        zipf.write(json_file, f"{folder_name}/{os.path.basename(json_file)}")
-                    if os.path.exists(session_file):
-                        zipf.write(session_file, f"{folder_name}/{os.path.basename(session_file)}")
+            entries = []
+            for account in bad_accounts:
+                session_file = account['session'] + '.session'
+                json_file = account['json']
+                phone = account['phone']
+                
+                # 为每个账号创建安全的文件夹名称（移除所有特殊字符）
+                folder_name = re.sub(r'[^\w\-]', '', phone.replace('+', ''))
+                
+                # 添加文件到对应文件夹（账号存储中的文件名是哈希，压缩包内使用账号名）
+                entries.append((json_file, f"{folder_name}/{phone}.json"))
+                entries.append((session_file, f"{folder_name}/{phone}.session"))
             
             # 发送坏号 zip 到群组
-            if os.path.exists(bad_zip_path):
+            with directory_zip_artifact(entries, "坏号.zip") as bad_artifact:
                 try:
                     group_id = int(BAD_ACCOUNT_GROUP_ID)
                     
@@ -2030,43 +1963,76 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
 数量: {len(bad_accounts)} 个
 
 ❌ 封禁: {banned_count_in_list} 个
-⚠️ 冻结: {frozen_count_in_list} 个"""
+⚠️ 冻结: {frozen_count_in_list} 个
+🔁 已补号: {replaced_count} 个"""
                     
-                    with open(bad_zip_path, 'rb') as f:
-                        context.bot.send_document(
-                            chat_id=group_id,
-                            document=f,
-                            filename="坏号.zip",
-                            caption=caption
-                        )
+                    context.bot.send_document(
+                        chat_id=group_id,
+                        document=bad_artifact.open(),
+                        filename=bad_artifact.filename,
+                        caption=caption
+                    )
                     
                     logging.info(f"✅ 已发送 {len(bad_accounts)} 个坏号到群组")
                 except Exception as e:
                     logging.error(f"❌ 发送坏号到群组失败: {e}")
-                
-                # 删除临时 zip 文件
-                try:
-                    os.remove(bad_zip_path)
-                except:
-                    pass
             
-            # 删除坏号原始文件
-            logging.info(f"🗑️ 删除 {len(bad_accounts)} 个坏号的原始文件")
-            for account in bad_accounts:
-                try:
-                    session_file = account['session'] + '.session'
-                    json_file = account['json']
-                    
-                    if os.path.exists(json_file):
-                        os.remove(json_file)
-                    if os.path.exists(session_file):
-                        os.remove(session_file)
-                except Exception as e:
-                    logging.error(f"删除坏号文件失败: {e}")
+            # 坏号随后移入隔离状态，原始文件保留供管理员复核，只删除预打包分片
+            for root in PROTOCOL_ROOTS:
+                discard_account_blobs(root, nowuid, [account['phone'] for account in bad_accounts])
                     
         except Exception as e:
             logging.error(f"处理坏号失败: {e}")
     
+    # 先发完账号并结算预留，再发结果消息：结果消息里的数量和退款都按实际送达计算
+    # 发送剩余的存活账号（未分批时即全部存活账号）；发送失败的批次不确认售出，按未送达处理
+    file_id = delivery.finish()
+    if file_id:
+        # 保存 file_id，重新下载时直接复用，不再重新上传；分批发货的订单重新下载时合并打包
+        agent_orders.update_one({'order_id': order_id}, {'$set': {'file_id': file_id}})
+    if delivery.parts > 1:
+        logging.info(f"📦 存活账号分 {delivery.parts} 批发送完成: {delivery.delivered} 个")
+    
+    # 发送未知错误账号zip
+    unknown_delivered = 0
+    if unknown_artifact:
+        try:
+            with unknown_artifact:
+                context.bot.send_document(
+                    chat_id=user_id,
+                    document=unknown_artifact.open(),
+                    filename="未知错误账号.zip" if lang == 'zh' else "unknown_error_accounts.zip"
+                )
+            # 送达后立即确认售出并记录进度，之后的步骤失败重试时不重复发送
+            commit_reservation(nowuid, reserve_token, user_id, beijing_now_str(),
+                               ids=[account['db_id'] for account in results['unknown'] if account.get('db_id') is not None])
+            add_delivered_count(order_id, unknown_count)
+            unknown_delivered = unknown_count
+        except Exception as e:
+            logging.error(f"❌ 发送未知错误账号失败: {e}")
+    
+    # 坏号移入隔离状态（不再出售，供管理员复核）
+    bad_account_ids = []
+    for account in results.get('banned', []) + results.get('frozen', []):
+        db_id = account.get('db_id')
+        if db_id is not None:
+            bad_account_ids.append(db_id)
+    
+    if bad_account_ids:
+        quarantine_reserved(nowuid, reserve_token, bad_account_ids)
+    
+    # 兜底：仍处于预留状态的账号（发送失败的账号）退回库存；已送达的账号在发送后已确认售出
+    release_reservation(nowuid, reserve_token)
+    
+    # 按实际送达数量结算，发送失败的账号和补号后仍未补足的坏号一起退款
+    if delivery.delivered < normal_count or unknown_delivered < unknown_count:
+        logging.warning(f"⚠️ 部分账号发送失败: 存活 {delivery.delivered}/{normal_count}, 未知 {unknown_delivered}/{unknown_count}")
+    normal_count, unknown_count = delivery.delivered, unknown_delivered
+    refund_count = max(0, quantity - normal_count - unknown_count)
+    refund_amount = refund_count * agent_price
+    
+    logging.info(f"💰 退款计算: 补号 {replaced_count} 个, {refund_count} 个未送达 × {agent_price:.2f} = {refund_amount:.2f} USDT")
+    
     # 删除进度消息
     try:
         context.bot.delete_message(chat_id=user_id, message_id=progress_msg.message_id)
@@ -2099,19 +2065,20 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
 ✅ 存活: {normal_count} 个
 ❌ 封禁: {banned_count} 个
 ⚠️ 冻结: {frozen_count} 个
+{f'🔁 坏号已自动补号: {replaced_count} 个' if replaced_count > 0 else ''}
 
 💰 实付: {(normal_count + unknown_count) * agent_price:.2f} USDT
 {f'💵 退回: {refund_amount:.2f} USDT ✅' if refund_amount > 0 else ''}
 📦 剩余余额: {current_balance:.2f} USDT
 
 📁 发货格式: {format_display}
-{f'📥 存活账号已发送 ↓' if normal_count > 0 else ''}"""
+{('📥 存活账号已分批发送 ↑' if delivery.parts > 1 else '📥 存活账号已发送 ↑') if normal_count > 0 else ''}"""
         
         if unknown_count > 0:
             result_text += f"""
 
 ━━━━━━━━━━━━━━━━━━━━
-⚠️ 以下账号检测异常，请联系客服处理: 
+⚠️ 以上未知错误账号检测异常，请联系客服处理: 
 
 ❓ 未知错误: {unknown_count} 个"""
         
@@ -2129,19 +2096,20 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
 ✅ Normal: {normal_count} pcs
 ❌ Banned: {banned_count} pcs
 ⚠️ Frozen: {frozen_count} pcs
+{f'🔁 Bad accounts replaced: {replaced_count} pcs' if replaced_count > 0 else ''}
 
 💰 Paid: {normal_count * agent_price:.2f} USDT
 {f'💵 Refund: {refund_amount:.2f} USDT ✅' if refund_amount > 0 else ''}
 📦 Remaining Balance: {current_balance:.2f} USDT
 
 📁 Delivery Format: {format_display_en}
-{f'📥 Normal accounts sent ↓' if normal_count > 0 else ''}"""
+{('📥 Normal accounts sent in parts ↑' if delivery.parts > 1 else '📥 Normal accounts sent ↑') if normal_count > 0 else ''}"""
         
         if unknown_count > 0:
             result_text += f"""
 
 ━━━━━━━━━━━━━━━━━━━━
-⚠️ Following accounts have detection errors, please contact support: 
+⚠️ The unknown error accounts above have detection errors, please contact support: 
 
 ❓ Unknown Error: {unknown_count} pcs"""
         
@@ -2152,64 +2120,6 @@ def send_account_files_with_detection(context: CallbackContext, user_id: int, no
         text=result_text
     )
     
-    # 发送存活账号zip
-    if normal_zip_path and os.path.exists(normal_zip_path):
-        with open(normal_zip_path, 'rb') as f:
-            if delivery_format == 'tdata':
-                filename = f"存活账号-{normal_count}_tdata.zip" if lang == 'zh' else f"normal_accounts-{normal_count}_tdata.zip"
-            else:
-                filename = f"存活账号-{normal_count}.zip" if lang == 'zh' else f"normal_accounts-{normal_count}.zip"
-            
-            context.bot.send_document(
-                chat_id=user_id,
-                document=f,
-                filename=filename
-            )
-        try:
-            os.remove(normal_zip_path)
-        except:
-            pass
-    
-    # 发送未知错误账号zip
-    if unknown_zip_path and os.path.exists(unknown_zip_path):
-        with open(unknown_zip_path, 'rb') as f:
-            context.bot.send_document(
-                chat_id=user_id,
-                document=f,
-                filename="未知错误账号.zip" if lang == 'zh' else "unknown_error_accounts.zip"
-            )
-        try:
-            os.remove(unknown_zip_path)
-        except:
-            pass
-    
-    # 标记存活和未知错误账号为已售出
-    timer = beijing_now_str()
-    sold_account_ids = []
-    
-    for account in results.get('normal', []) + results.get('unknown', []):
-        db_id = account.get('db_id')
-        if db_id is not None:
-            sold_account_ids.append(db_id)
-    
-    if sold_account_ids:
-        logging.info(f"📝 标记 {len(sold_account_ids)} 个账号为已售出 (state=1)")
-        hb.update_many(
-            {"_id": {"$in": sold_account_ids}},
-            {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}}
-        )
-    
-    # 删除坏号数据库记录
-    bad_account_ids = []
-    for account in results.get('banned', []) + results.get('frozen', []):
-        db_id = account.get('db_id')
-        if db_id is not None:
-            bad_account_ids.append(db_id)
-    
-    if bad_account_ids:
-        logging.info(f"🗑️ 从数据库删除 {len(bad_account_ids)} 个坏号记录")
-        hb.delete_many({"_id": {"$in": bad_account_ids}})
-    
     # 发送购买完成后的感谢消息和内联按钮
     if lang == 'zh':
         thank_you_text = """━━━━━━━━━━━━━━━━━━━━
@@ -2633,6 +2543,7 @@ Please recharge first! """
             'order_time': order_time,
             'delivery_type': fhtype
         })
+        record_sale(nowuid, quantity)
         
 # MOVED_TO_AFTER_DELIVERY:          # 发送订单通知到群组
 # MOVED_TO_AFTER_DELIVERY:          try:
@@ -2705,149 +2616,237 @@ Please recharge first! """
         except Exception as e:
             logging.warning(f"删除确认消息失败: {e}")
         
-        # 根据商品类型发送账号
-        if fhtype == '协议号':
+        # 扣款和订单已记录，检测、打包与发货交给发货工作线程
+        enqueue_delivery_job(order_id, AGENT_BOT_ID, 'agent', user_id, {
+            'nowuid': nowuid,
+            'quantity': quantity,
+            'product_name': product_name,
+            'fhtype': fhtype,
+            'delivery_format': delivery_format,
+            'hq_price': hq_price,
+            'agent_price': agent_price,
+            'total_price': total_price,
+            'profit': profit,
+            'balance': balance,
+            'order_time': order_time,
+            'username': username,
+            'fullname': fullname,
+            'lang': lang
+        })
+        
+        try:
+            msg = "⏳ Order placed, delivering..." if lang != 'zh' else "⏳ 订单已提交，正在为您发货..."
+            context.bot.send_message(chat_id=user_id, text=msg)
+        except Exception as e:
+            logging.warning(f"发送发货提示失败: {e}")
+        
+        logging.info(f"✅ 代理订单完成:  user={user_id}, product={product_name}, quantity={quantity}, amount={total_price:.2f}")
+        
+    except Exception as e: 
+        logging.error(f"❌ 购买失败: {e}")
+        import traceback
+        traceback.print_exc()
+        try:
+            msg = "❌ Purchase failed, please contact support" if lang != 'zh' else "❌ 购买失败，请联系客服"
+            context.bot.send_message(chat_id=user_id, text=msg)
+        except Exception as e:
+            logging.error(f"发送错误消息失败:  {e}")
+
+
+def deliver_agent_order(bot, job):
+    """发货任务处理器：代理订单的账号检测、坏号退款与发货"""
+    context = JobContext(bot)
+    user_id = job['user_id']
+    order_id = job['order_id']
+    payload = job['payload']
+    nowuid = payload['nowuid']
+    quantity = payload['quantity']
+    product_name = payload['product_name']
+    fhtype = payload['fhtype']
+    delivery_format = payload['delivery_format']
+    hq_price = payload['hq_price']
+    agent_price = payload['agent_price']
+    total_price = payload['total_price']
+    profit = payload['profit']
+    balance = payload['balance']
+    order_time = payload['order_time']
+    username = payload['username']
+    fullname = payload['fullname']
+    lang = payload['lang']
+    display_product = t(product_name, lang) if lang != 'zh' else product_name
+    agent_users = get_agent_bot_user_collection(AGENT_BOT_ID)
+    
+    # 重试前一次发货已失败并全额退款的订单不再发货
+    order = agent_orders.find_one({'order_id': order_id}, {'status': 1})
+    if order and order.get('status') == 'failed':
+        logging.warning(f"⚠️ 订单已退款，跳过发货: {order_id}")
+        return
+    
+    # 上次发货中断时已送达的部分（重试时只补发剩余部分）
+    progress = job.get('progress') or {}
+    delivered_before = progress.get('delivered', 0)
+    if progress.get('reserve_token'):
+        # 上次未送达的预留退回库存，已送达的账号已确认售出，不受影响
+        release_reservation(nowuid, progress['reserve_token'])
+    if delivered_before:
+        logging.info(f"♻️ 续发订单: {order_id}, 已送达 {delivered_before}/{quantity}")
+    
+    # 根据商品类型发送账号
+    if fhtype == '协议号':
+        if delivered_before >= quantity:
+            success, refund_amount, detection_result = True, 0.0, {'normal': 0, 'banned': 0, 'frozen': 0, 'unknown': 0}
+        else:
             # 使用带检测的发货功能
             success, refund_amount, detection_result = send_account_files_with_detection(
-                context, user_id, nowuid, quantity, product_name, agent_price, order_id, username, fullname, delivery_format
+                context, user_id, nowuid, quantity - delivered_before, product_name, agent_price, order_id,
+                username, fullname, delivery_format
             )
-            
-            if not success:
-                # 发货失败，全额退款
-                agent_users.update_one(
-                    {'user_id': user_id},
-                    {
-                        '$inc': {
-                            'USDT': total_price,
-                            'zgje':  -total_price,
-                            'zgsl': -quantity
-                        }
+            if not success and delivered_before:
+                # 剩余部分发货失败：只退未送达的部分
+                success, refund_amount = True, (quantity - delivered_before) * agent_price
+        detection_result = dict(detection_result, normal=detection_result.get('normal', 0) + delivered_before)
+        
+        if not success:
+            # 发货失败，全额退款
+            agent_users.update_one(
+                {'user_id': user_id},
+                {
+                    '$inc': {
+                        'USDT': total_price,
+                        'zgje':  -total_price,
+                        'zgsl': -quantity
                     }
-                )
-                agent_orders.update_one(
-                    {'order_id': order_id},
-                    {'$set': {'status': 'failed', 'error': '发货失败，已退款'}}
-                )
-                # 回退代理统计
-                agent_bots.update_one(
-                    {'agent_bot_id': AGENT_BOT_ID},
-                    {
-                        '$inc': {
-                            'total_sales': -total_price,
-                            'total_commission': -profit,
-                            'available_balance': -profit,
-                            'total_orders': -1
-                        }
+                }
+            )
+            agent_orders.update_one(
+                {'order_id': order_id},
+                {'$set': {'status': 'failed', 'error': '发货失败，已退款'}}
+            )
+            record_sale(nowuid, -quantity)
+            # 回退代理统计
+            agent_bots.update_one(
+                {'agent_bot_id': AGENT_BOT_ID},
+                {
+                    '$inc': {
+                        'total_sales': -total_price,
+                        'total_commission': -profit,
+                        'available_balance': -profit,
+                        'total_orders': -1
                     }
-                )
-                return
+                }
+            )
+            return
+        
+        # 处理退款（如果有坏号）
+        if refund_amount > 0:
+            # 退款给用户
+            agent_users.update_one(
+                {'user_id': user_id},
+                {'$inc': {'USDT': refund_amount, 'zgje': -refund_amount}}
+            )
             
-            # 处理退款（如果有坏号）
-            if refund_amount > 0:
-                # 退款给用户
-                agent_users.update_one(
-                    {'user_id': user_id},
-                    {'$inc': {'USDT': refund_amount, 'zgje': -refund_amount}}
-                )
-                
-                # 更新订单记录
-                agent_orders.update_one(
-                    {'order_id': order_id},
-                    {
-                        '$set': {
-                            'refund_amount': refund_amount,
-                            'final_price': total_price - refund_amount,
-                            'detection_result': detection_result
-                        }
+            # 更新订单记录
+            agent_orders.update_one(
+                {'order_id': order_id},
+                {
+                    '$set': {
+                        'refund_amount': refund_amount,
+                        'final_price': total_price - refund_amount,
+                        'detection_result': detection_result
                     }
-                )
-                
-                # 调整代理统计
-                # 计算需要退回的佣金：退款金额对应的佣金部分
-                hq_refund = refund_amount / (1 + COMMISSION_RATE)  # 总部成本部分
-                refund_commission = refund_amount - hq_refund  # 佣金部分
-                agent_bots.update_one(
-                    {'agent_bot_id': AGENT_BOT_ID},
-                    {
-                        '$inc': {
-                            'total_sales': -refund_amount,
-                            'total_commission': -refund_commission,
-                            'available_balance': -refund_commission
-                        }
+                }
+            )
+            
+            # 调整代理统计
+            # 计算需要退回的佣金：退款金额对应的佣金部分
+            hq_refund = refund_amount / (1 + COMMISSION_RATE)  # 总部成本部分
+            refund_commission = refund_amount - hq_refund  # 佣金部分
+            agent_bots.update_one(
+                {'agent_bot_id': AGENT_BOT_ID},
+                {
+                    '$inc': {
+                        'total_sales': -refund_amount,
+                        'total_commission': -refund_commission,
+                        'available_balance': -refund_commission
                     }
-                )
-                
-                logging.info(f"✅ 退款处理完成: user={user_id}, refund={refund_amount:.2f}")
-            else:
-                # 即使没有退款，也要保存检测结果
-                agent_orders.update_one(
-                    {'order_id': order_id},
-                    {
-                        '$set': {
-                            'detection_result': detection_result
-                        }
+                }
+            )
+            
+            logging.info(f"✅ 退款处理完成: user={user_id}, refund={refund_amount:.2f}")
+        else:
+            # 即使没有退款，也要保存检测结果
+            agent_orders.update_one(
+                {'order_id': order_id},
+                {
+                    '$set': {
+                        'detection_result': detection_result
                     }
-                )
-
-            # ===== 发送订单通知（使用实际交付数量计算利润）=====
-            try:
-                # 从检测结果获取数量
-                normal_count = detection_result.get("normal", 0)
-                banned_count = detection_result.get("banned", 0)
-                frozen_count = detection_result.get("frozen", 0)
-                unknown_count = detection_result.get("unknown", 0)
-                delivered_count = normal_count + unknown_count
-                
-                # 计算实际利润
-                actual_profit = delivered_count * (agent_price - hq_price) if delivered_count > 0 else 0
-                actual_total_price = delivered_count * agent_price
-                actual_hq_total_price = delivered_count * hq_price
-                profit_per_unit = agent_price - hq_price
-                
-                updated_user = get_agent_bot_user(AGENT_BOT_ID, user_id)
-                total_spent = updated_user.get("zgje", 0) if updated_user else 0
-                new_balance = updated_user.get("USDT", 0) if updated_user else 0
-                
-                total_orders_count = agent_orders.count_documents({
-                    "agent_bot_id": AGENT_BOT_ID,
-                    "customer_id": user_id,
-                    "status": "completed"
-                })
-                
-                order_notify_data = {
-                    "username":  username,
-                    "user_id": user_id,
-                    "order_id":  order_id,
-                    "order_time": order_time,
-                    "category":  fhtype,
-                    "product_name": product_name,
-                    "original_quantity": quantity,
-                    "normal_count": normal_count,
-                    "banned_count":  banned_count,
-                    "frozen_count": frozen_count,
-                    "unknown_count": unknown_count,
-                    "delivered_count": delivered_count,
-                    "total_price": actual_total_price,
-                    "hq_total_price": actual_hq_total_price,
-                    "agent_price": agent_price,
-                    "profit": actual_profit,
-                    "profit_per_unit": profit_per_unit,
-                    "old_balance":  balance,
-                    "new_balance": new_balance,
-                    "total_spent":  total_spent,
-                    "total_orders": total_orders_count
                 }
-                
-                send_order_notify_to_group("purchase", order_notify_data, bot=context.bot)
-                logging.info(f"✅ 订单通知已发送:  delivered={delivered_count}, profit={actual_profit:.2f}")
-            except Exception as notify_error:
-                logging.error(f"❌ 发送购买订单通知失败: {notify_error}")
-            # ===== 订单通知结束 =====
+            )
 
-        else:
-            accounts = list(hb.find({"nowuid": nowuid, 'state': 0}).limit(quantity))
+        # ===== 发送订单通知（使用实际交付数量计算利润）=====
+        try:
+            # 从检测结果获取数量
+            normal_count = detection_result.get("normal", 0)
+            banned_count = detection_result.get("banned", 0)
+            frozen_count = detection_result.get("frozen", 0)
+            unknown_count = detection_result.get("unknown", 0)
+            delivered_count = normal_count + unknown_count
             
+            # 计算实际利润
+            actual_profit = delivered_count * (agent_price - hq_price) if delivered_count > 0 else 0
+            actual_total_price = delivered_count * agent_price
+            actual_hq_total_price = delivered_count * hq_price
+            profit_per_unit = agent_price - hq_price
+            
+            updated_user = get_agent_bot_user(AGENT_BOT_ID, user_id)
+            total_spent = updated_user.get("zgje", 0) if updated_user else 0
+            new_balance = updated_user.get("USDT", 0) if updated_user else 0
+            
+            total_orders_count = agent_orders.count_documents({
+                "agent_bot_id": AGENT_BOT_ID,
+                "customer_id": user_id,
+                "status": "completed"
+            })
+            
+            order_notify_data = {
+                "username":  username,
+                "user_id": user_id,
+                "order_id":  order_id,
+                "order_time": order_time,
+                "category":  fhtype,
+                "product_name": product_name,
+                "original_quantity": quantity,
+                "normal_count": normal_count,
+                "banned_count":  banned_count,
+                "frozen_count": frozen_count,
+                "unknown_count": unknown_count,
+                "delivered_count": delivered_count,
+                "total_price": actual_total_price,
+                "hq_total_price": actual_hq_total_price,
+                "agent_price": agent_price,
+                "profit": actual_profit,
+                "profit_per_unit": profit_per_unit,
+                "old_balance":  balance,
+                "new_balance": new_balance,
+                "total_spent":  total_spent,
+                "total_orders": total_orders_count
+            }
+            
+            send_order_notify_to_group("purchase", order_notify_data, bot=context.bot)
+            logging.info(f"✅ 订单通知已发送:  delivered={delivered_count}, profit={actual_profit:.2f}")
+        except Exception as notify_error:
+            logging.error(f"❌ 发送购买订单通知失败: {notify_error}")
+        # ===== 订单通知结束 =====
+
+    else:
+        # 上次已确认售出但消息未发出：重发同一批内容，不再重新预留
+        content_list = progress.get('hbids')
+        if content_list is None:
+            reserve_token, accounts = reserve_stock(nowuid, quantity, owner_id=user_id)
+        
             if len(accounts) < quantity:
+                release_reservation(nowuid, reserve_token)
                 if lang == 'zh': 
                     context.bot.send_message(chat_id=user_id, text="❌ 库存不足，购买失败")
                 else:
@@ -2863,22 +2862,18 @@ Please recharge first! """
                     }
                 )
                 return
-            
-            timer = beijing_now_str()
-            for account in accounts: 
-                hb.update_one(
-                    {'_id': account['_id']},
-                    {'$set': {'state': 1, 'yssj': timer, 'gmid': user_id}}
-                )
-            
+        
+            commit_reservation(nowuid, reserve_token, user_id, beijing_now_str())
+        
             content_list = []
             for account in accounts:
                 content_list.append(account.get('hbid', ''))
-            
-            content = '\n'.join(content_list)
-            
-            if lang == 'zh': 
-                success_text = f"""
+            set_delivery_progress(order_id, hbids=content_list)
+        
+        content = '\n'.join(content_list)
+        
+        if lang == 'zh': 
+            success_text = f"""
 ✅ <b>购买成功</b>
 
 📦 商品: {product_name}
@@ -2893,14 +2888,14 @@ Please recharge first! """
 📋 订单号: <code>{order_id}</code>
 
 💡 如有问题请联系客服
-                """.strip()
-                
-                keyboard = [
-                    [InlineKeyboardButton("🛒 继续购买", callback_data="product_list")],
-                    [InlineKeyboardButton("📋 我的订单", callback_data="my_orders")]
-                ]
-            else:
-                success_text = f"""
+            """.strip()
+            
+            keyboard = [
+                [InlineKeyboardButton("🛒 继续购买", callback_data="product_list")],
+                [InlineKeyboardButton("📋 我的订单", callback_data="my_orders")]
+            ]
+        else:
+            success_text = f"""
 ✅ <b>Purchase Successful</b>
 
 📦 Product: {display_product}
@@ -2915,31 +2910,35 @@ Please recharge first! """
 📋 Order ID: <code>{order_id}</code>
 
 💡 Contact support if you have any issues
-                """.strip()
-                
-                keyboard = [
-                    [InlineKeyboardButton("🛒 Continue Shopping", callback_data="product_list")],
-                    [InlineKeyboardButton("📋 My Orders", callback_data="my_orders")]
-                ]
+            """.strip()
             
-            context.bot.send_message(
-                chat_id=user_id,
-                text=success_text,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        
-        logging.info(f"✅ 代理订单完成:  user={user_id}, product={product_name}, quantity={quantity}, amount={total_price:.2f}")
+            keyboard = [
+                [InlineKeyboardButton("🛒 Continue Shopping", callback_data="product_list")],
+                [InlineKeyboardButton("📋 My Orders", callback_data="my_orders")]
+            ]
         
-    except Exception as e: 
-        logging.error(f"❌ 购买失败: {e}")
-        import traceback
-        traceback.print_exc()
-        try:
-            msg = "❌ Purchase failed, please contact support" if lang != 'zh' else "❌ 购买失败，请联系客服"
-            context.bot.send_message(chat_id=user_id, text=msg)
-        except Exception as e:
-            logging.error(f"发送错误消息失败:  {e}")
+        context.bot.send_message(
+            chat_id=user_id,
+            text=success_text,
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    logging.info(f"✅ 代理订单发货完成: user={user_id}, order={order_id}")
+
+
+def agent_delivery_failed(bot, job, error):
+    """发货重试次数用尽：通知买家联系客服"""
+    lang = job['payload'].get('lang', 'zh')
+    if lang == 'zh':
+        msg = f"❌ 订单发货失败，订单号：{job['order_id']}\n请联系客服 {CUSTOMER_SERVICE} 处理"
+    else:
+        msg = f"❌ Delivery failed, order ID: {job['order_id']}\nPlease contact support {CUSTOMER_SERVICE}"
+    try:
+        bot.send_message(chat_id=job['user_id'], text=msg)
+    except Exception as e:
+        logging.error(f"通知发货失败消息失败: {e}")
+
 
 def show_recharge(update: Update, context: CallbackContext):
     """显示充值金额选择"""
@@ -3880,19 +3879,12 @@ def handle_country_search_input(update: Update, context: CallbackContext, user_i
         {'$set': {'sign':  '0'}}
     )
     
-    # 判断输入是区号还是国家名称
+    # 判断输入是区号还是国家名称（中英文国家名转换为区号）
     search_keyword = search_text.strip()
+    search_keyword = resolve_dial_code(search_keyword) or search_keyword
     
-    # 如果是国家名称，转换为区号
-    if search_keyword in COUNTRY_MAP:
-        search_keyword = COUNTRY_MAP[search_keyword]
-    
-    # 从数据库搜索商品名称包含关键词的商品
-    pattern = re.compile(re.escape(search_keyword), re.IGNORECASE)
-    
-    products = list(ejfl.find({
-        'projectname': {'$regex': pattern}
-    }).sort('row', 1))
+    # 内存索引搜索，结果已按有库存优先排序
+    products = search_products(search_keyword, limit=50)
     
     if not products: 
         if lang == 'en':
@@ -3932,7 +3924,7 @@ No matching products found
         text = f"🌍 <b>国家/区号搜索</b>\n🔍 <code>{search_keyword}</code> 搜索结果\n\n"
     
     keyboard = []
-    for product in products:
+    for product, stock in products:
         nowuid = product.get('nowuid')
         product_name = product.get('projectname', '')
         display_product = t(product_name, lang) if lang == 'en' else product_name
@@ -3941,9 +3933,6 @@ No matching products found
         # 计算代理价格
         agent_price = hq_price * (1 + COMMISSION_RATE)
         
-        # 获取库存
-        stock = get_real_time_stock(nowuid)
-        
         # 只显示有库存的商品
         if stock > 0:
             keyboard.append([
@@ -4017,66 +4006,43 @@ def download_order(update: Update, context: CallbackContext):
         
         if delivery_type == '协议号':
             # 协议号类型：需要打包发送
-            # 从hb集合中获取该订单购买的账号
-            accounts = list(hb.find({
-                'nowuid': nowuid,
-                'gmid': user_id,
-                'state': 1
-            }).limit(quantity))
-            
-            if len(accounts) < quantity:
-                context.bot.send_message(
-                    chat_id=user_id,
-                    text="⚠️ Some files may be lost, please contact customer service" if lang == 'en' else "⚠️ 部分文件可能已丢失，请联系客服"
-                )
-                # 即使部分丢失，也尝试发送找到的
-            
-            if accounts:
-                # 获取账号文件名
-                folder_names = [doc['projectname'] for doc in accounts]
-                
-                # 创建zip文件
-                timestamp = int(time.time())
-                zip_filename = f"./协议号发货/{user_id}_{timestamp}_redownload.zip"
-                
-                # 确保目录存在
-                os.makedirs('./协议号发货', exist_ok=True)
+            def build_artifact():
+                # 从hb集合中获取该订单购买的账号
+                accounts = list(hb.find({
+                    'nowuid': nowuid,
+                    'gmid': user_id,
+                    'state': 1
+                }).limit(quantity))
                 
-                # 打包文件
-                with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-                    for file_name in folder_names:
-                        # 尝试总部路径和本地路径
-                        json_file = os.path.join(BASE_PROTOCOL_PATH, nowuid, file_name + ".json")
-                        session_file = os.path.join(BASE_PROTOCOL_PATH, nowuid, file_name + ".session")
-                        
-                        if not os.path.exists(json_file):
-                            json_file = os.path.join(FALLBACK_PROTOCOL_PATH, nowuid, file_name + ".json")
-                        if not os.path.exists(session_file):
-                            session_file = os.path.join(FALLBACK_PROTOCOL_PATH, nowuid, file_name + ".session")
-                        
-                        if os.path.exists(json_file):
-                            zipf.write(json_file, os.path.basename(json_file))
-                        if os.path.exists(session_file):
-                            zipf.write(session_file, os.path.basename(session_file))
-                
-                # 发送文件
-                with open(zip_filename, "rb") as f:
-                    if lang == 'en':
-                        caption = f"✅ Order files downloaded\n\nProduct: {display_product}\nQuantity: {len(accounts)}"
-                    else: 
-                        caption = f"✅ 订单文件下载完成\n\n商品：{display_product}\n数量：{len(accounts)}"
-                    context.bot.send_document(
+                if len(accounts) < quantity:
+                    context.bot.send_message(
                         chat_id=user_id,
-                        document=f,
-                        caption=caption
+                        text="⚠️ Some files may be lost, please contact customer service" if lang == 'en' else "⚠️ 部分文件可能已丢失，请联系客服"
                     )
+                    # 即使部分丢失，也尝试发送找到的
+                if not accounts:
+                    raise FileNotFoundError(order_id)
                 
-                # 清理临时文件
-                try:
-                    os.remove(zip_filename)
-                except (OSError, FileNotFoundError) as e:
-                    logging.warning(f"清理临时文件失败:  {e}")
-            else:
+                # 获取账号文件名
+                folder_names = [doc['projectname'] for doc in accounts]
+                
+                # 打包文件（内存缓冲）
+                timestamp = int(time.time())
+                return order_zip_artifact('协议号', PROTOCOL_ROOTS, nowuid, folder_names,
+                                          f"{user_id}_{timestamp}_redownload.zip")
+            
+            if lang == 'en':
+                caption = f"✅ Order files downloaded\n\nProduct: {display_product}\nQuantity: {quantity}"
+            else: 
+                caption = f"✅ 订单文件下载完成\n\n商品：{display_product}\n数量：{quantity}"
+            
+            try:
+                # 优先复用首次发货时保存的 file_id，失效时才重新打包上传
+                file_id = order.get('file_id')
+                new_file_id = send_cached_document(context.bot, user_id, file_id, build_artifact, caption=caption)
+                if new_file_id and new_file_id != file_id:
+                    agent_orders.update_one({'order_id': order_id}, {'$set': {'file_id': new_file_id}})
+            except FileNotFoundError:
                 context.bot.send_message(
                     chat_id=user_id,
                     text="❌ Order files not found, please contact customer service" if lang == 'en' else "❌ 未找到订单文件，请联系客服"
@@ -4242,6 +4208,88 @@ def admin_command(update: Update, context: CallbackContext):
     show_admin_panel(update, context, is_command=True)
 
 
+def detect_stats_command(update: Update, context: CallbackContext):
+    """处理/detect_stats命令 - 各检测阶段耗时（按阶段、DC、代理），/detect_stats reset 清零"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("❌ 无权限访问")
+        return
+    if not ACCOUNT_DETECTOR_AVAILABLE:
+        update.message.reply_text("❌ 账号检测未启用")
+        return
+    
+    if context.args and context.args[0] == 'reset':
+        detection_metrics.reset()
+        update.message.reply_text("✅ 检测耗时统计已清零")
+        return
+    
+    lines = detection_metrics.summary_lines()
+    if not lines:
+        update.message.reply_text("暂无检测耗时记录")
+        return
+    
+    since = datetime.fromtimestamp(detection_metrics.since).strftime('%Y-%m-%d %H:%M:%S')
+    text = [f"⏱️ <b>检测阶段耗时</b>（自 {since} 起）", ""]
+    text += [html.escape(line) for line in lines]
+    
+    # 连接和发消息两个阶段按 DC 对比
+    dc_lines = [
+        f"{item['dc']} {item['stage']}: {item['count']}次 p95 {item['p95']:.2f}s"
+        for item in detection_metrics.snapshot('dc') if item['stage'] in ('connect', 'send_message')
+    ]
+    if dc_lines:
+        text += ["", "<b>按DC</b>"] + dc_lines
+    
+    # 连接最慢的代理（样本不少于5次）
+    slow_proxies = sorted(
+        (item for item in detection_metrics.snapshot('proxy') if item['stage'] == 'connect' and item['count'] >= 5),
+        key=lambda item: -item['p95']
+    )[:5]
+    if slow_proxies:
+        text += ["", "<b>连接最慢的代理</b>"] + [
+            f"{html.escape(item['proxy'])}: {item['count']}次 p95 {item['p95']:.2f}s" for item in slow_proxies
+        ]
+    update.message.reply_text("\n".join(text), parse_mode='HTML')
+
+
+def quarantine_command(update: Update, context: CallbackContext):
+    """处理/quarantine命令 - 隔离账号复核
+    
+    /quarantine <商品ID>          查看隔离数量
+    /quarantine <商品ID> recheck  重新检测，已恢复的放回库存
+    /quarantine <商品ID> release  不检测，全部放回库存
+    """
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("❌ 无权限访问")
+        return
+    if not context.args:
+        update.message.reply_text("用法: /quarantine <商品ID> [recheck|release]")
+        return
+    
+    nowuid = context.args[0]
+    action = context.args[1] if len(context.args) > 1 else ''
+    if action == 'release':
+        released = release_quarantined(nowuid)
+        update.message.reply_text(f"✅ 已放回库存 {released} 个隔离账号")
+    elif action == 'recheck':
+        if not (ENABLE_ACCOUNT_DETECTION and ACCOUNT_DETECTOR_AVAILABLE and API_ID and API_HASH):
+            update.message.reply_text("❌ 账号检测未启用")
+            return
+        update.message.reply_text("🔍 正在重新检测隔离账号...")
+        result = recheck_quarantined(API_ID, API_HASH, PROTOCOL_ROOTS, nowuid, concurrency=HEALTH_SWEEP_CONCURRENCY)
+        update.message.reply_text(
+            f"✅ 复检完成: 检测 {result['checked']} 个, 放回库存 {result['released']} 个, 仍为坏号 {result['bad']} 个"
+        )
+    else:
+        quarantined = hb.count_documents({'nowuid': nowuid, 'state': STOCK_STATE_QUARANTINED})
+        update.message.reply_text(
+            f"🚧 商品 {nowuid} 隔离中 {quarantined} 个账号\n"
+            f"/quarantine {nowuid} recheck 重新检测\n"
+            f"/quarantine {nowuid} release 全部放回"
+        )
+
+
 def show_admin_panel(update: Update, context: CallbackContext, is_command: bool = False):
     """显示管理面板主界面"""
     user_id = update.effective_user.id
@@ -5803,7 +5851,8 @@ def show_product_list_from_message(update: Update, context: CallbackContext):
     lang = get_user_lang(user_id)
     
     # 获取所有一级分类
-    categories = list(fenlei.find({}).sort('row', 1))
+    catalog = get_catalog()
+    categories = catalog.categories
     
     if not categories:
         update.message.reply_text("暂无商品分类" if lang == 'zh' else "No product categories")
@@ -5822,16 +5871,19 @@ def show_product_list_from_message(update: Update, context: CallbackContext):
 
 ❗ Long unused accounts may have issues, contact support"""
     
+    # 一次性读取库存计数器
+    stock_map = get_stock_map()
+    
     keyboard = []
     for category in categories: 
         uid = category.get('uid')
         category_name = category.get('projectname', '未知分类')
         
         # 获取该分类下的所有商品
-        products = list(ejfl.find({'uid': uid}))
+        products = catalog.category_products(uid)
         
         # 统计该分类下所有商品的总库存数量
-        total_stock = sum(get_real_time_stock(product.get('nowuid')) for product in products if product.get('nowuid'))
+        total_stock = sum(stock_map.get(product.get('nowuid'), 0) for product in products if product.get('nowuid'))
         
         if total_stock > 0:
             # 翻译分类名称
@@ -5974,6 +6026,10 @@ def main():
     # 使用环境变量中的Token
     bot_token = AGENT_BOT_TOKEN
     
+    # TData 转换进程池（fork 创建，需在支付系统等后台线程之前启动）
+    if TGCONVERTOR_AVAILABLE:
+        start_tdata_converter()
+    
     # 初始化支付系统（如果可用）
     if PAYMENT_SYSTEM_AVAILABLE:
         try:
@@ -5992,6 +6048,8 @@ def main():
     # 注册命令处理器
     dispatcher.add_handler(CommandHandler('start', start))
     dispatcher.add_handler(CommandHandler('admin', admin_command))
+    dispatcher.add_handler(CommandHandler('detect_stats', detect_stats_command))
+    dispatcher.add_handler(CommandHandler('quarantine', quarantine_command, run_async=True))
     
     # 底部菜单按钮处理（需要放在其他 MessageHandler 之前）
     dispatcher.add_handler(MessageHandler(
@@ -6069,6 +6127,27 @@ def main():
     dispatcher.add_handler(CallbackQueryHandler(back_to_main, pattern='^back_to_main$'))
     dispatcher.add_handler(CallbackQueryHandler(close_message, pattern=r'^close_'))
     
+    # 回收过期的库存预留（与总部共用同一套预留机制）
+    updater.job_queue.run_repeating(lambda context: release_expired_reservations(), 60, 30, name='release_reservations')
+    
+    # 热销协议号商品预转换 TData，买家选择 TData 格式时直接使用缓存
+    if TGCONVERTOR_AVAILABLE:
+        updater.job_queue.run_repeating(lambda context: warm_popular_tdata(PROTOCOL_ROOTS), TDATA_WARM_INTERVAL, 60,
+                                        name='warm_tdata')
+    
+    # 空闲时巡检在售协议号，提前隔离坏号
+    if ENABLE_HEALTH_SWEEPER and ENABLE_ACCOUNT_DETECTION and ACCOUNT_DETECTOR_AVAILABLE and API_ID and API_HASH:
+        start_health_sweeper(
+            API_ID, API_HASH, PROTOCOL_ROOTS,
+            rate=HEALTH_SWEEP_RATE,
+            batch=HEALTH_SWEEP_BATCH,
+            concurrency=HEALTH_SWEEP_CONCURRENCY,
+            max_age=HEALTH_SWEEP_MAX_AGE
+        )
+    
+    # 后台发货工作线程（只处理本代理Bot登记的任务）
+    start_delivery_workers(updater.bot, AGENT_BOT_ID, {'agent': deliver_agent_order}, on_failed=agent_delivery_failed)
+    
     # 启动Bot
     logging.info(f"🚀 代理Bot启动: {AGENT_INFO.get('agent_name')} (@{AGENT_INFO.get('agent_username')})")
     updater.start_polling()
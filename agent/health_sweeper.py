@@ -0,0 +1,173 @@
+"""
+库存健康巡检
+空闲时按优先级（近 7 天热销商品优先，同一商品内最久未检测的账号优先）对在售协议号做售后检测，
+结果写回 hb.health；封禁/冻结的账号移入隔离状态（state=3），不再卖给用户，管理员可重新检测后放回已恢复的账号。
+购买时多数账号已有新鲜的检测结果，可直接跳过检测，坏号退款也随之减少。
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from mongo import (
+    hb, get_top_sellers, claim_stale_stock, finish_health_sweep, get_quarantined, release_quarantined,
+    record_account_health, QUARANTINE_STATUSES
+)
+from account_store import open_account
+from account_detector import BatchDetector
+
+
+def detection_account(doc: dict, roots: list) -> dict:
+    """把 hb 记录转换为 BatchDetector 的检测项
+
+    Args:
+        roots: 旧库存的协议号目录（按顺序查找），最后一个作为找不到文件时的默认路径
+    """
+    nowuid = doc.get('nowuid')
+    file_name = doc['projectname']
+    account_files = open_account(doc, roots)
+    session_file = account_files.session or os.path.join(roots[-1], nowuid, file_name + ".session")
+    json_file = account_files.json or os.path.join(roots[-1], nowuid, file_name + ".json")
+    return {
+        'phone': file_name,
+        'nowuid': nowuid,
+        'session': session_file[:-len('.session')],  # Telethon不需要.session后缀
+        'json': json_file,
+        'files': doc.get('files'),
+        'db_id': doc['_id']
+    }
+
+
+class HealthSweeper:
+    """后台库存巡检"""
+
+    def __init__(self, api_id: int, api_hash: str, roots: list, rate: int = 60, batch: int = 20,
+                 concurrency: int = 10, max_age: int = 21600, idle_interval: int = 300, top: int = 20):
+        """
+        Args:
+            rate: 每分钟最多检测的账号数
+            batch: 每轮认领的账号数
+            concurrency: 每轮同时检测的账号数
+            max_age: 上次检测超过该秒数的账号需要重新巡检
+            idle_interval: 没有待巡检账号时的等待时间（秒）
+            top: 优先巡检的热销商品数量
+        """
+        self.roots = roots
+        self.rate = max(1, rate)
+        self.batch = max(1, batch)
+        self.max_age = max_age
+        self.idle_interval = idle_interval
+        self.top = top
+        self.detector = BatchDetector(api_id, api_hash, max_workers=concurrency)
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread = None
+        self.stats = {'rounds': 0, 'checked': 0, 'quarantined': 0}
+
+    @contextmanager
+    def busy(self):
+        """购买检测期间暂停巡检，把代理和检测并发让给用户订单"""
+        with self._lock:
+            self._busy += 1
+            self._idle.clear()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._busy -= 1
+                if self._busy == 0:
+                    self._idle.set()
+
+    def _products(self) -> list:
+        """巡检顺序：热销商品在前，其余有协议号库存的商品在后"""
+        ranked = [nowuid for nowuid, _ in get_top_sellers('7d', self.top)]
+        seen = set(ranked)
+        others = hb.distinct('nowuid', {'state': 0, 'leixing': '协议号'})
+        return ranked + [nowuid for nowuid in others if nowuid not in seen]
+
+    def sweep_once(self) -> int:
+        """巡检一批账号
+
+        Returns:
+            int: 本轮检测的账号数，0 表示没有待巡检的账号
+        """
+        for nowuid in self._products():
+            token, docs = claim_stale_stock(nowuid, self.batch, self.max_age)
+            if not docs:
+                continue
+            results = self.detector.detect_accounts([detection_account(doc, self.roots) for doc in docs])
+            quarantined = finish_health_sweep(nowuid, token, results)
+            self.stats['rounds'] += 1
+            self.stats['checked'] += len(docs)
+            self.stats['quarantined'] += quarantined
+            logging.info(f"🩺 库存巡检：nowuid={nowuid}, 检测 {len(docs)} 个, "
+                         f"存活 {len(results['normal'])}, 隔离 {quarantined}, 未知 {len(results['unknown'])}")
+            return len(docs)
+        return 0
+
+    def _run(self):
+        while True:
+            self._idle.wait()
+            started = time.time()
+            try:
+                checked = self.sweep_once()
+            except Exception as e:
+                logging.error(f"❌ 库存巡检失败：{e}")
+                checked = 0
+            if not checked:
+                time.sleep(self.idle_interval)
+                continue
+            # 限速：按每分钟 rate 个账号折算本轮应占用的时间
+            time.sleep(max(0.0, checked * 60 / self.rate - (time.time() - started)))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='health-sweeper', daemon=True)
+            self._thread.start()
+            logging.info(f"✅ 库存巡检已启动：每分钟 {self.rate} 个, 每轮 {self.batch} 个, 重新巡检间隔 {self.max_age} 秒")
+        return self
+
+
+# 进程内的巡检实例，未启动时为 None
+health_sweeper = None
+
+
+def start_health_sweeper(api_id: int, api_hash: str, roots: list, **kwargs) -> HealthSweeper:
+    global health_sweeper
+    if health_sweeper is None:
+        health_sweeper = HealthSweeper(api_id, api_hash, roots, **kwargs)
+    return health_sweeper.start()
+
+
+def recheck_quarantined(api_id: int, api_hash: str, roots: list, nowuid: str, limit: int = 50,
+                        concurrency: int = 10) -> dict:
+    """重新检测某商品的隔离账号，已恢复（不再封禁/冻结）的放回在售库存（管理员复核）
+
+    Returns:
+        {'checked', 'released', 'bad'}
+    """
+    docs = get_quarantined(nowuid, limit)
+    if not docs:
+        return {'checked': 0, 'released': 0, 'bad': 0}
+    detector = BatchDetector(api_id, api_hash, max_workers=concurrency)
+    with sweeper_paused():
+        results = detector.detect_accounts([detection_account(doc, roots) for doc in docs])
+    record_account_health(nowuid, results)
+    keep = [item['db_id'] for status in QUARANTINE_STATUSES for item in results.get(status, [])]
+    released = release_quarantined(nowuid, [doc['_id'] for doc in docs if doc['_id'] not in keep])
+    logging.info(f"🩺 隔离复检：nowuid={nowuid}, 检测 {len(docs)} 个, 放回 {released}, 仍为坏号 {len(keep)}")
+    return {'checked': len(docs), 'released': released, 'bad': len(keep)}
+
+
+@contextmanager
+def sweeper_paused():
+    """购买检测时使用：巡检未启动时什么也不做"""
+    if health_sweeper is None:
+        yield
+    else:
+        with health_sweeper.busy():
+            yield
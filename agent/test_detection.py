@@ -109,6 +109,301 @@ def test_keyword_matching():
         return True
 
 
+def test_proxy_pool():
+    """测试代理池熔断、加权选择与热加载"""
+    print("\n" + "=" * 60)
+    print("测试代理池 / Testing Proxy Pool")
+    print("=" * 60)
+    
+    import tempfile
+    import time
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        proxy_file = os.path.join(tmp, 'proxy.txt')
+        with open(proxy_file, 'w') as f:
+            f.write("127.0.0.1:1080\n127.0.0.2:1080\n127.0.0.3:1080\n")
+        
+        pm = ProxyManager(proxy_file, failure_threshold=3, cooldown=60, reload_interval=0)
+        dead, slow, fast = pm.proxies
+        
+        for _ in range(3):
+            pm.report(dead, 'timeout')
+        for _ in range(5):
+            pm.report(slow, 'ok', 2.0)
+            pm.report(fast, 'ok', 0.1)
+        
+        picks = [pm.get_next_proxy()['addr'] for _ in range(300)]
+        dead_picks = picks.count(dead['addr'])
+        fast_picks = picks.count(fast['addr'])
+        print(f"✅ 熔断代理被选中: {dead_picks} 次")
+        print(f"   快代理 / 慢代理: {fast_picks} / {picks.count(slow['addr'])}")
+        
+        states = {item['proxy']: item['state'] for item in pm.stats()}
+        print(f"   状态: {states}")
+        
+        # 修改代理文件后自动重新加载，已有代理保留统计
+        time.sleep(0.01)
+        with open(proxy_file, 'w') as f:
+            f.write("127.0.0.2:1080\n127.0.0.4:1080\n")
+        os.utime(proxy_file, (time.time() + 1, time.time() + 1))
+        pm.get_next_proxy()
+        reloaded = [proxy['addr'] for proxy in pm.proxies]
+        kept = [item for item in pm.stats() if item['proxy'].endswith('127.0.0.2:1080')][0]['successes']
+        print(f"   重新加载后: {reloaded}, 保留统计: {kept} 次成功")
+        
+        return (dead_picks == 0 and fast_picks > 200
+                and reloaded == ['127.0.0.2', '127.0.0.4'] and kept == 5)
+
+
+def test_session_loading(iterations=500):
+    """测试 session 只读加载到内存，并与复制临时文件的方式对比耗时"""
+    print("\n" + "=" * 60)
+    print("测试Session加载 / Testing Session Loading")
+    print("=" * 60)
+    
+    import shutil
+    import tempfile
+    import time
+    from telethon.crypto import AuthKey
+    from telethon.sessions import SQLiteSession
+    from account_detector import load_memory_session
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, '+8613800000000')
+        original = SQLiteSession(base)
+        original.set_dc(4, '149.154.167.91', 443)
+        original.auth_key = AuthKey(data=os.urandom(256))
+        original.save()
+        original.close()
+        session_path = base + '.session'
+        mtime = os.path.getmtime(session_path)
+        
+        session = load_memory_session(session_path)
+        loaded = (session is not None and session.dc_id == 4 and session.port == 443
+                  and session.auth_key.key == original.auth_key.key)
+        print(f"{'✅' if loaded else '❌'} 读取 DC 与授权密钥: dc={session.dc_id if session else None}")
+        
+        started = time.perf_counter()
+        for _ in range(iterations):
+            load_memory_session(session_path)
+        memory_ms = (time.perf_counter() - started) * 1000 / iterations
+        
+        # 原方式：复制临时文件，Telethon 打开（SQLiteSession）后删除
+        started = time.perf_counter()
+        for i in range(iterations):
+            temp_base = f"{base}_detect_{i}"
+            shutil.copy2(session_path, temp_base + '.session')
+            SQLiteSession(temp_base).close()
+            os.remove(temp_base + '.session')
+        copy_ms = (time.perf_counter() - started) * 1000 / iterations
+        
+        print(f"   内存加载: {memory_ms:.3f} ms/个 (无文件写入)")
+        print(f"   复制临时文件并打开: {copy_ms:.3f} ms/个 ({iterations} 次复制 + {iterations} 次删除)")
+        
+        untouched = os.path.getmtime(session_path) == mtime and len(os.listdir(tmp)) == 1
+        print(f"   原始文件未修改: {untouched}")
+        return loaded and untouched
+
+
+def test_batch_concurrency():
+    """测试批量检测并发（不连接 Telegram，用模拟检测替换）"""
+    print("\n" + "=" * 60)
+    print("测试批量检测并发 / Testing Batch Concurrency")
+    print("=" * 60)
+    
+    import asyncio
+    import threading
+    
+    batch = BatchDetector(0, '', max_workers=5, account_timeout=1)
+    state = {'running': 0, 'peak': 0}
+    loop_threads = set()
+    
+    async def fake_check(session_file, json_file, max_proxy_retries=2, events=None, timings=None):
+        loop_threads.add(threading.get_ident())
+        state['running'] += 1
+        state['peak'] = max(state['peak'], state['running'])
+        try:
+            if session_file.endswith('slow'):
+                await asyncio.sleep(5)
+            await asyncio.sleep(0.05)
+            return ('normal', 'ok', None) if int(session_file.split('_')[1]) % 2 else ('banned', 'banned', None)
+        finally:
+            state['running'] -= 1
+    
+    batch.detector.check_account_detail = fake_check
+    accounts = [{'phone': f'+{i}', 'session': f's_{i}', 'json': f'j_{i}'} for i in range(40)]
+    accounts.append({'phone': '+slow', 'session': 's_99_slow', 'json': 'j'})
+    progress = []
+    streamed = []
+    results = batch.detect_accounts(accounts, progress_callback=lambda c, t, r: progress.append(c),
+                                    result_callback=lambda status, item: streamed.append(status))
+    
+    counts = {k: len(v) for k, v in results.items()}
+    print(f"✅ 结果: {counts}")
+    print(f"   最大并发: {state['peak']} (上限 5)")
+    print(f"   事件循环线程数: {len(loop_threads)}")
+    print(f"   进度回调: {len(progress)} 次")
+    print(f"   逐个结果回调: {len(streamed)} 次 (存活 {streamed.count('normal')})")
+    
+    return (counts == {'normal': 20, 'banned': 20, 'frozen': 0, 'unknown': 1}
+            and state['peak'] <= 5 and len(loop_threads) == 1 and progress[-1] == len(accounts)
+            and len(streamed) == len(accounts) and streamed.count('normal') == 20)
+
+
+def test_adaptive_concurrency():
+    """测试自适应并发：超过承受能力时触发 FloodWait，并发应收敛到承受能力附近"""
+    print("\n" + "=" * 60)
+    print("测试自适应并发 / Testing Adaptive Concurrency")
+    print("=" * 60)
+    
+    import asyncio
+    
+    capacity = 8
+    batch = BatchDetector(0, '', max_workers=50, initial_workers=2, latency_target=0.05)
+    state = {'running': 0, 'peak': 0, 'floods': 0}
+    
+    async def fake_check(session_file, json_file, max_proxy_retries=2, events=None, timings=None):
+        state['running'] += 1
+        state['peak'] = max(state['peak'], state['running'])
+        try:
+            await asyncio.sleep(0.01)
+            if state['running'] > capacity:
+                state['floods'] += 1
+                events.append('flood')
+                return 'unknown', 'flood', None
+            return 'normal', 'ok', None
+        finally:
+            state['running'] -= 1
+    
+    batch.detector.check_account_detail = fake_check
+    accounts = [{'phone': f'+{i}', 'session': f's_{i}', 'json': f'j_{i}'} for i in range(600)]
+    results = batch.detect_accounts(accounts)
+    limiter = batch.limiter.stats()
+    
+    print(f"✅ 最终并发: {limiter['limit']} (承受能力 {capacity}, 上限 {limiter['maximum']})")
+    print(f"   峰值并发: {state['peak']}, 上调 {limiter['increases']} 次, 下调 {limiter['decreases']} 次")
+    print(f"   FloodWait: {state['floods']}/{len(accounts)}")
+    
+    return (len(results['normal']) + len(results['unknown']) == len(accounts)
+            and state['peak'] > capacity and limiter['decreases'] > 0
+            and limiter['limit'] <= capacity * 2 and state['floods'] < len(accounts) // 4)
+
+
+def test_stage_metrics():
+    """测试检测阶段耗时统计（用模拟的 TelegramClient 走完整检测流程）"""
+    print("\n" + "=" * 60)
+    print("测试阶段耗时统计 / Testing Stage Metrics")
+    print("=" * 60)
+    
+    import asyncio
+    import tempfile
+    import account_detector
+    from telethon.crypto import AuthKey
+    from telethon.sessions import SQLiteSession
+    from account_detector import LatencyHistogram, detection_metrics
+    
+    histogram = LatencyHistogram()
+    for i in range(100):
+        histogram.observe(i / 100)
+    p50, p95 = histogram.quantile(0.5), histogram.quantile(0.95)
+    print(f"✅ 直方图: p50 {p50:.2f}s p95 {p95:.2f}s (实际约 0.50 / 0.95)")
+    
+    class FakeMessage:
+        async def delete(self):
+            await asyncio.sleep(0.01)
+    
+    class FakeClient:
+        def __init__(self, session, *args, **kwargs):
+            self.session = session
+        
+        async def connect(self):
+            await asyncio.sleep(0.05)
+        
+        async def is_user_authorized(self):
+            return True
+        
+        async def get_me(self):
+            return object()
+        
+        async def send_message(self, entity, text):
+            if self.session.dc_id == 5:
+                await asyncio.sleep(20)  # 超过 10 秒发送超时
+            return FakeMessage()
+        
+        async def disconnect(self):
+            pass
+    
+    original_client = account_detector.TelegramClient
+    account_detector.TelegramClient = FakeClient
+    detection_metrics.reset()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            accounts = []
+            for i, dc in enumerate((4, 4, 5)):
+                base = os.path.join(tmp, f'+86138000000{i}')
+                session = SQLiteSession(base)
+                session.set_dc(dc, '149.154.167.91', 443)
+                session.auth_key = AuthKey(data=os.urandom(256))
+                session.save()
+                session.close()
+                accounts.append({'phone': f'+{i}', 'session': base, 'json': base + '.json'})
+            
+            batch = BatchDetector(0, '', max_workers=5, account_timeout=15)
+            results = batch.detect_accounts(accounts)
+    finally:
+        account_detector.TelegramClient = original_client
+    
+    stages = {item['stage']: item for item in detection_metrics.snapshot()}
+    by_dc = {(item['dc'], item['stage']): item for item in detection_metrics.snapshot('dc')}
+    for line in detection_metrics.summary_lines():
+        print(f"   {line}")
+    
+    send = stages.get('send_message', {})
+    return (len(results['normal']) == 2 and len(results['unknown']) == 1
+            and stages['connect']['count'] == 3 and stages['connect']['p50'] >= 0.05
+            and send.get('outcomes') == {'ok': 2, 'timeout': 1}
+            and by_dc[('DC5', 'send_message')]['outcomes'] == {'timeout': 1}
+            and by_dc[('DC4', 'delete_message')]['count'] == 2
+            and 0.45 <= p50 <= 0.55 and 0.9 <= p95 <= 1.0)
+
+
+def test_reserve_skips_bad_health():
+    """测试预留库存跳过最近检测为坏号的账号（需要可连接的 MongoDB，未配置时跳过）"""
+    print("\n" + "=" * 60)
+    print("测试坏号不再预留 / Testing Reserve Skips Bad Accounts")
+    print("=" * 60)
+    
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        import pymongo
+        from datetime import datetime, timedelta
+        from mongo import hb, hb_stock, reserve_stock, MONGO_URI, HEALTHY_STOCK_FILTER
+        pymongo.MongoClient(MONGO_URI, serverSelectionTimeoutMS=2000).admin.command('ping')
+    except Exception as e:
+        print(f"⚠️  跳过（MongoDB 不可用: {e}）")
+        return True
+    
+    nowuid = f'test_reserve_{os.getpid()}'
+    now = datetime.now()
+    docs = [
+        # 刚检测为冻结/封禁的账号检测时间最新，不加筛选时会被优先取到
+        {'projectname': 'frozen', 'health': {'status': 'frozen', 'checked_at': now}},
+        {'projectname': 'banned', 'health': {'status': 'banned', 'checked_at': now}},
+        {'projectname': 'normal', 'health': {'status': 'normal', 'checked_at': now - timedelta(minutes=5)}},
+        {'projectname': 'unchecked'},
+    ]
+    try:
+        hb.insert_many([dict(doc, nowuid=nowuid, state=0, leixing='协议号') for doc in docs])
+        _, reserved = reserve_stock(nowuid, 2, extra_filter=HEALTHY_STOCK_FILTER, sort=[('health.checked_at', -1)])
+        _, more = reserve_stock(nowuid, 2, extra_filter=HEALTHY_STOCK_FILTER, sort=[('health.checked_at', -1)])
+        names = [doc['projectname'] for doc in reserved]
+        print(f"✅ 第一次预留: {names}, 再次预留: {[doc['projectname'] for doc in more]}")
+        return names == ['normal', 'unchecked'] and not more
+    finally:
+        hb.delete_many({'nowuid': nowuid})
+        hb_stock.delete_many({'nowuid': nowuid})
+
+
 def test_configuration():
     """测试配置"""
     print("\n" + "=" * 60)
@@ -165,7 +460,49 @@ def main():
         print(f"❌ 关键词匹配测试失败: {e}")
         results.append(("Keyword Matching", False))
     
-    # Test 3: Configuration
+    # Test 3: Proxy Pool
+    try:
+        results.append(("Proxy Pool", test_proxy_pool()))
+    except Exception as e:
+        print(f"❌ 代理池测试失败: {e}")
+        results.append(("Proxy Pool", False))
+    
+    # Test 4: Session Loading
+    try:
+        results.append(("Session Loading", test_session_loading()))
+    except Exception as e:
+        print(f"❌ Session加载测试失败: {e}")
+        results.append(("Session Loading", False))
+    
+    # Test 5: Batch Concurrency
+    try:
+        results.append(("Batch Concurrency", test_batch_concurrency()))
+    except Exception as e:
+        print(f"❌ 批量检测并发测试失败: {e}")
+        results.append(("Batch Concurrency", False))
+    
+    # Test 6: Adaptive Concurrency
+    try:
+        results.append(("Adaptive Concurrency", test_adaptive_concurrency()))
+    except Exception as e:
+        print(f"❌ 自适应并发测试失败: {e}")
+        results.append(("Adaptive Concurrency", False))
+    
+    # Test 7: Stage Metrics
+    try:
+        results.append(("Stage Metrics", test_stage_metrics()))
+    except Exception as e:
+        print(f"❌ 阶段耗时统计测试失败: {e}")
+        results.append(("Stage Metrics", False))
+    
+    # Test 8: Reserve Skips Bad Accounts
+    try:
+        results.append(("Reserve Filter", test_reserve_skips_bad_health()))
+    except Exception as e:
+        print(f"❌ 坏号预留测试失败: {e}")
+        results.append(("Reserve Filter", False))
+    
+    # Test 9: Configuration
     try:
         results.append(("Configuration", test_configuration()))
     except Exception as e:
@@ -1,6 +1,7 @@
 import os
 import re
 import json
+import html
 import uuid
 import time
 import qrcode
@@ -9,7 +10,6 @@ import pickle
 import socket
 import random
 import struct
-import zipfile
 import logging
 import hashlib
 import threading
@@ -75,6 +75,16 @@ from mongo import *
 from mongo import topup, user, withdrawal_requests
 from utils import create_easypay_url, create_payment_with_qrcode
 from pay_server import start_flask_server
+from db_indexes import ensure_indexes, find_collscans, format_index_report
+from ingest import enqueue_ingest_job, start_ingest_workers
+from account_pack import order_zip_artifact, text_artifact, file_artifact, discard_account_blobs
+from delivery import (
+    enqueue_delivery_job, mark_delivery_packaged, start_delivery_workers, retry_delivery_job, format_delivery_report,
+    send_cached_document
+)
+from product_search import search_products
+from tdata_cache import start_tdata_converter, format_tdata_converter_stats
+from account_store import release_account_files, migrate_legacy_accounts
 
 # 导入代理管理模块（合并后的单文件）
 from bot_agent import (
@@ -618,20 +628,21 @@ def inline_query(update: Update, context: CallbackContext):
     # 商品分享卡片（根据 nowuid）
     if query.startswith("share_"):
         nowuid = query.replace("share_", "")
-        product = ejfl.find_one({'nowuid': nowuid})
+        catalog = get_catalog()
+        product = catalog.product(nowuid)
         if not product:
             return
 
         pname = product.get('projectname', '未知商品')
         price = float(product.get('money', 0))
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+        stock = get_product_stock(nowuid)
         desc = product.get('desc', '暂无商品说明')
 
         # 获取一级分类名
         uid = product.get('uid')
         cate_name = '未知分类'
         if uid:
-            cate = fenlei.find_one({'uid': uid})
+            cate = catalog.category(uid)
             if cate:
                 cate_name = cate.get('projectname', '未知分类')
 
@@ -1585,6 +1596,8 @@ def diag_db(update: Update, context: CallbackContext):
 <b>⏰ 系统时间</b>
 • 当前时间: {beijing_now_str()}
 
+{format_index_report()}
+
 <b>ℹ️ 说明</b>
 此命令用于诊断数据库连接和配置。
 """
@@ -1828,16 +1841,15 @@ def sales_dashboard(update: Update, context: CallbackContext):
     week_orders, week_customers, week_categories = get_sales_stats(week_start, now)
     month_orders, month_customers, month_categories = get_sales_stats(month_start, now)
 
-    # 热销商品Top5 - 修复版：统计实际商品销量
-    all_orders = list(gmjlu.find())
-    product_count = {}
-    for order in all_orders:
-        product = order.get('projectname', '未知商品')
-        count = order.get('count', 1)
-        if product != '点击按钮修改':  # 过滤掉测试数据
-            product_count[product] = product_count.get(product, 0) + count
-    
-    top_products = sorted(product_count.items(), key=lambda x: x[1], reverse=True)[:5]
+    # 热销商品Top5 - 读取销量排行榜（累计销量）
+    catalog = get_catalog()
+    top_products = []
+    for nowuid, count in get_top_sellers('all', 10):
+        product = catalog.product(nowuid)
+        name = product.get('projectname', '未知商品') if product else '已删除商品'
+        if name != '点击按钮修改':  # 过滤掉测试数据
+            top_products.append((name, count))
+    top_products = top_products[:5]
 
     # 获取库存统计 - 基于真实数据结构
     available_stock = hb.count_documents({'state': 0})  # 可用库存
@@ -4176,22 +4188,14 @@ def search_goods(update: Update, context: CallbackContext):
         update.message.reply_text(msg)
         return
 
-    matched = list(ejfl.find({'projectname': {'$regex': query, '$options': 'i'}}))
+    # ✅ 只返回有库存、分类未被删除的商品
+    matched = search_products(query, limit=None, in_stock_only=True)
     buttons = []
     count = 0
 
-    for item in matched:
+    for item, stock in matched:
         nowuid = item['nowuid']
 
-        # ✅ 排除分类被删除的商品
-        if not fenlei.find_one({'uid': item['uid']}):
-            continue
-
-        # ✅ 排除无库存商品
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
-        if stock <= 0:
-            continue
-
         # ✅ 排除未设置价格的商品
         money = item.get('money', 0)
         if money <= 0:
@@ -4225,27 +4229,34 @@ def hot_goods(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     user_lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
 
-    sorted_items = sorted(
-        ejfl.find(),
-        key=lambda item: -hb.count_documents({'nowuid': item['nowuid'], 'state': 0})
-    )
+    # 🛑 如果分类被删了，就跳过
+    catalog = get_catalog()
+    items = catalog.listed_products()
+    stock_map = get_stock_map([item['nowuid'] for item in items])
+
+    # 近7天实际销量排序，销量不足10个时按库存补齐
+    ranked = [catalog.product(nowuid) for nowuid, _ in get_top_sellers('7d', 50)]
+    ranked += sorted(items, key=lambda item: -stock_map.get(item['nowuid'], 0))
 
     buttons = []
+    shown = set()
 
-    for item in sorted_items[:10]:
-        nowuid = item['nowuid']
-        # 🛑 如果分类被删了，就跳过
-        if not fenlei.find_one({'uid': item['uid']}):
+    for item in ranked:
+        if len(buttons) >= 10:
+            break
+        if not item or item['nowuid'] in shown or not catalog.category(item.get('uid')):
             continue
+        nowuid = item['nowuid']
+        stock = stock_map.get(nowuid, 0)
 
-        # ✅ 跳过未设置价格的商品
+        # ✅ 跳过未设置价格、无库存的商品
         money = item.get('money', 0)
-        if money <= 0:
+        if money <= 0 or stock <= 0:
             continue
 
+        shown.add(nowuid)
         pname = item['projectname']
         pname = get_fy(pname) if user_lang == 'en' else pname
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
         buttons.append([InlineKeyboardButton(f"🛒 {pname}", callback_data=f"gmsp {nowuid}:{stock}")])
 
     buttons.append([InlineKeyboardButton("❌ 关闭" if user_lang == 'zh' else "❌ Close", callback_data=f"close {user_id}")])
@@ -4266,12 +4277,13 @@ def new_goods(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     user_lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
 
-    latest_items = list(ejfl.find().sort([('_id', -1)]).limit(10))
+    catalog = get_catalog()
+    latest_items = sorted(catalog.products, key=lambda item: item['_id'], reverse=True)[:10]
     buttons = []
 
     for item in latest_items:
         nowuid = item['nowuid']
-        if not fenlei.find_one({'uid': item['uid']}):
+        if not catalog.category(item['uid']):
             continue
 
         # ✅ 跳过未设置价格的商品
@@ -4281,7 +4293,7 @@ def new_goods(update: Update, context: CallbackContext):
 
         pname = item['projectname']
         pname = get_fy(pname) if user_lang == 'en' else pname
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+        stock = get_product_stock(nowuid)
         buttons.append([InlineKeyboardButton(f"🛒 {pname}", callback_data=f"gmsp {nowuid}:{stock}")])
 
     buttons.append([InlineKeyboardButton("❌ 关闭" if user_lang == 'zh' else "❌ Close", callback_data=f"close {user_id}")])
@@ -5137,18 +5149,30 @@ def zcfshuo(update: Update, context: CallbackContext):
         # ✅ 检查是否是有效的文件路径
         import os
         try:
-            # 如果text字段不包含路径分隔符或文件扩展名，可能是错误的数据
-            if not ('/' in zip_filename or '\\' in zip_filename or '.' in zip_filename):
-                error_msg = f"❌ 记录数据异常，请联系管理员：{zip_filename}" if lang == 'zh' else f"❌ Record data error, please contact admin: {zip_filename}"
-                context.bot.send_message(chat_id=user_id, text=error_msg)
-                return
-                
-            if os.path.exists(zip_filename):
-                with open(zip_filename, "rb") as f:
-                    query.message.reply_document(f)
-            else:
-                error_msg = f"❌ 文件不存在：{zip_filename}" if lang == 'zh' else f"❌ File not found: {zip_filename}"
-                context.bot.send_message(chat_id=user_id, text=error_msg)
+            file_id = gmjlu_list.get('file_id')
+            if file_id is None and gmjlu_list.get('accounts') is None:
+                # 如果text字段不包含路径分隔符或文件扩展名，可能是错误的数据
+                if not ('/' in zip_filename or '\\' in zip_filename or '.' in zip_filename):
+                    error_msg = f"❌ 记录数据异常，请联系管理员：{zip_filename}" if lang == 'zh' else f"❌ Record data error, please contact admin: {zip_filename}"
+                    context.bot.send_message(chat_id=user_id, text=error_msg)
+                    return
+                if not os.path.exists(zip_filename):
+                    error_msg = f"❌ 文件不存在：{zip_filename}" if lang == 'zh' else f"❌ File not found: {zip_filename}"
+                    context.bot.send_message(chat_id=user_id, text=error_msg)
+                    return
+
+            def build_artifact():
+                # 记录了账号列表的订单按账号重新打包，旧订单读取当时保存的压缩包
+                if gmjlu_list.get('accounts') is not None:
+                    root = './协议号' if leixing == '协议号' else './号包'
+                    return order_zip_artifact(leixing, root, gmjlu_list.get('nowuid'), gmjlu_list['accounts'],
+                                              os.path.basename(zip_filename))
+                return file_artifact(zip_filename)
+
+            # 优先复用已上传的 file_id，失效时才重新打包上传
+            new_file_id = send_cached_document(context.bot, user_id, file_id, build_artifact)
+            if new_file_id and new_file_id != file_id:
+                gmjlu.update_one({'bianhao': bianhao}, {'$set': {'file_id': new_file_id}})
         except Exception as e:
             error_msg = f"❌ 发送文件失败：{str(e)}" if lang == 'zh' else f"❌ Failed to send file: {str(e)}"
             context.bot.send_message(chat_id=user_id, text=error_msg)
@@ -5290,6 +5314,54 @@ def generate_24bit_uid():
     return hashed_uid[:24]
 
 
+def send_product_admin_panel(bot, user_id, nowuid):
+    """发送二级分类（商品）管理面板"""
+    ej_list = ejfl.find_one({'nowuid': nowuid})
+    uid = ej_list['uid']
+    money = ej_list['money']
+    ej_projectname = ej_list['projectname']
+    fl_pro = fenlei.find_one({'uid': uid})['projectname']
+    keyboard = [
+        [InlineKeyboardButton('取出所有库存', callback_data=f'qchuall {nowuid}'),
+         InlineKeyboardButton('此商品使用说明', callback_data=f'update_sysm {nowuid}')],
+        [InlineKeyboardButton('上传谷歌账户', callback_data=f'update_gg {nowuid}'),
+         InlineKeyboardButton('购买此商品提示', callback_data=f'update_wbts {nowuid}')],
+        [InlineKeyboardButton('上传链接', callback_data=f'update_hy {nowuid}'),
+         InlineKeyboardButton('上传txt文件', callback_data=f'update_txt {nowuid}')],
+        [InlineKeyboardButton('上传号包', callback_data=f'update_hb {nowuid}'),
+         InlineKeyboardButton('上传协议号', callback_data=f'update_xyh {nowuid}')],
+        [InlineKeyboardButton('修改二级分类名', callback_data=f'upejflname {nowuid}'),
+         InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
+        [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
+    ]
+    stock_counts = get_stock_counts(nowuid)
+    kc, ys = stock_counts['available'], stock_counts['sold']
+    fstext = f'''
+主分类: {fl_pro}
+二级分类: {ej_projectname}
+
+价格: {money}U
+库存: {kc}
+已售: {ys}
+    '''
+    bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def ingest_job_done(bot, job, count):
+    """后台入库任务完成回调：通知管理员并重新发送商品管理面板"""
+    done_texts = {
+        'hb': f'🎉 解压并处理完成！本次上传了 {count} 个号包',
+        'txt': f'处理完成！本次上传了{count}个api链接',
+        'xyh': f'解压并处理完成！本次上传了{count}个协议号',
+    }
+    user_id = job['chat_id']
+    try:
+        bot.send_message(chat_id=user_id, text=done_texts.get(job['kind'], f'入库完成，本次上传了{count}个'))
+        send_product_admin_panel(bot, user_id, job['nowuid'])
+    except Exception as e:
+        logging.error(f"❌ 发送入库结果失败：job_id={job['job_id']} - {e}")
+
+
 def newfl(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
@@ -5369,6 +5441,7 @@ def create_product(ejfl, projectname, price, uid):
         "leixing": category  # 添加分类字段
     }
     ejfl.insert_one(product)
+    bump_catalog_version()
     
     return nowuid
 
@@ -5411,8 +5484,9 @@ def fejxxi(update: Update, context: CallbackContext):
         [InlineKeyboardButton('返回', callback_data=f'flxxi {uid}')]
     ]
 
-    kc = hb.count_documents({'nowuid': nowuid, 'state': 0})
-    ys = hb.count_documents({'nowuid': nowuid, 'state': 1})
+    stock_counts = get_stock_counts(nowuid)
+
+    kc, ys = stock_counts['available'], stock_counts['sold']
 
     fstext = f'''
 主分类: {fl_pro}
@@ -6206,26 +6280,25 @@ def catejflsp(update: Update, context: CallbackContext):
     lang = user_data.get('lang', 'zh')
 
     # 获取所有二级分类并根据库存排序，只显示有库存的商品
-    ej_list = ejfl.find({'uid': uid})
+    ej_list = get_catalog().category_products(uid)
+    stock_map = get_stock_map([item['nowuid'] for item in ej_list])
     
-    # ✅ 功能1：只显示有库存的商品
+    # ✅ 功能1：只显示有库存的商品（快照中的文档只读，库存单独存放）
     filtered_ej_list = []
     for item in ej_list:
-        stock_count = hb.count_documents({'nowuid': item['nowuid'], 'state': 0})
+        stock_count = stock_map.get(item['nowuid'], 0)
         if stock_count > 0:  # 只添加有库存的商品
-            item['stock_count'] = stock_count
-            filtered_ej_list.append(item)
+            filtered_ej_list.append((item, stock_count))
     
     # 按库存数量降序排列（库存多的在前面）
-    sorted_ej_list = sorted(filtered_ej_list, key=lambda x: -x['stock_count'])
+    sorted_ej_list = sorted(filtered_ej_list, key=lambda x: -x[1])
 
     keyboard = []
 
-    for i in sorted_ej_list:
+    for i, hsl in sorted_ej_list:
         nowuid = i['nowuid']
         projectname = i['projectname']
         money = i.get('money', 0)
-        hsl = i['stock_count']  # 使用预先计算的库存数量
 
         # ✅ 跳过未设置价格的商品
         if money <= 0:
@@ -6288,7 +6361,7 @@ def gmsp(update: Update, context: CallbackContext, nowuid=None, hsl="1"):
     u = user.find_one({'user_id': user_id})
     lang = u.get('lang', 'zh') if u else 'zh'
 
-    ejfl_list = ejfl.find_one({'nowuid': nowuid})
+    ejfl_list = get_catalog().product(nowuid)
     if not ejfl_list:
         return send_func("❌ 未找到该商品")
 
@@ -6302,7 +6375,7 @@ def gmsp(update: Update, context: CallbackContext, nowuid=None, hsl="1"):
         return send_func(error_msg)
 
     # ✅ 实时库存查询
-    stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+    stock = get_product_stock(nowuid)
 
     answer()
     if lang == 'zh':
@@ -6355,7 +6428,7 @@ def gmqq(update: Update, context: CallbackContext):
     nowuid = data.split(':')[0]
     hsl = data.split(':')[1]
 
-    ejfl_list = ejfl.find_one({'nowuid': nowuid})
+    ejfl_list = get_catalog().product(nowuid)
     if not ejfl_list:
         query.answer("❌ 未找到该商品", show_alert=True)
         return
@@ -6398,7 +6471,7 @@ def sysming(update: Update, context: CallbackContext):
     nowuid = query.data.replace('sysming ', '')
 
     # 🧾 查找对应数据
-    ejfl_list = ejfl.find_one({'nowuid': nowuid})
+    ejfl_list = get_catalog().product(nowuid)
 
     if ejfl_list and 'sysm' in ejfl_list:
         sysm = ejfl_list['sysm']
@@ -6476,6 +6549,7 @@ def ejfpaixu(update: Update, context: CallbackContext):
         ejfl.update_many({"row": row + 1, 'uid': uid}, {"$set": {'row': 99}})
         ejfl.update_many({"row": row, 'uid': uid}, {"$set": {'row': row + 1}})
         ejfl.update_many({"row": 99, 'uid': uid}, {"$set": {'row': row}})
+    bump_catalog_version()
 
     fl_pro = fenlei.find_one({'uid': uid})['projectname']
     keyboard = [[], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [],
@@ -6551,6 +6625,7 @@ def flpxyd(update: Update, context: CallbackContext):
         fenlei.update_many({"row": row + 1}, {"$set": {'row': 99}})
         fenlei.update_many({"row": row}, {"$set": {'row': row + 1}})
         fenlei.update_many({"row": 99}, {"$set": {'row': row}})
+    bump_catalog_version()
     keylist = list(fenlei.find({}, sort=[('row', 1)]))
     keyboard = [[], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [],
                 [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [],
@@ -6610,6 +6685,7 @@ def qrscejrow(update: Update, context: CallbackContext):
     for i in max_list:
         max_row = i['row']
         ejfl.update_many({'uid': uid, 'row': max_row}, {"$set": {"row": max_row - 1}})
+    bump_catalog_version()
 
     fl_pro = fenlei.find_one({'uid': uid})['projectname']
     keyboard = [[], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [],
@@ -6671,8 +6747,8 @@ def del_ejfl_open(update: Update, context: CallbackContext):
     fl_pro = fl_list['projectname'] if fl_list else '未知分类'
     
     # 统计库存和已售数量
-    kc = hb.count_documents({'nowuid': nowuid, 'state': 0})
-    ys = hb.count_documents({'nowuid': nowuid, 'state': 1})
+    stock_counts = get_stock_counts(nowuid)
+    kc, ys = stock_counts['available'], stock_counts['sold']
     
     # 显示确认提示
     stock_warning = '\n⚠️ 该分类下仍有库存，删除后库存将被清空！' if kc > 0 else ''
@@ -6738,6 +6814,7 @@ def del_ejfl_confirm(update: Update, context: CallbackContext):
     try:
         # 删除该分类下的所有库存 (hb表)
         hb_delete_result = hb.delete_many({'nowuid': nowuid})
+        reset_stock_counter(nowuid)
         logging.info(f"✅ 删除库存: nowuid={nowuid}, 数量={hb_delete_result.deleted_count}")
         
         # 删除该分类下的协议号 (xyh表)
@@ -6753,6 +6830,7 @@ def del_ejfl_confirm(update: Update, context: CallbackContext):
         for i in max_list:
             max_row = i['row']
             ejfl.update_many({'uid': uid, 'row': max_row}, {"$set": {"row": max_row - 1}})
+        bump_catalog_version()
         
         # 显示成功消息并返回上级分类页面
         fl_list = fenlei.find_one({'uid': uid})
@@ -6833,9 +6911,9 @@ def backzcd(update: Update, context: CallbackContext):
     user_id = query.from_user.id
     lang = user.find_one({'user_id': user_id})['lang']
 
-    fenlei_data = list(fenlei.find({}, sort=[('row', 1)]))
-    ejfl_data = list(ejfl.find({}))
-    hb_data = list(hb.find({'state': 0}))
+    catalog = get_catalog()
+    fenlei_data = catalog.categories
+    stock_map = get_stock_map()
 
     keyboard = [[] for _ in range(50)]
 
@@ -6845,8 +6923,7 @@ def backzcd(update: Update, context: CallbackContext):
         row = i['row']
 
         hsl = sum(
-            1 for j in ejfl_data if j['uid'] == uid
-            for hb_item in hb_data if hb_item['nowuid'] == j['nowuid']
+            stock_map.get(j['nowuid'], 0) for j in catalog.category_products(uid)
         )
 
         display_name = projectname if lang == 'zh' else get_fy(projectname)
@@ -6891,9 +6968,9 @@ def show_product_list(update: Update, context: CallbackContext):
     user_data = user.find_one({'user_id': user_id})
     lang = user_data.get('lang', 'zh')
 
-    fenlei_data = list(fenlei.find({}, sort=[('row', 1)]))
-    ejfl_data = list(ejfl.find({}))
-    hb_data = list(hb.find({'state': 0}))
+    catalog = get_catalog()
+    fenlei_data = catalog.categories
+    stock_map = get_stock_map()
 
     # ✅ 一级分类始终显示，显示库存数量（包括0）
     keyboard = []
@@ -6904,8 +6981,7 @@ def show_product_list(update: Update, context: CallbackContext):
         projectname = i['projectname']
         row = i['row']
         hsl = sum(
-            1 for j in ejfl_data if j['uid'] == uid
-            for hb_item in hb_data if hb_item['nowuid'] == j['nowuid']
+            stock_map.get(j['nowuid'], 0) for j in catalog.category_products(uid)
         )
         
         # ✅ 一级分类始终显示（不论库存多少）
@@ -6982,54 +7058,155 @@ def is_number(s):
 
     return False
 
-def dabaohao(context, user_id, folder_names, leixing, nowuid, erjiprojectname, fstext, yssj):
+def make_bianhao():
+    """订单编号：北京时间 + 时间戳"""
     current_time = get_beijing_now()
-    formatted_time = format_beijing_time(current_time, "%Y%m%d%H%M%S")
-    timestamp = str(current_time.timestamp()).replace(".", "")
-    bianhao = formatted_time + timestamp
+    return format_beijing_time(current_time, "%Y%m%d%H%M%S") + str(current_time.timestamp()).replace(".", "")
+
+
+def dabaohao(bot, user_id, folder_names, leixing, nowuid, erjiprojectname, fstext, yssj, bianhao=None):
+    """打包并发送订单（由发货工作线程调用，bianhao 即发货任务的订单号）"""
+    bianhao = bianhao or make_bianhao()
     timer = beijing_now_str()
     count = len(folder_names)
+    # 购买记录在下单时已和扣款一起写入（text 即压缩包文件名），这里只补充 file_id；
+    # 旧版本登记的任务没有购买记录，发货时补写
+    record = gmjlu.find_one({'bianhao': bianhao}, {'text': 1})
+    recorded = record is not None
 
     if leixing == '协议号':
-        zip_filename = f"./协议号发货/{user_id}_{int(time.time())}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file_name in folder_names:
-                json_file = os.path.join(f"./协议号/{nowuid}", file_name + ".json")
-                session_file = os.path.join(f"./协议号/{nowuid}", file_name + ".session")
-                if os.path.exists(json_file):
-                    zipf.write(json_file, os.path.basename(json_file))
-                if os.path.exists(session_file):
-                    zipf.write(session_file, os.path.basename(session_file))
-        goumaijilua(leixing, bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, count)
-        context.bot.send_document(chat_id=user_id, document=open(zip_filename, "rb"))
+        zip_filename = record['text'] if recorded else f"{user_id}_{int(time.time())}.zip"
+        if not recorded:
+            goumaijilua(leixing, bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, count, nowuid=nowuid,
+                        accounts=folder_names)
+        with order_zip_artifact(leixing, './协议号', nowuid, folder_names, zip_filename) as artifact:
+            mark_delivery_packaged(bianhao)
+            message = bot.send_document(chat_id=user_id, document=artifact.open(), filename=artifact.filename)
+        # 保存 file_id，重新下载时直接复用，不再重新上传
+        gmjlu.update_one({'bianhao': bianhao}, {'$set': {'file_id': message.document.file_id}})
 
     elif leixing == '直登号':
-        zip_filename = f"./发货/{user_id}_{int(time.time())}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for folder_name in folder_names:
-                base_path = os.path.join(f"./号包/{nowuid}", folder_name)
-                if os.path.exists(base_path):
-                    for root, dirs, files in os.walk(base_path):
-                        for file in files:
-                            full_path = os.path.join(root, file)
-                            rel_path = os.path.join(folder_name, os.path.relpath(full_path, base_path))
-                            zipf.write(full_path, rel_path)
-        goumaijilua(leixing, bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, count)
-        context.bot.send_document(chat_id=user_id, document=open(zip_filename, "rb"))
+        zip_filename = record['text'] if recorded else f"{user_id}_{int(time.time())}.zip"
+        if not recorded:
+            goumaijilua(leixing, bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, count, nowuid=nowuid,
+                        accounts=folder_names)
+        with order_zip_artifact(leixing, './号包', nowuid, folder_names, zip_filename) as artifact:
+            mark_delivery_packaged(bianhao)
+            message = bot.send_document(chat_id=user_id, document=artifact.open(), filename=artifact.filename)
+        # 保存 file_id，重新下载时直接复用，不再重新上传
+        gmjlu.update_one({'bianhao': bianhao}, {'$set': {'file_id': message.document.file_id}})
 
     elif leixing == 'API链接':
         link_text = '\n'.join(folder_names)
-        context.bot.send_message(chat_id=user_id, text=link_text)
-        goumaijilua(leixing, bianhao, user_id, erjiprojectname, link_text, fstext, timer, count)
+        bot.send_message(chat_id=user_id, text=link_text)
+        if not recorded:
+            goumaijilua(leixing, bianhao, user_id, erjiprojectname, link_text, fstext, timer, count, nowuid=nowuid)
 
     elif leixing == 'txt文本':
         content = '\n'.join(folder_names)
-        context.bot.send_message(chat_id=user_id, text=content)
-        goumaijilua(leixing, bianhao, user_id, erjiprojectname, content, fstext, timer, count)
+        bot.send_message(chat_id=user_id, text=content)
+        if not recorded:
+            goumaijilua(leixing, bianhao, user_id, erjiprojectname, content, fstext, timer, count, nowuid=nowuid)
 
     else:
-        context.bot.send_message(chat_id=user_id, text=f"❌ 未知商品类型：{leixing}")
+        bot.send_message(chat_id=user_id, text=f"❌ 未知商品类型：{leixing}")
+
 
+def deliver_shop_order(bot, job):
+    """发货任务处理器：总部机器人订单"""
+    payload = job['payload']
+    dabaohao(bot, job['user_id'], payload['accounts'], payload['leixing'], payload['nowuid'],
+             payload['projectname'], payload['fstext'], payload['timer'], bianhao=job['order_id'])
+
+
+def delivery_job_failed(bot, job, error):
+    """发货重试次数用尽：通知买家联系客服，并通知管理员处理"""
+    try:
+        bot.send_message(chat_id=job['user_id'],
+                         text=f"❌ 订单发货失败，订单号：{job['order_id']}\n请联系客服 {CUSTOMER_SERVICE} 处理")
+    except Exception as e:
+        logging.warning(f"Failed to notify user {job['user_id']} of delivery failure: {e}")
+    text = (f"❌ <b>发货失败</b>\n订单号: <code>{job['order_id']}</code>\n用户ID: <code>{job['user_id']}</code>\n"
+            f"错误: {str(error)[:200].replace('<', '').replace('>', '')}\n\n/delivery 查看任务，/delivery retry {job['order_id']} 重试")
+    for admin_id in get_admin_ids():
+        try:
+            bot.send_message(chat_id=admin_id, text=text, parse_mode='HTML')
+        except Exception as e:
+            logging.warning(f"Failed to send admin notification to {admin_id}: {e}")
+
+
+def delivery_status(update: Update, context: CallbackContext):
+    """发货任务状态：/delivery 查看，/delivery retry 订单号 重试失败任务"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    if len(context.args) == 2 and context.args[0] == 'retry':
+        order_id = context.args[1]
+        if retry_delivery_job(order_id):
+            update.message.reply_text(f"✅ 已重新加入发货队列：{order_id}")
+        else:
+            update.message.reply_text(f"❌ 未找到失败的发货任务：{order_id}")
+        return
+
+    try:
+        text = format_delivery_report()
+        converter_stats = format_tdata_converter_stats()
+        if converter_stats:
+            text += "\n\n" + converter_stats
+        update.message.reply_text(text, parse_mode='HTML')
+    except Exception as e:
+        update.message.reply_text(f"❌ 获取发货任务失败：{e}")
+        logging.error(f"Delivery report failed: {e}")
+
+
+def migrate_store(update: Update, context: CallbackContext):
+    """把旧平铺目录（./协议号、./号包）中的在售库存迁移到账号存储：/migrate_store [nowuid]"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    nowuid = context.args[0] if context.args else None
+    update.message.reply_text("⏳ 开始迁移旧库存文件到账号存储，完成后通知您")
+
+    def run():
+        try:
+            counts = [f"{leixing}: {migrate_legacy_accounts(leixing, nowuid=nowuid)} 个"
+                      for leixing in ('协议号', '直登号')]
+            context.bot.send_message(chat_id=user_id, text="✅ 迁移完成\n" + "\n".join(counts))
+        except Exception as e:
+            logging.error(f"Store migration failed: {e}")
+            context.bot.send_message(chat_id=user_id, text=f"❌ 迁移失败：{e}")
+
+    Thread(target=run, name='migrate_store', daemon=True).start()
+
+
+def health_report(update: Update, context: CallbackContext):
+    """各商品的售后检测质量：/health [nowuid]"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    nowuid = context.args[0] if context.args else None
+    stats = get_health_stats(nowuid)
+    if not stats:
+        update.message.reply_text("暂无检测记录")
+        return
+
+    names = {doc['nowuid']: doc.get('projectname', '') for doc in
+             ejfl.find({'nowuid': {'$in': [item['nowuid'] for item in stats]}}, {'nowuid': 1, 'projectname': 1})}
+    lines = [f"<b>🩺 检测质量</b>（缓存有效期 {HEALTH_CHECK_TTL} 秒）"]
+    for item in stats:
+        name = html.escape(names.get(item['nowuid']) or item['nowuid'])
+        lines.append(
+            f"\n{name}\n"
+            f"检测 {item['checks']} · ✅ {item['normal']} · ❌ {item['banned']} · ⚠️ {item['frozen']} · ❓ {item['unknown']}\n"
+            f"坏号率 {item['bad_rate'] * 100:.1f}% · 隔离中 {item['quarantined']}"
+        )
+    update.message.reply_text("\n".join(lines), parse_mode='HTML')
 
 
 def qrgaimai(update: Update, context: CallbackContext):
@@ -7059,7 +7236,7 @@ def qrgaimai(update: Update, context: CallbackContext):
         context.bot.send_message(chat_id=user_id, text=error_msg)
         return
     
-    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
+    kc = get_product_stock(nowuid)
     if kc < gmsl:
         kcbz = '当前库存不足' if lang == 'zh' else get_fy('当前库存不足')
         context.bot.send_message(chat_id=user_id, text=kcbz)
@@ -7079,6 +7256,18 @@ def qrgaimai(update: Update, context: CallbackContext):
         yijiprojectname = yiji_list['projectname']
         fstext = ejfl_list['text']
         fstext = fstext if lang == 'zh' else get_fy(fstext)
+
+        # 扣款前先原子预留库存，并发购买时同一账号只会被一个订单抢到
+        reserve_token, reserved_docs = reserve_stock(
+            nowuid, gmsl, owner_id=user_id,
+            extra_filter={'leixing': '谷歌'} if fhtype == '谷歌' else None
+        )
+        if len(reserved_docs) < gmsl:
+            release_reservation(nowuid, reserve_token)
+            kcbz = '当前库存不足' if lang == 'zh' else get_fy('当前库存不足')
+            context.bot.send_message(chat_id=user_id, text=kcbz)
+            return
+
         if fhtype == '协议号':
             zgje = user_list['zgje']
             zgsl = user_list['zgsl']
@@ -7094,20 +7283,19 @@ def qrgaimai(update: Update, context: CallbackContext):
             #     hb.update_one({'hbid': hbid},{"$set":{'state': 1, 'yssj': timer, 'gmid': user_id}})
             #     folder_names.append(projectname)
 
-            query_condition = {"nowuid": nowuid, "state": 0}
-
-            pipeline = [
-                {"$match": query_condition},
-                {"$limit": gmsl}
-            ]
-            cursor = hb.aggregate(pipeline)
-            document_ids = [doc['_id'] for doc in cursor]
-            cursor = hb.aggregate(pipeline)
-            folder_names = [doc['projectname'] for doc in cursor]
+            folder_names = [doc['projectname'] for doc in reserved_docs]
 
             timer = beijing_now_str()
-            update_data = {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}}
-            hb.update_many({"_id": {"$in": document_ids}}, update_data)
+            commit_reservation(nowuid, reserve_token, user_id, timer)
+
+            # 扣款和库存已提交，先写购买记录、登记发货任务再发消息，消息发送失败也不会漏发货或漏记录
+            bianhao = make_bianhao()
+            goumaijilua('协议号', bianhao, user_id, erjiprojectname, f"{user_id}_{int(time.time())}.zip", fstext, timer,
+                        gmsl, nowuid=nowuid, accounts=folder_names)
+            enqueue_delivery_job(bianhao, 'shop', 'shop', user_id, {
+                'leixing': '协议号', 'nowuid': nowuid, 'accounts': folder_names,
+                'projectname': erjiprojectname, 'fstext': fstext, 'timer': timer
+            })
 
             # timer = beijing_now_str()
             # update_data = {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}}
@@ -7130,8 +7318,6 @@ def qrgaimai(update: Update, context: CallbackContext):
                 except Exception as e:
                     logging.warning(f"Failed to send admin notification to {admin_id}: {e}")
 
-            Timer(1, dabaohao,
-                  args=[context, user_id, folder_names, '协议号', nowuid, erjiprojectname, fstext, timer]).start()
             # shijiancuo = int(time.time())
             # zip_filename = f"./协议号发货/{user_id}_{shijiancuo}.zip"
             # with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
@@ -7172,11 +7358,9 @@ def qrgaimai(update: Update, context: CallbackContext):
             context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML', disable_web_page_preview=True,
                                      reply_markup=InlineKeyboardMarkup(keyboard))
             folder_names = []
-            for j in list(hb.find({"nowuid": nowuid, 'state': 0, 'leixing': '谷歌'}, limit=gmsl)):
-                projectname = j['projectname']
-                hbid = j['hbid']
-                timer = beijing_now_str()
-                hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
+            timer = beijing_now_str()
+            commit_reservation(nowuid, reserve_token, user_id, timer)
+            for j in reserved_docs:
                 data = j['data']
                 us1 = data['账户']
                 us2 = data['密码']
@@ -7187,9 +7371,7 @@ def qrgaimai(update: Update, context: CallbackContext):
             folder_names = '\n'.join(folder_names)
 
             shijiancuo = int(time.time())
-            zip_filename = f"./谷歌发货/{user_id}_{shijiancuo}.txt"
-            with open(zip_filename, "w") as f:
-                f.write(folder_names)
+            txt_filename = f"{user_id}_{shijiancuo}.txt"
             current_time = get_beijing_now()
 
             # 将当前时间格式化为字符串（北京时间）
@@ -7201,9 +7383,10 @@ def qrgaimai(update: Update, context: CallbackContext):
             # 组合编号
             bianhao = formatted_time + timestamp
             timer = beijing_now_str()
-            goumaijilua('谷歌', bianhao, user_id, erjiprojectname, zip_filename, fstext, timer)
+            goumaijilua('谷歌', bianhao, user_id, erjiprojectname, folder_names, fstext, timer, gmsl, nowuid=nowuid)
 
-            query.message.reply_document(open(zip_filename, "rb"))
+            with text_artifact(folder_names, txt_filename) as artifact:
+                query.message.reply_document(artifact.open(), filename=artifact.filename)
 
             fstext = f'''
 用户: <a href="tg://user?id={user_id}">{fullname}</a> @{username}
@@ -7231,19 +7414,13 @@ def qrgaimai(update: Update, context: CallbackContext):
             context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML', disable_web_page_preview=True,
                                      reply_markup=InlineKeyboardMarkup(keyboard))
             folder_names = []
-            for j in list(hb.find({"nowuid": nowuid, 'state': 0}, limit=gmsl)):
-                projectname = j['projectname']
-                hbid = j['hbid']
-                timer = beijing_now_str()
-                hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
-                folder_names.append(projectname)
+            timer = beijing_now_str()
+            commit_reservation(nowuid, reserve_token, user_id, timer)
+            for j in reserved_docs:
+                folder_names.append(j['projectname'])
 
             shijiancuo = int(time.time())
-
-            zip_filename = f"./手机接码发货/{user_id}_{shijiancuo}.txt"
-            with open(zip_filename, "w") as f:
-                for folder_name in folder_names:
-                    f.write(folder_name + "\n")
+            txt_filename = f"{user_id}_{shijiancuo}.txt"
 
             current_time = get_beijing_now()
 
@@ -7257,9 +7434,10 @@ def qrgaimai(update: Update, context: CallbackContext):
             bianhao = formatted_time + timestamp
             timer = beijing_now_str()
             link_text = '\n'.join(folder_names)  # API链接内容应该是账号列表
-            goumaijilua('API链接', bianhao, user_id, erjiprojectname, link_text, fstext, timer)
+            goumaijilua('API链接', bianhao, user_id, erjiprojectname, link_text, fstext, timer, gmsl, nowuid=nowuid)
 
-            query.message.reply_document(open(zip_filename, "rb"))
+            with text_artifact(link_text + '\n', txt_filename) as artifact:
+                query.message.reply_document(artifact.open(), filename=artifact.filename)
 
             fstext = f'''
 用户: <a href="tg://user?id={user_id}">{fullname}</a> @{username}
@@ -7282,12 +7460,10 @@ def qrgaimai(update: Update, context: CallbackContext):
             user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
             del_message(query.message)
             folder_names = []
-            for j in list(hb.find({"nowuid": nowuid, 'state': 0}, limit=gmsl)):
-                projectname = j['projectname']
-                hbid = j['hbid']
-                timer = beijing_now_str()
-                hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
-                folder_names.append(projectname)
+            timer = beijing_now_str()
+            commit_reservation(nowuid, reserve_token, user_id, timer)
+            for j in reserved_docs:
+                folder_names.append(j['projectname'])
 
             context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML', disable_web_page_preview=True,
                                      reply_markup=InlineKeyboardMarkup(keyboard))
@@ -7305,7 +7481,7 @@ def qrgaimai(update: Update, context: CallbackContext):
             # 组合编号
             bianhao = formatted_time + timestamp
             timer = beijing_now_str()
-            goumaijilua('会员链接', bianhao, user_id, erjiprojectname, folder_names, fstext, timer, gmsl)
+            goumaijilua('会员链接', bianhao, user_id, erjiprojectname, folder_names, fstext, timer, gmsl, nowuid=nowuid)
 
 
 
@@ -7340,20 +7516,19 @@ def qrgaimai(update: Update, context: CallbackContext):
             #     hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
             #     folder_names.append(projectname)
 
-            query_condition = {"nowuid": nowuid, "state": 0}
-
-            pipeline = [
-                {"$match": query_condition},
-                {"$limit": gmsl}
-            ]
-            cursor = hb.aggregate(pipeline)
-            document_ids = [doc['_id'] for doc in cursor]
-            cursor = hb.aggregate(pipeline)
-            folder_names = [doc['projectname'] for doc in cursor]
+            folder_names = [doc['projectname'] for doc in reserved_docs]
 
             timer = beijing_now_str()
-            update_data = {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}}
-            hb.update_many({"_id": {"$in": document_ids}}, update_data)
+            commit_reservation(nowuid, reserve_token, user_id, timer)
+
+            # 扣款和库存已提交，先写购买记录、登记发货任务再发消息，消息发送失败也不会漏发货或漏记录
+            bianhao = make_bianhao()
+            goumaijilua('直登号', bianhao, user_id, erjiprojectname, f"{user_id}_{int(time.time())}.zip", fstext, timer,
+                        gmsl, nowuid=nowuid, accounts=folder_names)
+            enqueue_delivery_job(bianhao, 'shop', 'shop', user_id, {
+                'leixing': '直登号', 'nowuid': nowuid, 'accounts': folder_names,
+                'projectname': erjiprojectname, 'fstext': fstext, 'timer': timer
+            })
 
             context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML', disable_web_page_preview=True,
                                      reply_markup=InlineKeyboardMarkup(keyboard))
@@ -7372,8 +7547,6 @@ def qrgaimai(update: Update, context: CallbackContext):
                 except Exception as e:
                     logging.warning(f"Failed to send admin notification to {admin_id}: {e}")
 
-            Timer(1, dabaohao,
-                  args=[context, user_id, folder_names, '直登号', nowuid, erjiprojectname, fstext, timer]).start()
             # shijiancuo = int(time.time())
             # zip_filename = f"./发货/{user_id}_{shijiancuo}.zip"
             # with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
@@ -7439,25 +7612,16 @@ def qchuall(update: Update, context: CallbackContext):
 
     folder_names = []
     if fhtype == '协议号':
-        for j in list(hb.find({"nowuid": nowuid, 'state': 0})):
-            projectname = j['projectname']
-            hbid = j['hbid']
-            timer = beijing_now_str()
-            hb.delete_one({'hbid': hbid})
-            folder_names.append(projectname)
+        # 先打包再删除记录：未预打包的账号需要按记录查找账号存储中的文件
+        docs = list(hb.find({"nowuid": nowuid, 'state': 0}))
+        folder_names = [j['projectname'] for j in docs]
         shijiancuo = int(time.time())
-        zip_filename = f"./协议号发货/{user_id}_{shijiancuo}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            # 将每个文件及其内容添加到 zip 文件中
-            for file_name in folder_names:
-                # 检查是否存在以 .json 或 .session 结尾的文件
-                json_file_path = os.path.join(f"./协议号/{nowuid}", file_name + ".json")
-                session_file_path = os.path.join(f"./协议号/{nowuid}", file_name + ".session")
-                if os.path.exists(json_file_path):
-                    zipf.write(json_file_path, os.path.basename(json_file_path))
-                if os.path.exists(session_file_path):
-                    zipf.write(session_file_path, os.path.basename(session_file_path))
-        query.message.reply_document(open(zip_filename, "rb"))
+        with order_zip_artifact(fhtype, './协议号', nowuid, folder_names, f"{user_id}_{shijiancuo}.zip") as artifact:
+            query.message.reply_document(artifact.open(), filename=artifact.filename)
+        hb.delete_many({'_id': {'$in': [j['_id'] for j in docs]}})
+        stock_counter_inc(nowuid, available=-len(folder_names))
+        discard_account_blobs('./协议号', nowuid, folder_names)
+        release_account_files(docs)
 
     elif fhtype == 'API':
         for j in list(hb.find({"nowuid": nowuid, 'state': 0})):
@@ -7466,15 +7630,13 @@ def qchuall(update: Update, context: CallbackContext):
             timer = beijing_now_str()
             hb.delete_one({'hbid': hbid})
             folder_names.append(projectname)
+        stock_counter_inc(nowuid, available=-len(folder_names))
 
         shijiancuo = int(time.time())
 
-        zip_filename = f"./手机接码发货/{user_id}_{shijiancuo}.txt"
-        with open(zip_filename, "w") as f:
-            for folder_name in folder_names:
-                f.write(folder_name + "\n")
-
-        query.message.reply_document(open(zip_filename, "rb"))
+        with text_artifact(''.join(folder_name + "\n" for folder_name in folder_names),
+                           f"{user_id}_{shijiancuo}.txt") as artifact:
+            query.message.reply_document(artifact.open(), filename=artifact.filename)
 
     elif fhtype == '谷歌':
         for j in list(hb.find({"nowuid": nowuid, 'state': 0, 'leixing': '谷歌'})):
@@ -7489,15 +7651,12 @@ def qchuall(update: Update, context: CallbackContext):
             fste23xt = f'login: {us1}\npassword: {us2}\nsubmail: {us3}\n'
             hb.delete_one({'hbid': hbid})
             folder_names.append(fste23xt)
+        stock_counter_inc(nowuid, available=-len(folder_names))
         folder_names = '\n'.join(folder_names)
         shijiancuo = int(time.time())
 
-        zip_filename = f"./谷歌发货/{user_id}_{shijiancuo}.txt"
-        with open(zip_filename, "w") as f:
-
-            f.write(folder_names)
-
-        query.message.reply_document(open(zip_filename, "rb"))
+        with text_artifact(folder_names, f"{user_id}_{shijiancuo}.txt") as artifact:
+            query.message.reply_document(artifact.open(), filename=artifact.filename)
 
 
     elif fhtype == '会员链接':
@@ -7507,36 +7666,20 @@ def qchuall(update: Update, context: CallbackContext):
             timer = beijing_now_str()
             hb.delete_one({'hbid': hbid})
             folder_names.append(projectname)
+        stock_counter_inc(nowuid, available=-len(folder_names))
         folder_names = '\n'.join(folder_names)
 
         context.bot.send_message(chat_id=user_id, text=folder_names, disable_web_page_preview=True)
     else:
-        for j in list(hb.find({"nowuid": nowuid, 'state': 0})):
-            projectname = j['projectname']
-            hbid = j['hbid']
-            timer = beijing_now_str()
-            hb.delete_one({'hbid': hbid})
-            folder_names.append(projectname)
-
+        docs = list(hb.find({"nowuid": nowuid, 'state': 0}))
+        folder_names = [j['projectname'] for j in docs]
         shijiancuo = int(time.time())
-        zip_filename = f"./发货/{user_id}_{shijiancuo}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            # 将每个文件夹及其内容添加到 zip 文件中
-            for folder_name in folder_names:
-                full_folder_path = os.path.join(f"./号包/{nowuid}", folder_name)
-                if os.path.exists(full_folder_path):
-                    # 添加文件夹及其内容
-                    for root, dirs, files in os.walk(full_folder_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            # 使用相对路径在压缩包中添加文件，并设置压缩包内部的路径
-                            zipf.write(file_path,
-                                       os.path.join(folder_name, os.path.relpath(file_path, full_folder_path)))
-                else:
-                    # update.message.reply_text(f"文件夹 '{folder_name}' 不存在！")
-                    pass
-
-        query.message.reply_document(open(zip_filename, "rb"))
+        with order_zip_artifact('直登号', './号包', nowuid, folder_names, f"{user_id}_{shijiancuo}.zip") as artifact:
+            query.message.reply_document(artifact.open(), filename=artifact.filename)
+        hb.delete_many({'_id': {'$in': [j['_id'] for j in docs]}})
+        stock_counter_inc(nowuid, available=-len(folder_names))
+        discard_account_blobs('./号包', nowuid, folder_names)
+        release_account_files(docs)
 
     ej_list = ejfl.find_one({'nowuid': nowuid})
     uid = ej_list['uid']
@@ -7556,8 +7699,8 @@ def qchuall(update: Update, context: CallbackContext):
          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
     ]
-    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
+    stock_counts = get_stock_counts(nowuid)
+    kc, ys = stock_counts['available'], stock_counts['sold']
     fstext = f'''
 主分类: {fl_pro}
 二级分类: {ej_projectname}
@@ -7965,7 +8108,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                     projectname = ejfl_list['projectname']
                     money = ejfl_list['money']
                     uid = ejfl_list['uid']
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
+                    kc = get_product_stock(nowuid)
                     if is_number(text):
                         gmsl = int(text)
                         
@@ -8054,6 +8197,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                         nowuid = sign.replace('upmoney ', '')
                         money = float(text) if text.count('.') > 0 else int(text)
                         ejfl.update_one({"nowuid": nowuid}, {"$set": {"money": money}})
+                        bump_catalog_version()
                         user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
 
                         ej_list = ejfl.find_one({'nowuid': nowuid})
@@ -8074,8 +8218,8 @@ def textkeyboard(update: Update, context: CallbackContext):
                              InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                             [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                         ]
-                        kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                        ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
+                        stock_counts = get_stock_counts(nowuid)
+                        kc, ys = stock_counts['available'], stock_counts['sold']
                         fstext = f'''
 主分类: {fl_pro}
 二级分类: {ej_projectname}
@@ -8093,6 +8237,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                 elif 'upejflname' in sign:
                     nowuid = sign.replace('upejflname ', '')
                     ejfl.update_one({"nowuid": nowuid}, {"$set": {"projectname": text}})
+                    bump_catalog_version()
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
                     
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
@@ -8123,6 +8268,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                 elif 'upspname' in sign:
                     uid = sign.replace('upspname ', '')
                     fenlei.update_one({"uid": uid}, {"$set": {"projectname": text}})
+                    bump_catalog_version()
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
 
                     keylist = list(fenlei.find({}, sort=[('row', 1)]))
@@ -8213,6 +8359,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                     nowuid = sign.replace('update_sysm ', '')
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
                     ejfl.update_one({"nowuid": nowuid}, {"$set": {'sysm': zxh}})
+                    bump_catalog_version()
                     fstext = f'''
 新的使用说明为:
 {zxh}
@@ -8238,8 +8385,8 @@ def textkeyboard(update: Update, context: CallbackContext):
                          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
+                    stock_counts = get_stock_counts(nowuid)
+                    kc, ys = stock_counts['available'], stock_counts['sold']
                     fstext = f'''
 主分类: {fl_pro}
 二级分类: {ej_projectname}
@@ -8253,6 +8400,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                     nowuid = sign.replace('update_wbts ', '')
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
                     ejfl.update_one({"nowuid": nowuid}, {"$set": {'text': zxh}})
+                    bump_catalog_version()
                     fstext = f'''
 新的提示为:
 {zxh}
@@ -8278,8 +8426,8 @@ def textkeyboard(update: Update, context: CallbackContext):
                          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
+                    stock_counts = get_stock_counts(nowuid)
+                    kc, ys = stock_counts['available'], stock_counts['sold']
                     fstext = f'''
 主分类: {fl_pro}
 二级分类: {ej_projectname}
@@ -8373,8 +8521,9 @@ def textkeyboard(update: Update, context: CallbackContext):
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
 
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
+                    stock_counts = get_stock_counts(nowuid)
+
+                    kc, ys = stock_counts['available'], stock_counts['sold']
 
                     fstext = f'''
 主分类: {fl_pro}
@@ -8388,92 +8537,18 @@ def textkeyboard(update: Update, context: CallbackContext):
 
 
             elif update.message.document:
-                if 'update_hb' in sign:
-                    nowuid = sign.replace('update_hb ', '')
+                if 'update_hb' in sign or 'update_txt' in sign or 'update_xyh' in sign:
+                    # 号包 / txt / 协议号：只登记入库任务，下载、解压、入库由后台工作线程完成
+                    ingest_kind = {'update_hb': 'hb', 'update_txt': 'txt', 'update_xyh': 'xyh'}[sign.split(' ', 1)[0]]
+                    nowuid = sign.split(' ', 1)[1]
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
 
                     file = update.message.document
-                    filename = file.file_name
-                    file_id = file.file_id
-                    new_file = context.bot.get_file(file_id)
-                    new_file_path = f'./临时文件夹/{filename}'
-                    new_file.download(new_file_path)
-
-                    progress_msg = context.bot.send_message(chat_id=user_id, text='📤 上传中，请勿重复操作...')
-                    
-                    # ✅ 启动批量上传模式
-                    stock_manager.start_batch_upload()
-
-                    count = 0
-                    timer = beijing_now_str()
-                    with zipfile.ZipFile(new_file_path, 'r') as zip_ref:
-                        file_list = zip_ref.infolist()
-                        total = len(file_list)
-                        step = max(1, total // 10)
-
-                        for idx, file_info in enumerate(file_list, 1):
-                            match = re.match(r'^([^/\\]+)/.*$', file_info.filename)
-                            if match:
-                                folder_name = match.group(1)
-                                if hb.find_one({'nowuid': nowuid, 'projectname': folder_name}) is None:
-                                    hbid = generate_24bit_uid()
-                                    shangchuanhaobao('直登号', uid, nowuid, hbid, folder_name, timer, batch_mode=True)
-                                    count += 1
-
-                            zip_ref.extract(file_info, f'号包/{nowuid}')
-
-                            # 每10%进度更新
-                            if idx % step == 0 or idx == total:
-                                percent = int(idx / total * 100)
-                                try:
-                                    context.bot.edit_message_text(
-                                        chat_id=user_id,
-                                        message_id=progress_msg.message_id,
-                                        text=f'📦 正在解压处理号包...\n\n✅ 当前进度：{percent}%'
-                                    )
-                                except:
-                                    pass
-                    
-                    # ✅ 结束批量上传模式并立即发送通知
-                    stock_manager.end_batch_upload(force_send=True)
-
-                    update.message.reply_text(f'🎉 解压并处理完成！本次上传了 {count} 个号包')
+                    progress_msg = context.bot.send_message(chat_id=user_id, text='📤 已加入入库队列，请勿重复操作...')
+                    enqueue_ingest_job(ingest_kind, uid, nowuid, file.file_id, file.file_name, user_id,
+                                       progress_msg.message_id)
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
 
-                    ej_list = ejfl.find_one({'nowuid': nowuid})
-                    uid = ej_list['uid']
-                    money = ej_list['money']
-                    ej_projectname = ej_list['projectname']
-                    fl_pro = fenlei.find_one({'uid': uid})['projectname']
-
-                    keyboard = [
-                        [InlineKeyboardButton('取出所有库存', callback_data=f'qchuall {nowuid}'),
-                         InlineKeyboardButton('此商品使用说明', callback_data=f'update_sysm {nowuid}')],
-                        [InlineKeyboardButton('上传谷歌账户', callback_data=f'update_gg {nowuid}'),
-                         InlineKeyboardButton('购买此商品提示', callback_data=f'update_wbts {nowuid}')],
-                        [InlineKeyboardButton('上传链接', callback_data=f'update_hy {nowuid}'),
-                         InlineKeyboardButton('上传txt文件', callback_data=f'update_txt {nowuid}')],
-                        [InlineKeyboardButton('上传号包', callback_data=f'update_hb {nowuid}'),
-                         InlineKeyboardButton('上传协议号', callback_data=f'update_xyh {nowuid}')],
-                        [InlineKeyboardButton('修改二级分类名', callback_data=f'upejflname {nowuid}'),
-                         InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
-                        [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
-                    ]
-
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
-                    context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
-
-
                 elif 'update_gg' in sign:
                     nowuid = sign.replace('update_gg ', '')
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
@@ -8557,179 +8632,8 @@ def textkeyboard(update: Update, context: CallbackContext):
                          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
-                    context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
-
-
-                elif 'update_txt' in sign:
-                    nowuid = sign.replace('update_txt ', '')
-                    uid = ejfl.find_one({'nowuid': nowuid})['uid']
-
-                    file = update.message.document
-                    # 获取文件名
-                    filename = file.file_name
-
-                    # 获取文件ID
-                    file_id = file.file_id
-                    # 下载文件
-                    new_file = context.bot.get_file(file_id)
-                    # 将文件保存到本地
-                    new_file_path = f'./临时文件夹/{filename}'
-                    new_file.download(new_file_path)
-
-                    # 初始进度提示
-                    progress_msg = context.bot.send_message(chat_id=user_id, text='📤 上传中，请勿重复操作...')
-                    
-                    # ✅ 启动批量上传模式
-                    stock_manager.start_batch_upload()
-
-                    link_list = []
-                    with open(new_file_path, 'r', encoding='utf-8') as file:
-                        # 逐行读取文件内容
-                        for line in file:
-                            # 去除每行末尾的换行符并添加到列表中
-                            link_list.append(line.strip())
-
-                    timer = beijing_now_str()
-                    count = 0
-                    total = len(link_list)
-                    step = max(1, total // 10)
-
-                    for idx, i in enumerate(link_list, 1):
-                        if hb.find_one({'nowuid': nowuid, 'projectname': i}) is None:
-                            hbid = generate_24bit_uid()
-                            shangchuanhaobao('API', uid, nowuid, hbid, i, timer, batch_mode=True)
-                            count += 1
-
-                        # 每10%更新一次进度提示
-                        if idx % step == 0 or idx == total:
-                            percent = int(idx / total * 100)
-                            try:
-                                context.bot.edit_message_text(
-                                    chat_id=user_id,
-                                    message_id=progress_msg.message_id,
-                                    text=f'📥 正在处理链接...\n\n✅ 进度：{percent}%'
-                                )
-                            except:
-                                pass
-                    
-                    # ✅ 结束批量上传模式并立即发送通知
-                    stock_manager.end_batch_upload(force_send=True)
-
-                    update.message.reply_text(f'处理完成！本次上传了{count}个api链接')
-                    user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
-
-                    ej_list = ejfl.find_one({'nowuid': nowuid})
-                    uid = ej_list['uid']
-                    money = ej_list['money']
-                    ej_projectname = ej_list['projectname']
-                    fl_pro = fenlei.find_one({'uid': uid})['projectname']
-                    keyboard = [
-                        [InlineKeyboardButton('取出所有库存', callback_data=f'qchuall {nowuid}'),
-                         InlineKeyboardButton('此商品使用说明', callback_data=f'update_sysm {nowuid}')],
-                        [InlineKeyboardButton('上传谷歌账户', callback_data=f'update_gg {nowuid}'),
-                         InlineKeyboardButton('购买此商品提示', callback_data=f'update_wbts {nowuid}')],
-                        [InlineKeyboardButton('上传链接', callback_data=f'update_hy {nowuid}'),
-                         InlineKeyboardButton('上传txt文件', callback_data=f'update_txt {nowuid}')],
-                        [InlineKeyboardButton('上传号包', callback_data=f'update_hb {nowuid}'),
-                         InlineKeyboardButton('上传协议号', callback_data=f'update_xyh {nowuid}')],
-                        [InlineKeyboardButton('修改二级分类名', callback_data=f'upejflname {nowuid}'),
-                         InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
-                        [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
-                    ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
-                    context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
-
-                elif 'update_xyh' in sign:
-                    nowuid = sign.replace('update_xyh ', '')
-                    uid = ejfl.find_one({'nowuid': nowuid})['uid']
-
-                    file = update.message.document
-                    # 获取文件名
-                    filename = file.file_name
-
-                    # 获取文件ID
-                    file_id = file.file_id
-                    # 下载文件
-                    new_file = context.bot.get_file(file_id)
-                    # 将文件保存到本地
-                    new_file_path = f'./临时文件夹/{filename}'
-                    new_file.download(new_file_path)
-
-                    context.bot.send_message(chat_id=user_id, text='上传中，请勿重复操作')
-                    
-                    # ✅ 启动批量上传模式
-                    stock_manager.start_batch_upload()
-                    
-                    # 解压缩文件
-                    count = 0
-                    tj_dict = {}
-                    timer = beijing_now_str()
-                    with zipfile.ZipFile(new_file_path, 'r') as zip_ref:
-                        for file_info in zip_ref.infolist():
-                            filename = file_info.filename
-                            if filename.endswith('.json') or filename.endswith('.session'):
-                                # 仅解压 session 或者 json 格式的文件
-                                fli1 = filename.replace('.json', '').replace('.session', '')
-                                if fli1 not in tj_dict.keys():
-
-                                    hbid = generate_24bit_uid()
-                                    if hb.find_one({'nowuid': nowuid, 'projectname': fli1}) is None:
-                                        tj_dict[fli1] = 1
-                                        shangchuanhaobao('协议号', uid, nowuid, hbid, fli1, timer, batch_mode=True)
-
-                                zip_ref.extract(member=file_info, path=f'协议号/{nowuid}')
-                                pass
-                            else:
-                                pass
-                    for i in tj_dict:
-                        count += 1
-                    
-                    # ✅ 结束批量上传模式并立即发送通知
-                    stock_manager.end_batch_upload(force_send=True)
-
-                    update.message.reply_text(f'解压并处理完成！本次上传了{count}个协议号')
-
-                    user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
-
-                    ej_list = ejfl.find_one({'nowuid': nowuid})
-                    uid = ej_list['uid']
-                    money = ej_list['money']
-                    ej_projectname = ej_list['projectname']
-                    fl_pro = fenlei.find_one({'uid': uid})['projectname']
-                    keyboard = [
-                        [InlineKeyboardButton('取出所有库存', callback_data=f'qchuall {nowuid}'),
-                         InlineKeyboardButton('此商品使用说明', callback_data=f'update_sysm {nowuid}')],
-                        [InlineKeyboardButton('上传谷歌账户', callback_data=f'update_gg {nowuid}'),
-                         InlineKeyboardButton('购买此商品提示', callback_data=f'update_wbts {nowuid}')],
-                        [InlineKeyboardButton('上传链接', callback_data=f'update_hy {nowuid}'),
-                         InlineKeyboardButton('上传txt文件', callback_data=f'update_txt {nowuid}')],
-                        [InlineKeyboardButton('上传号包', callback_data=f'update_hb {nowuid}'),
-                         InlineKeyboardButton('上传协议号', callback_data=f'update_xyh {nowuid}')],
-                        [InlineKeyboardButton('修改二级分类名', callback_data=f'upejflname {nowuid}'),
-                         InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
-                        [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
-                    ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
+                    stock_counts = get_stock_counts(nowuid)
+                    kc, ys = stock_counts['available'], stock_counts['sold']
                     fstext = f'''
 主分类: {fl_pro}
 二级分类: {ej_projectname}
@@ -9311,9 +9215,9 @@ def textkeyboard(update: Update, context: CallbackContext):
 
             elif text == '🛒商品列表' or text == '🛒Product List':
                 del_message(update.message)
-                fenlei_data = list(fenlei.find({}, sort=[('row', 1)]))
-                ejfl_data = list(ejfl.find({}))
-                hb_data = list(hb.find({'state': 0}))
+                catalog = get_catalog()
+                fenlei_data = catalog.categories
+                stock_map = get_stock_map()
 
                 # ✅ 一级分类始终显示，显示库存数量（包括0）
                 keyboard = []
@@ -9324,8 +9228,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                     projectname = i['projectname']
                     row = i['row']
                     hsl = sum(
-                        1 for j in ejfl_data if j['uid'] == uid
-                        for hb_item in hb_data if hb_item['nowuid'] == j['nowuid']
+                        stock_map.get(j['nowuid'], 0) for j in catalog.category_products(uid)
                     )
                     
                     # ✅ 一级分类始终显示（不论库存多少）
@@ -9415,41 +9318,25 @@ def textkeyboard(update: Update, context: CallbackContext):
                 # ✅ 在商品名称中搜索关键词（支持模糊匹配）
                 matched_products = []
                 
-                # 搜索所有商品
-                for product in ejfl.find():
-                    nowuid = product['nowuid']
-                    uid = product.get('uid')
-                    
-                    # 跳过分类被删除的商品
-                    if not fenlei.find_one({'uid': uid}):
-                        continue
-                    
-                    # 检查库存
-                    stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
-                    if stock <= 0:
-                        continue
-                    
-                    # 检查价格
-                    money = product.get('money', 0)
-                    if money <= 0:
-                        continue
-                    
-                    # 关键词匹配逻辑（不区分大小写）
-                    product_name = product['projectname'].lower()
-                    query_lower = query_text.lower()
-                    
-                    # 支持多种匹配方式
-                    if (query_lower in product_name or 
-                        any(keyword in product_name for keyword in query_lower.split()) or
-                        # 支持数字匹配（如+86, +885等）
-                        query_text in product_name or
-                        # 支持国家名称匹配
-                        any(country in product_name for country in [query_text, query_lower])):
-                        
+                # 整句优先，其次逐个关键词匹配（只返回有库存、分类未被删除的商品）
+                catalog = get_catalog()
+                seen_nowuids = set()
+                for keyword in [query_text] + query_text.split():
+                    for product, stock in search_products(keyword, limit=None, in_stock_only=True):
+                        nowuid = product['nowuid']
+                        if nowuid in seen_nowuids:
+                            continue
+                        seen_nowuids.add(nowuid)
+
+                        # 检查价格
+                        money = product.get('money', 0)
+                        if money <= 0:
+                            continue
+
                         # 获取分类信息
-                        category = fenlei.find_one({'uid': uid})
+                        category = catalog.category(product.get('uid'))
                         category_name = category.get('projectname', '未知分类') if category else '未知分类'
-                        
+
                         matched_products.append({
                             'nowuid': nowuid,
                             'name': product['projectname'],
@@ -9527,37 +9414,59 @@ def textkeyboard(update: Update, context: CallbackContext):
                     )
 
 
+# 🔎查询库存 分页缓存：{lang: {'key': (目录版本, 库存版本), 'built_at', 'lines', 'total_pages'}}
+# 每个库存行（含翻译）只在目录或库存变化时生成一次，翻页直接切片
+STOCK_PAGE_SIZE = 50
+_stock_page_cache = {}
+_stock_page_lock = threading.Lock()
+
+
+def get_stock_page_model(lang='zh') -> dict:
+    catalog = get_catalog()
+    key = (catalog.version, get_stock_version())
+    model = _stock_page_cache.get(lang)
+    if model and model['key'] == key and time.time() - model['built_at'] < STOCK_PAGE_CACHE_TTL:
+        return model
+
+    with _stock_page_lock:
+        model = _stock_page_cache.get(lang)
+        if model and model['key'] == key and time.time() - model['built_at'] < STOCK_PAGE_CACHE_TTL:
+            return model
+
+        # 获取所有有库存的商品（过滤掉所属一级分类被删除的）
+        stock_map = get_stock_map()
+        lines = []
+        for g in catalog.listed_products():
+            stock = stock_map.get(g['nowuid'], 0)
+            if stock <= 0:
+                continue
+            pname = g.get('projectname', '未知商品')
+            pname = pname if lang == 'zh' else get_fy(pname)
+            lines.append(f"⤷ <b>{len(lines) + 1}. {pname}</b>  ➥  {'库存' if lang == 'zh' else 'Stock'}: <b>{stock}</b>")
+
+        model = {
+            'key': key,
+            'built_at': time.time(),
+            'lines': lines,
+            'total_pages': (len(lines) + STOCK_PAGE_SIZE - 1) // STOCK_PAGE_SIZE
+        }
+        _stock_page_cache[lang] = model
+        return model
+
+
 def check_stock_callback(update: Update, context: CallbackContext, page=0, lang='zh'):
     query = update.callback_query if update.callback_query else None
     user_id = update.effective_user.id
-    limit = 50
-    start = page * limit
-
-    # 获取所有商品（过滤掉所属一级分类被删除的）
-    all_goods = []
-    for g in ejfl.find().sort("row", 1):
-        nowuid = g['nowuid']
-        uid = g.get('uid')
-        if not fenlei.find_one({'uid': uid}):
-            continue
-        stock_count = hb.count_documents({'nowuid': nowuid, 'state': 0})
-        if stock_count <= 0:
-            continue
-        g['stock'] = stock_count
-        all_goods.append(g)
 
-    total = len(all_goods)
-    total_pages = (total + limit - 1) // limit
-    display_goods = all_goods[start:start + limit]
+    model = get_stock_page_model(lang)
+    total_pages = model['total_pages']
+    # 旧消息上的页码按钮可能超出当前页数
+    page = max(0, min(page, total_pages - 1))
+    start = page * STOCK_PAGE_SIZE
 
     # 拼接展示内容
     text_lines = [f"<b>{'商品库存列表' if lang == 'zh' else 'Product Stock List'}</b>", "--------"]
-    for i, g in enumerate(display_goods, start=start + 1):
-        pname = g.get('projectname', '未知商品')
-        pname = pname if lang == 'zh' else get_fy(pname)
-        stock = g['stock']
-        line = f"⤷ <b>{i}. {pname}</b>  ➥  {'库存' if lang == 'zh' else 'Stock'}: <b>{stock}</b>"
-        text_lines.append(line)
+    text_lines.extend(model['lines'][start:start + STOCK_PAGE_SIZE])
 
     text_lines.append("--------")
     if lang == 'zh':
@@ -9628,9 +9537,9 @@ def show_product_list(update: Update, context: CallbackContext):
     lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
     
     # 获取分类和商品数据
-    fenlei_data = list(fenlei.find({}, sort=[('row', 1)]))
-    ejfl_data = list(ejfl.find({}))
-    hb_data = list(hb.find({'state': 0}))
+    catalog = get_catalog()
+    fenlei_data = catalog.categories
+    stock_map = get_stock_map()
 
     # ✅ 一级分类始终显示，显示库存数量（包括0）
     keyboard = []
@@ -9641,8 +9550,7 @@ def show_product_list(update: Update, context: CallbackContext):
         projectname = i['projectname']
         row = i['row']
         hsl = sum(
-            1 for j in ejfl_data if j['uid'] == uid
-            for hb_item in hb_data if hb_item['nowuid'] == j['nowuid']
+            stock_map.get(j['nowuid'], 0) for j in catalog.category_products(uid)
         )
         
         # ✅ 一级分类始终显示（不论库存多少）
@@ -11913,6 +11821,10 @@ def main():
 
     Thread(target=start_flask_server, daemon=True).start()
 
+    # 启动时幂等创建索引，并检查常用查询是否存在全表扫描
+    ensure_indexes()
+    find_collscans()
+
     updater = Updater(
         token=BOT_TOKEN,
         use_context=True,
@@ -11933,6 +11845,9 @@ def main():
     dispatcher.add_handler(CommandHandler("admin_add", admin_add, run_async=True))
     dispatcher.add_handler(CommandHandler("admin_remove", admin_remove, run_async=True))
     dispatcher.add_handler(CommandHandler("diag_db", diag_db, run_async=True))  # Database diagnostics
+    dispatcher.add_handler(CommandHandler("delivery", delivery_status, run_async=True))  # 发货任务状态
+    dispatcher.add_handler(CommandHandler("migrate_store", migrate_store, run_async=True))  # 旧库存迁移到账号存储
+    dispatcher.add_handler(CommandHandler("health", health_report, run_async=True))  # 售后检测质量统计
     # 🆕 代理系统命令处理器
     dispatcher.add_handler(CommandHandler("add_agent", add_new_agent, run_async=True))
     # 🆕 用户提现管理命令
@@ -12141,6 +12056,23 @@ def main():
     # 订单检查任务：30秒间隔（权衡性能和响应速度，最多30秒延迟）
     updater.job_queue.run_repeating(suoyouchengxu, 30, 1, name='suoyouchengxu')
     updater.job_queue.run_repeating(jiexi, 30, 1, name='chongzhi')
+    # 回收过期的库存预留（发货中断遗留）
+    updater.job_queue.run_repeating(lambda context: release_expired_reservations(), 60, 30, name='release_reservations')
+    # 库存计数器对账：纠正计数器与 hb 实际数据之间的漂移
+    updater.job_queue.run_repeating(lambda context: reconcile_stock_counters(), STOCK_RECONCILE_INTERVAL,
+                                    STOCK_RECONCILE_INTERVAL, name='stock_reconcile')
+    # 清理超过30天的小时销量桶
+    updater.job_queue.run_repeating(lambda context: prune_sales_stats(), 3600, 120, name='prune_sales_stats')
+    # 首次部署时从历史订单回填销量统计（开始接单前完成，失败时下次启动重试）
+    try:
+        backfill_sales_stats()
+    except Exception as e:
+        logging.error(f"❌ 销量统计回填失败，下次启动重试：{e}")
+    # TData 转换进程池（fork 创建，需在其他后台线程之前启动；未安装 opentele 时跳过）
+    start_tdata_converter()
+    # 后台入库工作线程（上传的号包/协议号/txt 在这里处理，不占用 dispatcher 线程）
+    start_ingest_workers(updater.bot, on_complete=ingest_job_done)
+    start_delivery_workers(updater.bot, 'shop', {'shop': deliver_shop_order}, on_failed=delivery_job_failed)
     updater.start_polling(timeout=BOT_TIMEOUT)
     updater.idle()
 
@@ -0,0 +1,220 @@
+"""
+数据库索引管理
+启动时按声明幂等创建热点集合的索引，并用 explain() 检查项目中的常用查询是否退化为全表扫描(COLLSCAN)
+"""
+
+import html
+import logging
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from mongo import (hb, hb_stock, gmjlu, topup, qukuai, user, fyb, ejfl, fenlei, ingest_jobs, sales_stats, delivery_jobs,
+                   health_stats)
+
+
+# ================================ 索引声明 ================================
+# (集合, 索引键, 选项)
+INDEX_SPECS = [
+    # 号包库存
+    (hb, [('nowuid', ASCENDING), ('state', ASCENDING)], {}),
+    (hb, [('nowuid', ASCENDING), ('projectname', ASCENDING)], {'unique': True}),
+    (hb, [('hbid', ASCENDING)], {}),
+    (hb, [('reserve_token', ASCENDING)], {'sparse': True}),
+    (hb, [('state', ASCENDING), ('reserve_expire', ASCENDING)], {}),
+    (hb, [('files.sha256', ASCENDING)], {'sparse': True}),
+    (hb, [('nowuid', ASCENDING), ('state', ASCENDING), ('health.checked_at', ASCENDING)], {}),
+    (hb, [('sweep_token', ASCENDING)], {'sparse': True}),
+    (hb_stock, [('nowuid', ASCENDING)], {'unique': True}),
+
+    # 购买记录
+    (gmjlu, [('user_id', ASCENDING), ('timer', DESCENDING)], {}),
+    (gmjlu, [('bianhao', ASCENDING)], {}),
+
+    # 充值订单
+    (topup, [('status', ASCENDING), ('money', ASCENDING)], {}),
+    (topup, [('user_id', ASCENDING), ('status', ASCENDING)], {}),
+    (topup, [('bianhao', ASCENDING)], {}),
+    (topup, [('txid', ASCENDING)], {}),
+
+    # 链上交易
+    (qukuai, [('state', ASCENDING), ('to_address', ASCENDING)], {}),
+    (qukuai, [('txid', ASCENDING)], {'unique': True}),
+
+    # 用户
+    (user, [('user_id', ASCENDING)], {'unique': True}),
+    (user, [('count_id', ASCENDING)], {}),
+
+    # 翻译包
+    (fyb, [('text', ASCENDING)], {}),
+
+    # 商品分类
+    (ejfl, [('nowuid', ASCENDING)], {}),
+    (ejfl, [('uid', ASCENDING), ('row', ASCENDING)], {}),
+    (fenlei, [('uid', ASCENDING)], {}),
+
+    # 热销排行
+    (sales_stats, [('nowuid', ASCENDING), ('hour', ASCENDING)], {'unique': True}),
+    (sales_stats, [('hour', ASCENDING)], {}),
+
+    # 入库任务队列
+    (ingest_jobs, [('status', ASCENDING), ('created_at', ASCENDING)], {}),
+    (ingest_jobs, [('job_id', ASCENDING)], {'unique': True}),
+
+    # 发货任务队列
+    (delivery_jobs, [('order_id', ASCENDING)], {'unique': True}),
+    (delivery_jobs, [('owner', ASCENDING), ('status', ASCENDING), ('next_attempt_at', ASCENDING)], {}),
+
+    # 账号健康统计
+    (health_stats, [('nowuid', ASCENDING)], {'unique': True}),
+    (health_stats, [('checks', DESCENDING)], {}),
+]
+
+# 项目中真实使用的查询，用于 explain() 检查是否命中索引
+# (名称, 集合, 查询条件, 排序)
+CANNED_QUERIES = [
+    ('hb 商品库存', hb, {'nowuid': '_', 'state': 0}, None),
+    ('hb 上传去重', hb, {'nowuid': '_', 'projectname': '_'}, None),
+    ('hb 按hbid更新', hb, {'hbid': '_'}, None),
+    ('hb 过期预留', hb, {'state': 2, 'reserve_expire': {'$lt': 0}}, None),
+    ('hb 存储文件引用', hb, {'files.sha256': '_'}, None),
+    ('hb 待巡检库存', hb, {'nowuid': '_', 'state': 0, 'leixing': '协议号'}, [('health.checked_at', ASCENDING)]),
+    ('hb 巡检认领', hb, {'sweep_token': '_'}, None),
+    ('gmjlu 用户购买记录', gmjlu, {'user_id': 0}, [('timer', DESCENDING)]),
+    ('gmjlu 订单详情', gmjlu, {'bianhao': '_'}, None),
+    ('topup 金额匹配', topup, {'money': {'$gte': 0, '$lte': 1}, 'status': 'pending'}, None),
+    ('topup 用户待支付', topup, {'user_id': 0, 'status': 'pending'}, None),
+    ('topup 交易去重', topup, {'txid': '_'}, None),
+    ('qukuai 待处理交易', qukuai, {'state': 0, 'to_address': '_'}, None),
+    ('qukuai 按txid更新', qukuai, {'txid': '_'}, None),
+    ('user 用户信息', user, {'user_id': 0}, None),
+    ('user 最大编号', user, {}, [('count_id', DESCENDING)]),
+    ('fyb 翻译缓存', fyb, {'text': '_'}, None),
+    ('ejfl 商品详情', ejfl, {'nowuid': '_'}, None),
+    ('ejfl 分类商品', ejfl, {'uid': '_'}, [('row', ASCENDING)]),
+    ('fenlei 一级分类', fenlei, {'uid': '_'}, None),
+    ('sales_stats 排行窗口', sales_stats, {'hour': {'$gte': '_', '$ne': 'all'}}, None),
+    ('ingest_jobs 待处理任务', ingest_jobs, {'status': 'pending'}, [('created_at', ASCENDING)]),
+    ('delivery_jobs 待发货任务', delivery_jobs, {'owner': '_', 'status': 'pending', 'next_attempt_at': {'$lte': 0}},
+     [('next_attempt_at', ASCENDING)]),
+    ('health_stats 检测质量', health_stats, {}, [('checks', DESCENDING)]),
+]
+
+# 最近一次 ensure_indexes() 的结果，供 /diag_db 展示
+last_report = None
+
+
+def _index_label(collection, keys) -> str:
+    return f"{collection.name}(" + ", ".join(f"{k}{'' if d == ASCENDING else ' desc'}" for k, d in keys) + ")"
+
+
+def ensure_indexes() -> dict:
+    """幂等创建全部声明的索引
+
+    Returns:
+        dict: {'created': [...], 'existing': [...], 'failed': [(索引, 错误), ...]}
+    """
+    global last_report
+    report = {'created': [], 'existing': [], 'failed': []}
+    existing_cache = {}
+
+    for collection, keys, options in INDEX_SPECS:
+        label = _index_label(collection, keys)
+        try:
+            if collection.name not in existing_cache:
+                existing_cache[collection.name] = [
+                    [(k, d) for k, d in info['key']]
+                    for info in collection.index_information().values()
+                ]
+            key_list = [(k, d) for k, d in keys]
+            if key_list in existing_cache[collection.name]:
+                report['existing'].append(label)
+                continue
+
+            collection.create_index(keys, background=True, **options)
+            existing_cache[collection.name].append(key_list)
+            report['created'].append(label)
+            logging.info(f"✅ 创建索引：{label}")
+        except OperationFailure as e:
+            # 常见原因：唯一索引遇到重复数据、同名索引选项冲突
+            report['failed'].append((label, str(e)))
+            logging.error(f"❌ 创建索引失败：{label} - {e}")
+            if options.get('unique'):
+                # 存在重复数据时退回普通索引，保证查询仍能命中；清理重复数据并删除该索引后重启即可升级为唯一索引
+                try:
+                    fallback = {k: v for k, v in options.items() if k != 'unique'}
+                    collection.create_index(keys, background=True, **fallback)
+                    existing_cache[collection.name].append([(k, d) for k, d in keys])
+                    logging.warning(f"⚠️ 已退回创建普通索引：{label}")
+                except Exception as fallback_error:
+                    logging.error(f"❌ 创建普通索引失败：{label} - {fallback_error}")
+        except Exception as e:
+            report['failed'].append((label, str(e)))
+            logging.error(f"❌ 创建索引失败：{label} - {e}")
+
+    logging.info(f"📇 索引检查完成：新建 {len(report['created'])}，已存在 {len(report['existing'])}，"
+                 f"失败 {len(report['failed'])}")
+    last_report = report
+    return report
+
+
+def _plan_stages(plan) -> list:
+    """递归收集执行计划中的所有 stage"""
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan['stage']] if 'stage' in plan else []
+    for key in ('inputStage', 'queryPlan'):
+        stages.extend(_plan_stages(plan.get(key)))
+    for child in plan.get('inputStages', []) or []:
+        stages.extend(_plan_stages(child))
+    for shard in plan.get('shards', []) or []:
+        stages.extend(_plan_stages(shard.get('winningPlan')))
+    return stages
+
+
+def find_collscans() -> list:
+    """对常用查询执行 explain()，返回退化为全表扫描的查询
+
+    Returns:
+        list: [(名称, 集合名, stage列表), ...]
+    """
+    collscans = []
+    for name, collection, query, sort in CANNED_QUERIES:
+        try:
+            cursor = collection.find(query).limit(1)
+            if sort:
+                cursor = cursor.sort(sort)
+            explain = cursor.explain()
+            stages = _plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))
+            if 'COLLSCAN' in stages:
+                collscans.append((name, collection.name, stages))
+                logging.warning(f"⚠️ 全表扫描：{name} ({collection.name}) stages={stages}")
+        except Exception as e:
+            logging.error(f"❌ explain 失败：{name} - {e}")
+    return collscans
+
+
+def format_index_report(report: dict = None, collscans: list = None) -> str:
+    """生成 /diag_db 使用的索引诊断文本（HTML）"""
+    if report is None:
+        report = last_report or ensure_indexes()
+    if collscans is None:
+        collscans = find_collscans()
+
+    lines = [
+        "<b>📇 索引状态</b>",
+        f"• 已声明: {len(INDEX_SPECS)}",
+        f"• 已存在: {len(report['existing'])}",
+        f"• 启动时新建: {len(report['created'])}",
+        f"• 创建失败: {len(report['failed'])}",
+    ]
+    for label, error in report['failed'][:5]:
+        lines.append(f"  ✗ <code>{label}</code>: {html.escape(error[:80])}")
+
+    lines.append("")
+    lines.append(f"<b>🔎 查询计划检查</b>（{len(CANNED_QUERIES)} 条常用查询）")
+    if collscans:
+        for name, collection_name, stages in collscans:
+            lines.append(f"  ⚠️ {name} <code>{collection_name}</code>: {' → '.join(stages)}")
+    else:
+        lines.append("  ✅ 全部命中索引，无 COLLSCAN")
+    return "\n".join(lines)
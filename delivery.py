@@ -0,0 +1,289 @@
+"""
+订单发货任务队列
+购买处理器只负责扣款、记账并登记发货任务；打包与上传由后台工作线程完成。
+任务持久化在 delivery_jobs 集合中，按订单号幂等，失败按指数退避重试，
+状态：pending（待发货）→ running（处理中）→ packaged（已打包，上传中）→ sent（已发送）/ failed（失败）
+"""
+
+import html
+import logging
+import threading
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from telegram.error import BadRequest
+
+from mongo import delivery_jobs, DELIVERY_WORKERS, DELIVERY_MAX_ATTEMPTS, DELIVERY_RETRY_BASE
+
+
+DELIVERY_STATUS_NAMES = {
+    'pending': '⏳ 待发货',
+    'running': '⚙️ 处理中',
+    'packaged': '📦 已打包',
+    'sent': '✅ 已发送',
+    'failed': '❌ 失败',
+}
+
+
+class JobContext:
+    """后台任务中调用原有发货函数时使用的最小 context（这些函数只用到 context.bot）"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+
+# ================================ 任务登记 ================================
+
+def enqueue_delivery_job(order_id: str, owner, kind: str, user_id, payload: dict) -> bool:
+    """登记发货任务，同一订单号只会登记一次
+
+    Args:
+        owner: 负责发货的机器人（'shop' 为总部机器人，代理机器人为 AGENT_BOT_ID）
+        kind: 发货处理器名称
+        payload: 发货处理器需要的订单数据
+
+    Returns:
+        bool: 是否为新登记的任务
+    """
+    now = datetime.now()
+    try:
+        result = delivery_jobs.update_one(
+            {'order_id': order_id},
+            {'$setOnInsert': {
+                'order_id': order_id,
+                'owner': owner,
+                'kind': kind,
+                'user_id': user_id,
+                'payload': payload,
+                'status': 'pending',
+                'attempts': 0,
+                'error': None,
+                'next_attempt_at': now,
+                'created_at': now,
+                'packaged_at': None,
+                'sent_at': None,
+                'updated_at': now
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    created = result.upserted_id is not None
+    if created:
+        logging.info(f"📮 发货任务已登记：order_id={order_id}, owner={owner}, kind={kind}, user={user_id}")
+        pool = delivery_worker_pool
+        if pool is not None and pool.owner == owner:
+            pool.wake()
+    else:
+        logging.warning(f"⚠️ 发货任务已存在，忽略重复登记：order_id={order_id}")
+    return created
+
+
+def mark_delivery_packaged(order_id: str):
+    """发货处理器在文件打包完成、开始上传前调用"""
+    try:
+        now = datetime.now()
+        delivery_jobs.update_one(
+            {'order_id': order_id, 'status': 'running'},
+            {'$set': {'status': 'packaged', 'packaged_at': now, 'updated_at': now}}
+        )
+    except Exception as e:
+        logging.error(f"❌ 更新发货任务状态失败：order_id={order_id} - {e}")
+
+
+# ================================ 发货进度 ================================
+# 处理器在任务的 progress 字段记录已送达的部分，重试时领取到的 job 带着上次的进度，
+# 据此只补发剩余部分，不重复预留、不重复发货。
+
+def set_delivery_progress(order_id: str, **fields):
+    """记录发货进度，例如 reserve_token（本次预留令牌）、hbids（已发送的内容）"""
+    if not order_id:
+        return
+    try:
+        delivery_jobs.update_one({'order_id': order_id},
+                                 {'$set': {f'progress.{key}': value for key, value in fields.items()}})
+    except Exception as e:
+        logging.error(f"❌ 记录发货进度失败：order_id={order_id} - {e}")
+
+
+def add_delivered_count(order_id: str, count: int):
+    """累计已送达并确认售出的账号数（progress.delivered）"""
+    if not order_id or not count:
+        return
+    try:
+        delivery_jobs.update_one({'order_id': order_id}, {'$inc': {'progress.delivered': count}})
+    except Exception as e:
+        logging.error(f"❌ 记录发货进度失败：order_id={order_id} - {e}")
+
+
+# ================================ 工作线程池 ================================
+
+class DeliveryWorkerPool:
+    """发货任务工作线程池
+
+    每个机器人进程只领取 owner 为自己的任务；通过 find_one_and_update 原子领取，
+    启动时把上次进程中断时仍在处理中的任务退回 pending。
+    处理器通过 set_delivery_progress / add_delivered_count 记录已送达的部分，重试时只补发剩余部分；
+    上传成功但未来得及记录进度时进程崩溃，重启后会再发送一次（至少一次送达）。
+    """
+
+    def __init__(self, bot, owner, handlers: dict, workers: int = None, on_failed=None, poll_interval: float = 5):
+        """
+        Args:
+            handlers: {kind: handler(bot, job)}，处理器抛出异常即视为本次发货失败
+            on_failed: 重试次数用尽后的回调 on_failed(bot, job, error)
+        """
+        self.bot = bot
+        self.owner = owner
+        self.handlers = handlers
+        self.workers = workers or DELIVERY_WORKERS
+        self.on_failed = on_failed
+        self.poll_interval = poll_interval
+        self._wake_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        recovered = delivery_jobs.update_many(
+            {'owner': self.owner, 'status': {'$in': ['running', 'packaged']}},
+            {'$set': {'status': 'pending', 'next_attempt_at': datetime.now()}}
+        ).modified_count
+        if recovered:
+            logging.info(f"♻️ 恢复中断的发货任务：{recovered} 个")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'delivery-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"✅ 发货工作线程已启动：{self.workers} 个 (owner={self.owner})")
+
+    def wake(self):
+        self._wake_event.set()
+
+    def _claim(self):
+        now = datetime.now()
+        return delivery_jobs.find_one_and_update(
+            {'owner': self.owner, 'status': 'pending', 'next_attempt_at': {'$lte': now}},
+            {'$set': {'status': 'running', 'updated_at': now}, '$inc': {'attempts': 1}},
+            sort=[('next_attempt_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logging.error(f"❌ 领取发货任务失败：{e}")
+                job = None
+            if job is None:
+                self._wake_event.wait(self.poll_interval)
+                self._wake_event.clear()
+                continue
+            self._process(job)
+
+    def _process(self, job):
+        order_id = job['order_id']
+        try:
+            handler = self.handlers[job['kind']]
+            handler(self.bot, job)
+            now = datetime.now()
+            delivery_jobs.update_one({'order_id': order_id}, {'$set': {
+                'status': 'sent', 'error': None, 'sent_at': now, 'updated_at': now
+            }})
+            logging.info(f"✅ 发货完成：order_id={order_id}, 第 {job['attempts']} 次")
+        except Exception as e:
+            attempts = job.get('attempts', 1)
+            failed = attempts >= DELIVERY_MAX_ATTEMPTS
+            now = datetime.now()
+            delivery_jobs.update_one({'order_id': order_id}, {'$set': {
+                'status': 'failed' if failed else 'pending',
+                'error': str(e),
+                'next_attempt_at': now + timedelta(seconds=DELIVERY_RETRY_BASE * 2 ** (attempts - 1)),
+                'updated_at': now
+            }})
+            logging.error(f"❌ 发货失败：order_id={order_id}, 第 {attempts} 次 - {e}")
+            if failed and self.on_failed:
+                try:
+                    self.on_failed(self.bot, job, e)
+                except Exception as callback_error:
+                    logging.error(f"❌ 发货失败回调出错：order_id={order_id} - {callback_error}")
+
+
+# 由各机器人 main() 创建并启动
+delivery_worker_pool = None
+
+
+def start_delivery_workers(bot, owner, handlers: dict, on_failed=None, workers: int = None) -> DeliveryWorkerPool:
+    """创建并启动本进程的发货工作线程池"""
+    global delivery_worker_pool
+    delivery_worker_pool = DeliveryWorkerPool(bot, owner, handlers, workers=workers, on_failed=on_failed)
+    delivery_worker_pool.start()
+    return delivery_worker_pool
+
+
+def retry_delivery_job(order_id: str) -> bool:
+    """管理员手动重试失败的发货任务"""
+    result = delivery_jobs.update_one(
+        {'order_id': order_id, 'status': 'failed'},
+        {'$set': {'status': 'pending', 'attempts': 0, 'next_attempt_at': datetime.now(), 'updated_at': datetime.now()}}
+    )
+    if result.modified_count and delivery_worker_pool is not None:
+        delivery_worker_pool.wake()
+    return bool(result.modified_count)
+
+
+# ================================ 文件重发 ================================
+
+def send_cached_document(bot, chat_id, file_id, build_artifact, **kwargs):
+    """发送订单文件，优先复用上次上传返回的 file_id
+
+    Telegram 对同一个机器人上传过的文件返回 file_id，用它发送不需要重新上传；
+    file_id 为空或被 Telegram 拒绝时才调用 build_artifact() 重新打包上传。
+    注意 file_id 只对上传它的机器人有效。
+
+    Args:
+        build_artifact: 无参函数，返回 DeliveryArtifact
+        kwargs: 透传给 send_document（caption 等）
+
+    Returns:
+        str: 本次发送对应的 file_id，调用方保存后下次复用
+    """
+    if file_id:
+        try:
+            message = bot.send_document(chat_id=chat_id, document=file_id, **kwargs)
+            return message.document.file_id
+        except BadRequest as e:
+            logging.warning(f"⚠️ file_id 已失效，重新上传：{e}")
+
+    with build_artifact() as artifact:
+        message = bot.send_document(chat_id=chat_id, document=artifact.open(), filename=artifact.filename, **kwargs)
+    return message.document.file_id if message.document else None
+
+
+# ================================ 状态查看 ================================
+
+def format_delivery_report(owner=None, limit: int = 10) -> str:
+    """生成发货任务状态文本（HTML），列出未完成的任务"""
+    query = {} if owner is None else {'owner': owner}
+    counts = {item['_id']: item['count'] for item in delivery_jobs.aggregate([
+        {'$match': query},
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+    ])}
+
+    lines = ["<b>📮 发货任务</b>"]
+    for status, name in DELIVERY_STATUS_NAMES.items():
+        lines.append(f"• {name}: {counts.get(status, 0)}")
+
+    unfinished = list(delivery_jobs.find(
+        {**query, 'status': {'$ne': 'sent'}},
+        {'order_id': 1, 'owner': 1, 'user_id': 1, 'status': 1, 'attempts': 1, 'error': 1}
+    ).sort('created_at', -1).limit(limit))
+    if unfinished:
+        lines.append("")
+        lines.append(f"<b>未完成任务</b>（最近 {len(unfinished)} 个）")
+        for job in unfinished:
+            line = (f"{DELIVERY_STATUS_NAMES.get(job['status'], job['status'])} <code>{job['order_id']}</code> "
+                    f"用户 {job['user_id']} · 第 {job.get('attempts', 0)} 次")
+            if job.get('error'):
+                line += f"\n    {html.escape(str(job['error'])[:80])}"
+            lines.append(line)
+    return "\n".join(lines)
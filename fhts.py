@@ -75,6 +75,9 @@ def reset_purchase_tips():
         
         updated_count = result.modified_count
         
+        # 通知运行中的机器人重建商品目录快照
+        db['catalog_meta'].update_one({'_id': 'catalog'}, {'$inc': {'version': 1}}, upsert=True)
+        
         logging.info(f"✅ 批量更新完成！")
         logging.info(f"📊 总商品数：{total_count}")
         logging.info(f"🔄 成功更新：{updated_count}")
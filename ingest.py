@@ -0,0 +1,337 @@
+"""
+库存批量入库管道
+号包 / 协议号 压缩包与 txt 链接文件的解析、并行解压与分块入库，
+以及持久化在 MongoDB 中的后台入库任务队列
+"""
+
+import os
+import re
+import shutil
+import logging
+import tempfile
+import threading
+import zipfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ReturnDocument
+
+from account_pack import prepack_accounts
+from account_store import store_accounts, store_path
+from tdata_cache import enqueue_tdata_conversion
+from mongo import (
+    bulk_shangchuanhaobao, ingest_jobs, stock_manager, new_hbid, beijing_now_str,
+    INGEST_EXTRACT_WORKERS, INGEST_WORKERS, INGEST_MAX_ATTEMPTS, ACCOUNT_STORE_DIR
+)
+
+
+# ================================ 压缩包解析 ================================
+
+def _hb_folder_name(member_name: str):
+    """号包：取压缩包内第一级目录名作为账号名"""
+    match = re.match(r'^([^/\\]+)/.*$', member_name)
+    return match.group(1) if match else None
+
+
+def _xyh_account_name(member_name: str):
+    """协议号：.session / .json 文件名（去扩展名）作为账号名"""
+    if member_name.endswith('.json') or member_name.endswith('.session'):
+        return member_name.replace('.json', '').replace('.session', '')
+    return None
+
+
+def extract_members_parallel(zip_path: str, members: list, dest: str, max_workers: int = None,
+                             progress_callback=None):
+    """并行解压指定成员
+
+    ZipFile 句柄不是线程安全的，每个线程单独打开一次压缩包，按切片解压。
+
+    Args:
+        members: 成员名列表
+        progress_callback: 回调 progress_callback(已解压数, 总数)
+    """
+    total = len(members)
+    if total == 0:
+        return
+    max_workers = max(1, min(max_workers or INGEST_EXTRACT_WORKERS, total))
+    slices = [members[i::max_workers] for i in range(max_workers)]
+    done = [0]
+    lock = threading.Lock()
+
+    def worker(names):
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for name in names:
+                zip_ref.extract(name, dest)
+                with lock:
+                    done[0] += 1
+                    current = done[0]
+                if progress_callback and (current % 200 == 0 or current == total):
+                    progress_callback(current, total)
+
+    os.makedirs(dest, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(worker, names) for names in slices]:
+            future.result()
+
+
+# ================================ 入库管道 ================================
+
+def _ingest_zip(zip_path, leixing, uid, nowuid, timer, dest, name_of, extract_all, progress_callback=None):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        member_names = [info.filename for info in zip_ref.infolist()]
+
+    accounts = []
+    to_extract = []
+    for member_name in member_names:
+        account = name_of(member_name)
+        if account:
+            accounts.append(account)
+        if extract_all or account:
+            to_extract.append(member_name)
+
+    # 先解压到存储目录下的临时目录，再按内容放入账号存储；文件落盘后才写库存，避免买家买到文件尚未就绪的账号
+    os.makedirs(ACCOUNT_STORE_DIR, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='ingest_', dir=ACCOUNT_STORE_DIR)
+    try:
+        extract_members_parallel(
+            zip_path, to_extract, os.path.join(staging, nowuid),
+            progress_callback=(lambda done, total: progress_callback('extract', done, total)) if progress_callback else None
+        )
+        files_by_account = store_accounts(leixing, staging, nowuid, accounts)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # 预打包每个账号，发货时直接拼接分片；失败不影响入库，发货时会现场补打包
+    try:
+        prepack_accounts(
+            leixing, os.path.dirname(dest), nowuid, accounts,
+            progress_callback=(lambda done, total: progress_callback('pack', done, total)) if progress_callback else None,
+            files_by_account=files_by_account
+        )
+    except Exception as e:
+        logging.error(f"❌ 预打包失败：nowuid={nowuid} - {e}")
+
+    inserted = bulk_shangchuanhaobao(
+        leixing, uid, nowuid, (account for account in accounts if account in files_by_account), timer,
+        total=len(accounts),
+        progress_callback=(lambda done, total: progress_callback('insert', done, total)) if progress_callback else None,
+        extra_of=lambda account: {'files': files_by_account[account]}
+    )
+
+    # 协议号在后台预转换 TData，不阻塞入库；未安装 opentele 时跳过
+    if leixing == '协议号':
+        try:
+            enqueue_tdata_conversion([
+                store_path(f['sha256'], f['ext'])
+                for files in files_by_account.values() for f in files if f['ext'] == '.session'
+            ])
+        except Exception as e:
+            logging.error(f"❌ 提交TData预转换失败：nowuid={nowuid} - {e}")
+
+    return inserted
+
+
+def ingest_hb_zip(zip_path: str, uid, nowuid: str, timer: str, progress_callback=None) -> int:
+    """号包（直登号）压缩包入库，返回新上架数量
+
+    Args:
+        progress_callback: 回调 progress_callback(阶段, 已处理数, 总数)，阶段为 'extract' / 'pack' / 'insert'
+    """
+    return _ingest_zip(zip_path, '直登号', uid, nowuid, timer, f'号包/{nowuid}',
+                       _hb_folder_name, True, progress_callback)
+
+
+def ingest_xyh_zip(zip_path: str, uid, nowuid: str, timer: str, progress_callback=None) -> int:
+    """协议号压缩包入库（仅解压 .session / .json），返回新上架数量"""
+    return _ingest_zip(zip_path, '协议号', uid, nowuid, timer, f'协议号/{nowuid}',
+                       _xyh_account_name, False, progress_callback)
+
+
+def ingest_txt_file(file_path: str, uid, nowuid: str, timer: str, progress_callback=None) -> int:
+    """txt 链接文件入库（每行一个 API 链接），逐行流式读取，返回新上架数量"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        total = sum(1 for _ in f)
+
+    def lines():
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield line.strip()
+
+    return bulk_shangchuanhaobao(
+        'API', uid, nowuid, lines(), timer, total=total,
+        progress_callback=(lambda done, t: progress_callback('insert', done, t)) if progress_callback else None
+    )
+
+
+# ================================ 后台入库任务队列 ================================
+
+INGEST_HANDLERS = {
+    'hb': ingest_hb_zip,
+    'xyh': ingest_xyh_zip,
+    'txt': ingest_txt_file,
+}
+
+INGEST_TITLES = {
+    'hb': '📦 正在解压处理号包...',
+    'xyh': '📦 正在解压处理协议号...',
+    'txt': '📥 正在处理链接...',
+}
+
+
+def enqueue_ingest_job(kind: str, uid, nowuid: str, file_id: str, filename: str, chat_id, message_id=None) -> str:
+    """登记入库任务，处理器只负责入队，下载与入库由后台工作线程完成
+
+    Args:
+        kind: 'hb' / 'xyh' / 'txt'
+        message_id: 用于显示进度的消息ID
+
+    Returns:
+        str: 任务ID
+    """
+    job_id = new_hbid()
+    ingest_jobs.insert_one({
+        'job_id': job_id,
+        'kind': kind,
+        'uid': uid,
+        'nowuid': nowuid,
+        'file_id': file_id,
+        'filename': filename,
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'status': 'pending',
+        'attempts': 0,
+        'count': 0,
+        'error': None,
+        'created_at': datetime.now(),
+        'started_at': None,
+        'finished_at': None
+    })
+    logging.info(f"📥 入库任务已登记：job_id={job_id}, kind={kind}, nowuid={nowuid}, file={filename}")
+    if ingest_worker_pool is not None:
+        ingest_worker_pool.wake()
+    return job_id
+
+
+class IngestWorkerPool:
+    """入库任务工作线程池
+
+    任务持久化在 ingest_jobs 集合中，通过 find_one_and_update 原子领取；
+    启动时把上次进程中断时仍处于 running 的任务退回 pending，重启后继续处理。
+    """
+
+    def __init__(self, bot, workers: int = None, on_complete=None, poll_interval: float = 5):
+        """
+        Args:
+            bot: telegram Bot 实例，用于下载文件和编辑进度消息
+            on_complete: 任务成功后的回调 on_complete(bot, job, count)
+        """
+        self.bot = bot
+        self.workers = workers or INGEST_WORKERS
+        self.on_complete = on_complete
+        self.poll_interval = poll_interval
+        self._wake_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        recovered = ingest_jobs.update_many({'status': 'running'}, {'$set': {'status': 'pending'}}).modified_count
+        if recovered:
+            logging.info(f"♻️ 恢复中断的入库任务：{recovered} 个")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'ingest-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"✅ 入库工作线程已启动：{self.workers} 个")
+
+    def wake(self):
+        self._wake_event.set()
+
+    def _claim(self):
+        return ingest_jobs.find_one_and_update(
+            {'status': 'pending'},
+            {'$set': {'status': 'running', 'started_at': datetime.now()}, '$inc': {'attempts': 1}},
+            sort=[('created_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logging.error(f"❌ 领取入库任务失败：{e}")
+                job = None
+            if job is None:
+                self._wake_event.wait(self.poll_interval)
+                self._wake_event.clear()
+                continue
+            self._process(job)
+
+    def _edit(self, job, text):
+        if not job.get('message_id'):
+            return
+        try:
+            self.bot.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'], text=text)
+        except Exception:
+            pass
+
+    def _progress_callback(self, job):
+        title = INGEST_TITLES.get(job['kind'], '📤 正在入库...')
+        stage_names = {'extract': '解压文件', 'pack': '预打包账号', 'insert': '写入库存'}
+        last = {}
+
+        def callback(stage, done, total):
+            percent = int(done / total * 100) if total else 100
+            if percent - last.get(stage, -10) < 10 and done != total:
+                return
+            last[stage] = percent
+            self._edit(job, f'{title}\n\n{stage_names.get(stage, stage)}\n✅ 当前进度：{percent}%')
+
+        return callback
+
+    def _process(self, job):
+        job_id = job['job_id']
+        file_path = f"./临时文件夹/{job_id}_{job['filename']}"
+        try:
+            self._edit(job, f"{INGEST_TITLES.get(job['kind'], '📤 正在入库...')}\n\n⬇️ 正在下载文件")
+            os.makedirs('./临时文件夹', exist_ok=True)
+            self.bot.get_file(job['file_id']).download(file_path)
+
+            handler = INGEST_HANDLERS[job['kind']]
+            count = handler(file_path, job['uid'], job['nowuid'], beijing_now_str(),
+                            progress_callback=self._progress_callback(job))
+
+            ingest_jobs.update_one({'job_id': job_id}, {'$set': {
+                'status': 'done', 'count': count, 'error': None, 'finished_at': datetime.now()
+            }})
+            logging.info(f"✅ 入库任务完成：job_id={job_id}, nowuid={job['nowuid']}, 新增 {count}")
+
+            stock_manager.send_batched_notifications()
+            if self.on_complete:
+                self.on_complete(self.bot, job, count)
+        except Exception as e:
+            failed = job.get('attempts', 1) >= INGEST_MAX_ATTEMPTS
+            ingest_jobs.update_one({'job_id': job_id}, {'$set': {
+                'status': 'failed' if failed else 'pending',
+                'error': str(e),
+                'finished_at': datetime.now() if failed else None
+            }})
+            logging.error(f"❌ 入库任务失败：job_id={job_id}, 第 {job.get('attempts', 1)} 次 - {e}")
+            if failed:
+                self._edit(job, f'❌ 入库失败：{e}')
+        finally:
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            except Exception:
+                pass
+
+
+# 由 bot.main() 创建并启动
+ingest_worker_pool = None
+
+
+def start_ingest_workers(bot, on_complete=None, workers: int = None) -> IngestWorkerPool:
+    """创建并启动全局入库工作线程池"""
+    global ingest_worker_pool
+    ingest_worker_pool = IngestWorkerPool(bot, workers=workers, on_complete=on_complete)
+    ingest_worker_pool.start()
+    return ingest_worker_pool
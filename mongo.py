@@ -3,6 +3,7 @@ import random
 import re
 import pymongo
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 import logging
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from datetime import datetime, timedelta
@@ -10,6 +11,9 @@ import time
 from dotenv import load_dotenv
 import os
 import threading
+import uuid
+import hashlib
+from types import MappingProxyType
 import pytz
 from decimal import Decimal
 
@@ -53,6 +57,51 @@ class Config:
     # 时间配置
     STOCK_NOTIFICATION_DELAY = int(os.getenv('STOCK_NOTIFICATION_DELAY', '3'))
     MESSAGE_DELETE_DELAY = int(os.getenv('MESSAGE_DELETE_DELAY', '3'))
+    STOCK_RECONCILE_INTERVAL = int(os.getenv('STOCK_RECONCILE_INTERVAL', '600'))
+    STOCK_RESERVE_TTL = int(os.getenv('STOCK_RESERVE_TTL', '900'))
+
+    # 批量入库配置
+    INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '1000'))
+    INGEST_EXTRACT_WORKERS = int(os.getenv('INGEST_EXTRACT_WORKERS', '8'))
+    INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '4'))
+    INGEST_MAX_ATTEMPTS = int(os.getenv('INGEST_MAX_ATTEMPTS', '3'))
+
+    # 商品目录快照：检查其他进程是否修改了目录的间隔（秒）
+    CATALOG_VERSION_CHECK_INTERVAL = float(os.getenv('CATALOG_VERSION_CHECK_INTERVAL', '5'))
+
+    # 热销排行榜：从数据库刷新的间隔（秒），本进程内的销量实时计入
+    LEADERBOARD_REFRESH_INTERVAL = int(os.getenv('LEADERBOARD_REFRESH_INTERVAL', '60'))
+
+    # 🔎查询库存 分页缓存有效期（秒），兜底其他进程（代理机器人）的库存变化
+    STOCK_PAGE_CACHE_TTL = int(os.getenv('STOCK_PAGE_CACHE_TTL', '30'))
+
+    # 发货文件在内存中缓冲的上限（字节），超过后才写入临时文件
+    DELIVERY_SPOOL_MAX_SIZE = int(os.getenv('DELIVERY_SPOOL_MAX_SIZE', str(32 * 1024 * 1024)))
+
+    # 后台发货任务配置
+    DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', '4'))
+    DELIVERY_MAX_ATTEMPTS = int(os.getenv('DELIVERY_MAX_ATTEMPTS', '5'))
+    DELIVERY_RETRY_BASE = int(os.getenv('DELIVERY_RETRY_BASE', '10'))
+
+    # 账号文件存储（内容寻址）目录：未配置时放在协议号目录（BASE_PROTOCOL_PATH，默认 ./协议号）同级的 账号存储 下，
+    # 代理机器人配置了总部协议号目录的绝对路径后即与总部共用同一份存储，不依赖进程的启动目录
+    ACCOUNT_STORE_DIR = os.getenv('ACCOUNT_STORE_DIR') or os.path.join(
+        os.path.dirname(os.path.abspath(os.getenv('BASE_PROTOCOL_PATH', './协议号'))), '账号存储')
+
+    # TData 转换缓存：目录为空时放在账号存储目录同级的 TData缓存 下
+    TDATA_CACHE_DIR = os.getenv('TDATA_CACHE_DIR', '')
+    # TData 转换进程池：进程数默认等于 CPU 核数；已提交任务上限（0 为进程数×4）；单个账号转换超时（秒）；后台预转换排队上限
+    TDATA_CONVERT_WORKERS = int(os.getenv('TDATA_CONVERT_WORKERS', str(os.cpu_count() or 4)))
+    TDATA_CONVERT_QUEUE = int(os.getenv('TDATA_CONVERT_QUEUE', '0'))
+    TDATA_CONVERT_TIMEOUT = int(os.getenv('TDATA_CONVERT_TIMEOUT', '30'))
+    TDATA_BACKGROUND_QUEUE = int(os.getenv('TDATA_BACKGROUND_QUEUE', '20000'))
+    # 热销商品预转换：每隔多少秒检查一次、取前几名商品、每个商品最多预转换多少个库存账号
+    TDATA_WARM_INTERVAL = int(os.getenv('TDATA_WARM_INTERVAL', '600'))
+    TDATA_WARM_TOP = int(os.getenv('TDATA_WARM_TOP', '10'))
+    TDATA_WARM_PER_PRODUCT = int(os.getenv('TDATA_WARM_PER_PRODUCT', '200'))
+
+    # 账号健康缓存：最近一次检测为存活且未超过该秒数的账号，售后检测时直接跳过（0 为每次都检测）
+    HEALTH_CHECK_TTL = int(os.getenv('HEALTH_CHECK_TTL', '1800'))
     
     # 验证关键配置
     @classmethod
@@ -76,6 +125,29 @@ RESTOCK_GROUP = Config.RESTOCK_GROUP
 BOT_TOKEN = Config.BOT_TOKEN
 NOTIFY_CHANNEL_ID = Config.NOTIFY_CHANNEL_ID
 STOCK_NOTIFICATION_DELAY = Config.STOCK_NOTIFICATION_DELAY
+STOCK_RECONCILE_INTERVAL = Config.STOCK_RECONCILE_INTERVAL
+STOCK_RESERVE_TTL = Config.STOCK_RESERVE_TTL
+INGEST_CHUNK_SIZE = Config.INGEST_CHUNK_SIZE
+INGEST_EXTRACT_WORKERS = Config.INGEST_EXTRACT_WORKERS
+INGEST_WORKERS = Config.INGEST_WORKERS
+INGEST_MAX_ATTEMPTS = Config.INGEST_MAX_ATTEMPTS
+CATALOG_VERSION_CHECK_INTERVAL = Config.CATALOG_VERSION_CHECK_INTERVAL
+LEADERBOARD_REFRESH_INTERVAL = Config.LEADERBOARD_REFRESH_INTERVAL
+STOCK_PAGE_CACHE_TTL = Config.STOCK_PAGE_CACHE_TTL
+DELIVERY_SPOOL_MAX_SIZE = Config.DELIVERY_SPOOL_MAX_SIZE
+DELIVERY_WORKERS = Config.DELIVERY_WORKERS
+DELIVERY_MAX_ATTEMPTS = Config.DELIVERY_MAX_ATTEMPTS
+DELIVERY_RETRY_BASE = Config.DELIVERY_RETRY_BASE
+ACCOUNT_STORE_DIR = Config.ACCOUNT_STORE_DIR
+TDATA_CACHE_DIR = Config.TDATA_CACHE_DIR
+TDATA_CONVERT_WORKERS = Config.TDATA_CONVERT_WORKERS
+TDATA_CONVERT_QUEUE = Config.TDATA_CONVERT_QUEUE
+TDATA_CONVERT_TIMEOUT = Config.TDATA_CONVERT_TIMEOUT
+TDATA_BACKGROUND_QUEUE = Config.TDATA_BACKGROUND_QUEUE
+TDATA_WARM_INTERVAL = Config.TDATA_WARM_INTERVAL
+TDATA_WARM_TOP = Config.TDATA_WARM_TOP
+TDATA_WARM_PER_PRODUCT = Config.TDATA_WARM_PER_PRODUCT
+HEALTH_CHECK_TTL = Config.HEALTH_CHECK_TTL
 BOT_USERNAME = Config.BOT_USERNAME
 
 # ✅ 数据库连接和集合管理优化
@@ -105,6 +177,7 @@ class DatabaseManager:
         self.fenlei = self.bot_db['fenlei']
         self.ejfl = self.bot_db['ejfl']
         self.hb = self.bot_db['hb']
+        self.hb_stock = self.bot_db['hb_stock']
         self.xyh = self.bot_db['xyh']
         self.gmjlu = self.bot_db['gmjlu']
         self.fyb = self.bot_db['fyb']
@@ -113,6 +186,11 @@ class DatabaseManager:
         self.qb = self.bot_db['qb']
         self.zhuanz = self.bot_db['zhuanz']
         self.withdrawal_requests = self.bot_db['withdrawal_requests']
+        self.ingest_jobs = self.bot_db['ingest_jobs']
+        self.catalog_meta = self.bot_db['catalog_meta']
+        self.sales_stats = self.bot_db['sales_stats']
+        self.delivery_jobs = self.bot_db['delivery_jobs']
+        self.health_stats = self.bot_db['health_stats']
     
     def close(self):
         """关闭数据库连接"""
@@ -137,6 +215,7 @@ user_log = db_manager.user_log
 fenlei = db_manager.fenlei
 ejfl = db_manager.ejfl
 hb = db_manager.hb
+hb_stock = db_manager.hb_stock
 xyh = db_manager.xyh
 gmjlu = db_manager.gmjlu
 fyb = db_manager.fyb
@@ -145,6 +224,11 @@ hongbao = db_manager.hongbao
 qb = db_manager.qb
 zhuanz = db_manager.zhuanz
 withdrawal_requests = db_manager.withdrawal_requests
+ingest_jobs = db_manager.ingest_jobs
+catalog_meta = db_manager.catalog_meta
+sales_stats = db_manager.sales_stats
+delivery_jobs = db_manager.delivery_jobs
+health_stats = db_manager.health_stats
 
 # ✅ 库存通知管理优化
 class StockNotificationManager:
@@ -162,13 +246,13 @@ class StockNotificationManager:
             self.bot_instance = Bot(token=BOT_TOKEN)
         return self.bot_instance
     
-    def add_stock_notification(self, nowuid: str, projectname: str):
+    def add_stock_notification(self, nowuid: str, projectname: str, count: int = 1):
         """添加库存通知"""
         with self.notification_lock:
             if nowuid not in self.notify_cache:
-                self.notify_cache[nowuid] = {'projectname': projectname, 'count': 1}
+                self.notify_cache[nowuid] = {'projectname': projectname, 'count': count}
             else:
-                self.notify_cache[nowuid]['count'] += 1
+                self.notify_cache[nowuid]['count'] += count
     
     def send_notification(self, nowuid: str, projectname: str, price: float, stock: int, count: int):
         """发送单个商品的库存通知"""
@@ -273,7 +357,7 @@ class StockNotificationManager:
                 product_name = f"{parent_name}/{product['projectname']}"
                 
                 price = float(product.get('money', 0))
-                stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+                stock = get_product_stock(nowuid)
                 
                 # 发送单独的通知消息
                 self.send_notification(nowuid, product_name, price, stock, info['count'])
@@ -405,20 +489,30 @@ def fanyibao(projectname, text, fanyi):
     except Exception as e:
         logging.error(f"❌ 插入翻译包失败：{projectname} - {e}")
 
-def goumaijilua(leixing, bianhao, user_id, projectname, text, ts, timer, count):
-    """购买记录插入函数"""
+def goumaijilua(leixing, bianhao, user_id, projectname, text, ts, timer, count, nowuid=None, accounts=None):
+    """购买记录插入函数
+
+    Args:
+        accounts: 协议号/直登号订单的账号名列表，重新下载时按此重新打包
+    """
     try:
-        gmjlu.insert_one({
+        record = {
             'leixing': leixing,
             'bianhao': bianhao,
             'user_id': user_id,
             'projectname': projectname,
+            'nowuid': nowuid,
             'text': text,
             'ts': ts,
             'timer': timer,
             'count': count   # ✅ 记录实际数量
-        })
+        }
+        if accounts is not None:
+            record['accounts'] = list(accounts)
+        gmjlu.insert_one(record)
         logging.info(f"✅ 插入购买记录：{user_id} - {projectname}")
+        if nowuid:
+            record_sale(nowuid, count)
     except Exception as e:
         logging.error(f"❌ 插入购买记录失败：{user_id} - {projectname} - {e}")
 
@@ -456,6 +550,7 @@ def shangchuanhaobao(leixing, uid, nowuid, hbid, projectname, timer, remark='',
             'timer': timer,
             'remark': remark
         })
+        stock_counter_inc(nowuid, available=1)
         logging.info(f"✅ 上架商品成功：{projectname} (nowuid={nowuid})")
 
         # ✅ 使用优化的库存通知管理器
@@ -470,6 +565,112 @@ def shangchuanhaobao(leixing, uid, nowuid, hbid, projectname, timer, remark='',
         logging.error(f"❌ 上架商品失败：{projectname} - {e}")
 
 
+def new_hbid() -> str:
+    """生成24位库存ID（与 bot.generate_24bit_uid 规则一致）"""
+    return hashlib.md5(str(uuid.uuid4()).encode()).hexdigest()[:24]
+
+
+def bulk_shangchuanhaobao(leixing, uid, nowuid, projectnames, timer, remark='', extra=None,
+                          total=None, progress_callback=None, chunk_size=None, extra_of=None) -> int:
+    """批量上架商品
+
+    按块处理 projectnames（可为生成器）：每块用一次 $in 查询去重，再用 insert_many(ordered=False)
+    写入；(nowuid, projectname) 唯一索引兜底并发上传造成的重复。
+
+    Args:
+        projectnames: 账号名迭代器
+        extra: 附加到每条记录的字段
+        extra_of: 按账号名返回附加字段的函数；重复上传的在售账号也用它更新
+                  （新上传的文件覆盖旧文件，与原来解压覆盖平铺目录的行为一致）
+        total: 总数（用于进度回调，可选）
+        progress_callback: 回调 progress_callback(已处理数, 总数)
+
+    Returns:
+        int: 实际新上架的数量
+
+    Raises:
+        写库失败（重复记录以外的错误）时向上抛出，由入库任务按失败重试；已写入的记录重试时按去重跳过
+    """
+    chunk_size = chunk_size or INGEST_CHUNK_SIZE
+    seen = set()
+    inserted_total = 0
+    processed = 0
+
+    def flush(chunk):
+        names = list(dict.fromkeys(chunk))
+        existing = {
+            doc['projectname']
+            for doc in hb.find({'nowuid': nowuid, 'projectname': {'$in': names}}, {'projectname': 1, '_id': 0})
+        }
+        docs = []
+        for name in names:
+            if name in existing:
+                continue
+            doc = {
+                'leixing': leixing,
+                'uid': uid,
+                'nowuid': nowuid,
+                'hbid': new_hbid(),
+                'projectname': name,
+                'state': 0,
+                'timer': timer,
+                'remark': remark
+            }
+            if extra:
+                doc.update(extra)
+            if extra_of:
+                doc.update(extra_of(name))
+            docs.append(doc)
+        if extra_of and existing:
+            updates = [
+                pymongo.UpdateOne({'nowuid': nowuid, 'projectname': name, 'state': 0}, {'$set': fields})
+                for name, fields in ((name, extra_of(name)) for name in existing) if fields
+            ]
+            if updates:
+                hb.bulk_write(updates, ordered=False)
+        if not docs:
+            return 0
+        try:
+            inserted = len(hb.insert_many(docs, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            # 唯一索引冲突的记录被跳过，其余照常写入；其他写入错误向上抛出
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                stock_counter_inc(nowuid, available=e.details.get('nInserted', 0))
+                raise
+            inserted = e.details.get('nInserted', 0)
+            logging.warning(f"⚠️ 批量上架跳过重复记录：nowuid={nowuid}, "
+                            f"跳过 {len(e.details.get('writeErrors', []))} 条")
+        if inserted:
+            stock_counter_inc(nowuid, available=inserted)
+        return inserted
+
+    chunk = []
+    try:
+        for name in projectnames:
+            processed += 1
+            if not name or name in seen:
+                continue
+            seen.add(name)
+            chunk.append(name)
+            if len(chunk) >= chunk_size:
+                inserted_total += flush(chunk)
+                chunk = []
+                if progress_callback:
+                    progress_callback(processed, total or processed)
+        if chunk:
+            inserted_total += flush(chunk)
+        if progress_callback:
+            progress_callback(processed, total or processed)
+    except Exception as e:
+        logging.error(f"❌ 批量上架失败：nowuid={nowuid}, 已新增 {inserted_total} - {e}")
+        raise
+    finally:
+        if inserted_total:
+            stock_manager.add_stock_notification(nowuid, leixing, inserted_total)
+    logging.info(f"✅ 批量上架完成：nowuid={nowuid}, 新增 {inserted_total} / 处理 {processed}")
+    return inserted_total
+
+
 
 
     
@@ -494,6 +695,7 @@ def erjifenleibiao(uid, nowuid, projectname, row):
         ''',
         'money': 0
     })
+    bump_catalog_version()
 
 
 def fenleibiao(uid, projectname,row):
@@ -502,6 +704,7 @@ def fenleibiao(uid, projectname,row):
         'projectname': projectname,
         'row': row
     })
+    bump_catalog_version()
 
 def user_logging(uid, projectname , user_id, today_money, today_time):
     log_data = {
@@ -541,15 +744,729 @@ def kehuduanurl(api, key):
     except Exception as e:
         logging.error(f"❌ 插入客户端URL失败：{api} - {e}")
 
-# ✅ 新增：实用工具函数
-def get_product_stock(nowuid: str) -> int:
-    """获取商品库存数量"""
+# ================================ 商品库存计数器 ================================
+# hb_stock 每个 nowuid 一条文档：{'nowuid', 'available', 'sold', 'update_time'}
+# 所有改变 hb.state 的写路径在写完 hb 之后调用 stock_counter_inc 原子更新计数，
+# 读路径直接读计数器，不再对 hb 做 count_documents。
+# 计数器缺失时按 hb 实际数据重建；reconcile_stock_counters 定期纠正漂移。
+# 本进程每次改动计数器都会递增 _stock_version，供库存页面等缓存判断是否失效。
+
+_stock_version = 0
+
+
+def bump_stock_version():
+    """标记本进程内库存计数已变化"""
+    global _stock_version
+    _stock_version += 1
+
+
+def get_stock_version() -> int:
+    """本进程内的库存版本号（仅用于缓存失效判断，其他进程的变化靠缓存有效期兜底）"""
+    return _stock_version
+
+
+def _count_stock_from_hb(nowuid: str) -> dict:
+    """从 hb 表统计单个商品的库存/已售数量"""
+    counts = {'available': 0, 'sold': 0}
+    for item in hb.aggregate([
+        {'$match': {'nowuid': nowuid, 'state': {'$in': [0, 1]}}},
+        {'$group': {'_id': '$state', 'count': {'$sum': 1}}}
+    ]):
+        if item['_id'] == 0:
+            counts['available'] = item['count']
+        elif item['_id'] == 1:
+            counts['sold'] = item['count']
+    return counts
+
+def rebuild_stock_counter(nowuid: str) -> dict:
+    """按 hb 实际数据重建单个商品的计数器"""
+    counts = _count_stock_from_hb(nowuid)
+    hb_stock.update_one(
+        {'nowuid': nowuid},
+        {'$set': {**counts, 'update_time': datetime.now()}},
+        upsert=True
+    )
+    bump_stock_version()
+    return counts
+
+def stock_counter_inc(nowuid: str, available: int = 0, sold: int = 0):
+    """原子更新商品库存计数器
+
+    Args:
+        available: 可售库存增量（上架 +1，售出/删除为负数）
+        sold: 已售数量增量
+    """
+    if not nowuid or (available == 0 and sold == 0):
+        return
+    try:
+        result = hb_stock.update_one(
+            {'nowuid': nowuid},
+            {'$inc': {'available': available, 'sold': sold}, '$set': {'update_time': datetime.now()}}
+        )
+        bump_stock_version()
+        if result.matched_count == 0:
+            # 计数器尚未建立：hb 已经写入，直接按实际数据重建即可包含本次变更
+            rebuild_stock_counter(nowuid)
+    except Exception as e:
+        logging.error(f"❌ 更新库存计数器失败：nowuid={nowuid} - {e}")
+
+def reset_stock_counter(nowuid: str):
+    """删除商品时移除对应计数器"""
+    try:
+        hb_stock.delete_one({'nowuid': nowuid})
+        bump_stock_version()
+    except Exception as e:
+        logging.error(f"❌ 删除库存计数器失败：nowuid={nowuid} - {e}")
+
+def get_stock_counts(nowuid: str) -> dict:
+    """获取商品库存与已售数量 {'available': x, 'sold': y}"""
+    try:
+        doc = hb_stock.find_one({'nowuid': nowuid}, {'_id': 0, 'available': 1, 'sold': 1})
+        if doc is None:
+            return rebuild_stock_counter(nowuid)
+        return {'available': max(int(doc.get('available', 0)), 0), 'sold': max(int(doc.get('sold', 0)), 0)}
+    except Exception as e:
+        logging.error(f"❌ 获取库存计数失败：nowuid={nowuid} - {e}")
+        return {'available': 0, 'sold': 0}
+
+def get_stock_map(nowuids=None) -> dict:
+    """一次查询获取多个商品的可售库存 {nowuid: available}
+
+    Args:
+        nowuids: nowuid 列表；为 None 时返回全部计数器
+    """
+    try:
+        query = {} if nowuids is None else {'nowuid': {'$in': list(nowuids)}}
+        stock_map = {
+            doc['nowuid']: max(int(doc.get('available', 0)), 0)
+            for doc in hb_stock.find(query, {'_id': 0, 'nowuid': 1, 'available': 1})
+        }
+        if nowuids is not None:
+            for nowuid in nowuids:
+                if nowuid and nowuid not in stock_map:
+                    stock_map[nowuid] = rebuild_stock_counter(nowuid)['available']
+        return stock_map
+    except Exception as e:
+        logging.error(f"❌ 批量获取库存失败：{e}")
+        return {}
+
+def reconcile_stock_counters() -> int:
+    """对账任务：用一次聚合重算全部计数器，纠正漂移
+
+    Returns:
+        int: 被修正的计数器数量
+    """
+    try:
+        actual = {}
+        for item in hb.aggregate([
+            {'$match': {'state': {'$in': [0, 1]}}},
+            {'$group': {'_id': {'nowuid': '$nowuid', 'state': '$state'}, 'count': {'$sum': 1}}}
+        ]):
+            nowuid = item['_id'].get('nowuid')
+            if not nowuid:
+                continue
+            counts = actual.setdefault(nowuid, {'available': 0, 'sold': 0})
+            counts['available' if item['_id'].get('state') == 0 else 'sold'] = item['count']
+
+        fixed = 0
+        existing = {doc['nowuid']: doc for doc in hb_stock.find({}, {'_id': 0})}
+        for nowuid in set(actual) | set(existing):
+            counts = actual.get(nowuid, {'available': 0, 'sold': 0})
+            doc = existing.get(nowuid)
+            if doc and doc.get('available') == counts['available'] and doc.get('sold') == counts['sold']:
+                continue
+            hb_stock.update_one(
+                {'nowuid': nowuid},
+                {'$set': {**counts, 'update_time': datetime.now()}},
+                upsert=True
+            )
+            fixed += 1
+            if doc:
+                logging.warning(f"⚠️ 库存计数器漂移已修正：nowuid={nowuid}, "
+                                f"{doc.get('available')}/{doc.get('sold')} -> {counts['available']}/{counts['sold']}")
+        if fixed:
+            bump_stock_version()
+        logging.info(f"✅ 库存计数器对账完成：{len(actual)} 个商品，修正 {fixed} 个")
+        return fixed
+    except Exception as e:
+        logging.error(f"❌ 库存计数器对账失败：{e}")
+        return 0
+
+def init_stock_counters():
+    """初始化库存计数器索引，计数器为空时全量构建"""
+    try:
+        hb_stock.create_index('nowuid', unique=True)
+        if hb_stock.estimated_document_count() == 0:
+            reconcile_stock_counters()
+        return True
+    except Exception as e:
+        logging.error(f"❌ 库存计数器初始化失败：{e}")
+        return False
+
+init_stock_counters()
+
+# ================================ 商品目录快照 ================================
+# 一级分类(fenlei) + 二级分类(ejfl) 的进程内只读视图。
+# 管理员修改目录后调用 bump_catalog_version()：本进程立即失效，
+# 其他进程（代理机器人）每 CATALOG_VERSION_CHECK_INTERVAL 秒比对一次版本号后重建。
+
+class CatalogSnapshot:
+    """商品目录只读快照，调用方不要修改其中的文档"""
+
+    def __init__(self, version, fenlei_docs, ejfl_docs):
+        self.version = version
+        self.built_at = time.time()
+        self.categories = tuple(sorted(fenlei_docs, key=lambda d: d.get('row', 0)))
+        self.products = tuple(sorted(ejfl_docs, key=lambda d: d.get('row', 0)))
+        self.category_by_uid = MappingProxyType({d.get('uid'): d for d in self.categories})
+        self.product_by_nowuid = MappingProxyType({d.get('nowuid'): d for d in self.products})
+        grouped = {}
+        for d in self.products:
+            grouped.setdefault(d.get('uid'), []).append(d)
+        self.products_by_uid = MappingProxyType({uid: tuple(docs) for uid, docs in grouped.items()})
+
+    def category(self, uid):
+        return self.category_by_uid.get(uid)
+
+    def product(self, nowuid):
+        return self.product_by_nowuid.get(nowuid)
+
+    def category_products(self, uid) -> tuple:
+        """某一级分类下的二级分类，按 row 排序"""
+        return self.products_by_uid.get(uid, ())
+
+    def listed_products(self) -> list:
+        """所属一级分类仍存在的二级分类"""
+        return [p for p in self.products if p.get('uid') in self.category_by_uid]
+
+
+_catalog_lock = threading.Lock()
+_catalog_snapshot = None
+_catalog_checked_at = 0.0
+
+
+def _read_catalog_version() -> int:
+    doc = catalog_meta.find_one({'_id': 'catalog'})
+    return doc.get('version', 0) if doc else 0
+
+
+def get_catalog() -> CatalogSnapshot:
+    """获取商品目录快照
+
+    版本号未变化时直接返回内存中的快照，不访问 fenlei / ejfl。
+    """
+    global _catalog_snapshot, _catalog_checked_at
+    snapshot = _catalog_snapshot
+    if snapshot is not None and time.time() - _catalog_checked_at < CATALOG_VERSION_CHECK_INTERVAL:
+        return snapshot
+
+    with _catalog_lock:
+        if _catalog_snapshot is not None and time.time() - _catalog_checked_at < CATALOG_VERSION_CHECK_INTERVAL:
+            return _catalog_snapshot
+        try:
+            version = _read_catalog_version()
+            if _catalog_snapshot is None or _catalog_snapshot.version != version:
+                _catalog_snapshot = CatalogSnapshot(version, list(fenlei.find({})), list(ejfl.find({})))
+                logging.info(f"📚 商品目录快照已重建：version={version}, 一级分类 {len(_catalog_snapshot.categories)}，"
+                             f"二级分类 {len(_catalog_snapshot.products)}")
+            _catalog_checked_at = time.time()
+        except Exception as e:
+            logging.error(f"❌ 重建商品目录快照失败：{e}")
+            if _catalog_snapshot is None:
+                return CatalogSnapshot(-1, [], [])
+        return _catalog_snapshot
+
+
+def bump_catalog_version():
+    """目录发生变化（分类增删改、价格、排序、说明）后调用"""
+    global _catalog_snapshot
+    try:
+        catalog_meta.update_one({'_id': 'catalog'}, {'$inc': {'version': 1}}, upsert=True)
+    except Exception as e:
+        logging.error(f"❌ 更新商品目录版本失败：{e}")
+    with _catalog_lock:
+        _catalog_snapshot = None
+
+
+# ================================ 热销排行榜 ================================
+# sales_stats 按 (nowuid, hour) 累加销量，hour 为北京时间 'YYYY-MM-DD HH'，另有 hour='all' 的累计桶。
+# 每个时间窗口在内存中保存一份已排序的排行，读取为 O(k)；本进程写入的销量实时计入，
+# 其他进程（代理机器人）的销量在下次刷新时合并。
+
+LEADERBOARD_WINDOWS = {'24h': 24, '7d': 24 * 7, '30d': 24 * 30, 'all': None}
+SALES_STATS_RETENTION_HOURS = 24 * 31
+
+
+def _sales_hour_key(dt=None) -> str:
+    return (dt or get_beijing_now()).strftime('%Y-%m-%d %H')
+
+
+class SalesLeaderboard:
+    """按商品、时间窗口统计的热销排行"""
+
+    def __init__(self, refresh_interval: int):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._boards = {}  # window -> {'built_at', 'counts', 'ranking'}
+
+    def record(self, nowuid: str, quantity: int):
+        """记录一笔销量（退款传负数）"""
+        if not nowuid or not quantity:
+            return
+        try:
+            for hour in (_sales_hour_key(), 'all'):
+                sales_stats.update_one({'nowuid': nowuid, 'hour': hour},
+                                       {'$inc': {'count': quantity}}, upsert=True)
+        except Exception as e:
+            logging.error(f"❌ 记录销量失败：nowuid={nowuid} - {e}")
+            return
+        with self._lock:
+            for board in self._boards.values():
+                board['counts'][nowuid] = board['counts'].get(nowuid, 0) + quantity
+                board['ranking'] = None
+
+    def _load(self, window: str) -> dict:
+        hours = LEADERBOARD_WINDOWS[window]
+        if hours is None:
+            match = {'hour': 'all'}
+        else:
+            start = _sales_hour_key(get_beijing_now() - timedelta(hours=hours - 1))
+            match = {'hour': {'$gte': start, '$ne': 'all'}}
+        pipeline = [
+            {'$match': match},
+            {'$group': {'_id': '$nowuid', 'count': {'$sum': '$count'}}}
+        ]
+        return {doc['_id']: doc['count'] for doc in sales_stats.aggregate(pipeline)}
+
+    def top(self, window: str = '7d', k: int = 10) -> list:
+        """返回 [(nowuid, 销量), ...]，按销量降序"""
+        if window not in LEADERBOARD_WINDOWS:
+            raise ValueError(f'未知的排行窗口：{window}')
+        with self._lock:
+            board = self._boards.get(window)
+            stale = board is None or time.time() - board['built_at'] >= self.refresh_interval
+        if stale:
+            try:
+                counts = self._load(window)
+                with self._lock:
+                    board = self._boards[window] = {'built_at': time.time(), 'counts': counts, 'ranking': None}
+            except Exception as e:
+                logging.error(f"❌ 刷新热销排行失败：window={window} - {e}")
+                if board is None:
+                    return []
+        with self._lock:
+            if board['ranking'] is None:
+                board['ranking'] = sorted(((n, c) for n, c in board['counts'].items() if c > 0),
+                                          key=lambda item: -item[1])
+            return board['ranking'][:k]
+
+
+def backfill_sales_stats():
+    """从历史 gmjlu / agent_orders 回填 sales_stats（主机器人启动时、开始接单前调用）
+
+    以历史记录为准直接写入（$set）保留期内的小时桶和累计桶，重复执行结果相同；
+    全部写完后才记录完成标记，中途失败下次启动会重新回填。
+
+    Returns:
+        int: 回填的桶数量，已回填过时返回 0
+    """
+    if catalog_meta.find_one({'_id': 'sales_backfill', 'completed_at': {'$exists': True}}):
+        return 0
+    cutoff = _sales_hour_key(get_beijing_now() - timedelta(hours=SALES_STATS_RETENTION_HOURS))
+
+    name_to_nowuid = {}
+    for product in ejfl.find({}, {'projectname': 1, 'nowuid': 1}):
+        name_to_nowuid.setdefault(product.get('projectname'), product.get('nowuid'))
+
+    buckets = {}
+
+    def add(nowuid, hour, count):
+        if nowuid and count:
+            # 超出保留期的小时桶会被 prune_sales_stats 删除，只计入累计桶
+            for key in ((hour, 'all') if hour >= cutoff else ('all',)):
+                buckets[(nowuid, key)] = buckets.get((nowuid, key), 0) + count
+
+    for doc in gmjlu.aggregate([
+        {'$match': {'timer': {'$type': 'string'}}},
+        {'$group': {'_id': {'p': '$projectname', 'n': '$nowuid', 'h': {'$substrBytes': ['$timer', 0, 13]}},
+                    'count': {'$sum': {'$ifNull': ['$count', 1]}}}}
+    ]):
+        add(doc['_id'].get('n') or name_to_nowuid.get(doc['_id'].get('p')), doc['_id']['h'], doc['count'])
+
+    for doc in agent_orders.aggregate([
+        {'$match': {'status': 'completed', 'order_time': {'$type': 'string'}}},
+        {'$group': {'_id': {'n': '$original_nowuid', 'h': {'$substrBytes': ['$order_time', 0, 13]}},
+                    'count': {'$sum': {'$ifNull': ['$quantity', 1]}}}}
+    ]):
+        add(doc['_id'].get('n'), doc['_id']['h'], doc['count'])
+
+    if buckets:
+        sales_stats.bulk_write([
+            pymongo.UpdateOne({'nowuid': nowuid, 'hour': hour}, {'$set': {'count': count}}, upsert=True)
+            for (nowuid, hour), count in buckets.items()
+        ], ordered=False)
+    catalog_meta.update_one({'_id': 'sales_backfill'}, {'$set': {'completed_at': datetime.now(), 'buckets': len(buckets)}},
+                            upsert=True)
+    logging.info(f"✅ 销量统计回填完成：{len(buckets)} 个桶")
+    return len(buckets)
+
+
+def prune_sales_stats() -> int:
+    """删除超出最大窗口的小时桶"""
+    try:
+        cutoff = _sales_hour_key(get_beijing_now() - timedelta(hours=SALES_STATS_RETENTION_HOURS))
+        return sales_stats.delete_many({'hour': {'$lt': cutoff, '$ne': 'all'}}).deleted_count
+    except Exception as e:
+        logging.error(f"❌ 清理销量统计失败：{e}")
+        return 0
+
+
+sales_leaderboard = SalesLeaderboard(LEADERBOARD_REFRESH_INTERVAL)
+
+
+def record_sale(nowuid: str, quantity: int):
+    sales_leaderboard.record(nowuid, quantity)
+
+
+def get_top_sellers(window: str = '7d', k: int = 10) -> list:
+    """热销排行 [(nowuid, 销量), ...]，window 为 24h / 7d / 30d / all"""
+    return sales_leaderboard.top(window, k)
+
+
+# ================================ 库存预留引擎 ================================
+# 购买时先把 N 条 state=0 的账号原子地改成 state=2（预留中），带上预留令牌和过期时间。
+# 更新条件里带 state=0，同一条账号只可能被一个订单抢到，不会超卖。
+# 发货成功后 commit_reservation 标记为已售（state=1）；
+# 发货失败 release_reservation 退回库存；进程崩溃遗留的预留由 release_expired_reservations 到期回收。
+
+STOCK_STATE_RESERVED = 2
+
+def reserve_stock(nowuid: str, quantity: int, owner_id=None, ttl: int = None, extra_filter: dict = None,
+                  max_attempts: int = 3, sort=None, token: str = None):
+    """为一个订单原子预留 quantity 条库存
+
+    Args:
+        owner_id: 预留人（用户ID），仅用于排查
+        ttl: 预留有效期（秒），默认 STOCK_RESERVE_TTL
+        extra_filter: 额外的筛选条件，例如 {'leixing': '谷歌'}
+        max_attempts: 并发抢占失败时的重试次数
+        sort: 候选账号的排序，例如 [('health.checked_at', -1)] 优先取最近检测过的账号
+        token: 追加到已有的预留令牌下（补号），默认生成新令牌
+
+    Returns:
+        (token, docs): 预留令牌和本次预留的账号文档列表；库存不足时 docs 少于 quantity
+    """
+    token = token or uuid.uuid4().hex
+    if quantity <= 0:
+        return token, []
+
+    expire_at = datetime.now() + timedelta(seconds=ttl or STOCK_RESERVE_TTL)
+    query = {'nowuid': nowuid, 'state': 0}
+    if extra_filter:
+        query.update(extra_filter)
+
+    reserved = []
+    try:
+        for _ in range(max_attempts):
+            need = quantity - len(reserved)
+            if need <= 0:
+                break
+            cursor = hb.find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            candidates = list(cursor.limit(need))
+            if not candidates:
+                break
+            result = hb.update_many(
+                {'_id': {'$in': [doc['_id'] for doc in candidates]}, 'state': 0},
+                {'$set': {
+                    'state': STOCK_STATE_RESERVED,
+                    'reserve_token': token,
+                    'reserve_owner': owner_id,
+                    'reserve_expire': expire_at
+                }}
+            )
+            if result.modified_count == len(candidates):
+                reserved.extend(candidates)
+            else:
+                # 部分候选被其他订单抢走，只保留确实属于本令牌的（令牌下已有的预留不计入本次）
+                claimed_ids = {doc['_id'] for doc in hb.find({'reserve_token': token}, {'_id': 1})}
+                reserved = [doc for doc in reserved + candidates if doc['_id'] in claimed_ids]
+        if reserved:
+            stock_counter_inc(nowuid, available=-len(reserved))
+        logging.info(f"✅ 预留库存：nowuid={nowuid}, 需要={quantity}, 预留={len(reserved)}, token={token}")
+    except Exception as e:
+        logging.error(f"❌ 预留库存失败：nowuid={nowuid} - {e}")
+    return token, reserved
+
+def commit_reservation(nowuid: str, token: str, user_id, timer: str = None, ids=None) -> int:
+    """确认预留：把预留账号标记为已售出
+
+    Args:
+        ids: 只确认其中一部分账号的 _id 列表，默认全部
+
+    Returns:
+        int: 标记为已售的数量
+    """
+    try:
+        query = {'reserve_token': token, 'state': STOCK_STATE_RESERVED}
+        if ids is not None:
+            query['_id'] = {'$in': list(ids)}
+        result = hb.update_many(query, {
+            '$set': {'state': 1, 'yssj': timer or beijing_now_str(), 'gmid': user_id},
+            '$unset': {'reserve_token': '', 'reserve_owner': '', 'reserve_expire': ''}
+        })
+        stock_counter_inc(nowuid, sold=result.modified_count)
+        return result.modified_count
+    except Exception as e:
+        logging.error(f"❌ 确认预留失败：nowuid={nowuid}, token={token} - {e}")
+        return 0
+
+def release_reservation(nowuid: str, token: str, ids=None) -> int:
+    """释放预留：把账号退回可售库存
+
+    Returns:
+        int: 退回库存的数量
+    """
+    try:
+        query = {'reserve_token': token, 'state': STOCK_STATE_RESERVED}
+        if ids is not None:
+            query['_id'] = {'$in': list(ids)}
+        result = hb.update_many(query, {
+            '$set': {'state': 0},
+            '$unset': {'reserve_token': '', 'reserve_owner': '', 'reserve_expire': ''}
+        })
+        stock_counter_inc(nowuid, available=result.modified_count)
+        if result.modified_count:
+            logging.info(f"↩️ 释放预留库存：nowuid={nowuid}, 数量={result.modified_count}, token={token}")
+        return result.modified_count
+    except Exception as e:
+        logging.error(f"❌ 释放预留失败：nowuid={nowuid}, token={token} - {e}")
+        return 0
+
+def discard_reserved(token: str, ids) -> int:
+    """删除预留中的账号记录（坏号），预留时已扣减过可售库存，无需再改计数器"""
     try:
-        return hb.count_documents({'nowuid': nowuid, 'state': 0})
+        result = hb.delete_many({'reserve_token': token, 'state': STOCK_STATE_RESERVED, '_id': {'$in': list(ids)}})
+        return result.deleted_count
     except Exception as e:
-        logging.error(f"❌ 获取库存失败：nowuid={nowuid} - {e}")
+        logging.error(f"❌ 删除预留账号失败：token={token} - {e}")
         return 0
 
+def quarantine_reserved(nowuid: str, token: str, ids) -> int:
+    """把预留中的坏号移入隔离状态（state=3），保留记录和文件供管理员复核
+
+    预留时已扣减过可售库存，隔离账号不计入库存，无需再改计数器
+
+    Returns:
+        int: 隔离的账号数量
+    """
+    try:
+        result = hb.update_many(
+            {'reserve_token': token, 'state': STOCK_STATE_RESERVED, '_id': {'$in': list(ids)}},
+            {'$set': {'state': STOCK_STATE_QUARANTINED, 'quarantined_at': datetime.now()},
+             '$unset': {'reserve_token': '', 'reserve_owner': '', 'reserve_expire': ''}}
+        )
+        if result.modified_count:
+            logging.info(f"🚧 隔离坏号：nowuid={nowuid}, 数量={result.modified_count}, token={token}")
+        return result.modified_count
+    except Exception as e:
+        logging.error(f"❌ 隔离预留账号失败：nowuid={nowuid}, token={token} - {e}")
+        return 0
+
+def release_expired_reservations() -> int:
+    """回收过期的预留（发货进程崩溃或超时遗留），退回可售库存"""
+    released = 0
+    try:
+        expired = hb.aggregate([
+            {'$match': {'state': STOCK_STATE_RESERVED, 'reserve_expire': {'$lt': datetime.now()}}},
+            {'$group': {'_id': {'nowuid': '$nowuid', 'token': '$reserve_token'}}}
+        ])
+        for item in expired:
+            released += release_reservation(item['_id'].get('nowuid'), item['_id'].get('token'))
+        if released:
+            logging.warning(f"⚠️ 回收过期预留库存 {released} 条")
+    except Exception as e:
+        logging.error(f"❌ 回收过期预留失败：{e}")
+    return released
+
+# ================================ 账号健康缓存 ================================
+# 售后检测结果写回 hb.health：{'status', 'message', 'checked_at', 'proxy'}。
+# 最近 HEALTH_CHECK_TTL 秒内检测为存活的账号，下次购买时不再重复登录检测。
+# health_stats 按商品累计各状态的检测次数，用于统计各商品的冻结/封禁比例。
+# 库存巡检（agent/health_sweeper.py）和购买检测出的封禁/冻结账号改为 state=3（隔离），不再出售也不计入库存；
+# 发消息超时、发送频率受限等暂时性问题记为未知，不隔离。
+# 管理员可用代理Bot的 /quarantine 命令重新检测（已恢复的放回库存）或直接放回隔离账号。
+
+HEALTH_STATUSES = ('normal', 'banned', 'frozen', 'unknown')
+QUARANTINE_STATUSES = ('banned', 'frozen')
+# 购买/补号预留的筛选条件：跳过最近检测为坏号的账号（隔离失败或检测后仍在售的），从未检测的照常预留
+HEALTHY_STOCK_FILTER = {'health.status': {'$nin': list(QUARANTINE_STATUSES)}}
+STOCK_STATE_QUARANTINED = 3
+
+def is_health_fresh(doc: dict, ttl: int = None) -> bool:
+    """账号最近一次检测是否为存活且仍在有效期内"""
+    ttl = HEALTH_CHECK_TTL if ttl is None else ttl
+    health = doc.get('health') or {}
+    if ttl <= 0 or health.get('status') != 'normal' or not health.get('checked_at'):
+        return False
+    return datetime.now() - health['checked_at'] < timedelta(seconds=ttl)
+
+def record_account_health(nowuid: str, results: dict) -> int:
+    """把一批检测结果写回 hb 并累计到 health_stats
+
+    Args:
+        results: {'normal': [...], 'banned': [...], ...}，每项带 db_id、message，可选 proxy；
+                 带 health_cached 的项是直接使用缓存结果的账号，不重复记录
+
+    Returns:
+        int: 写回的账号数量
+    """
+    now = datetime.now()
+    updates = []
+    counts = {}
+    for status, items in results.items():
+        for item in items:
+            if item.get('health_cached') or item.get('db_id') is None:
+                continue
+            updates.append(pymongo.UpdateOne({'_id': item['db_id']}, {'$set': {'health': {
+                'status': status,
+                'message': item.get('message', ''),
+                'checked_at': now,
+                'proxy': item.get('proxy')
+            }}}))
+            counts[status] = counts.get(status, 0) + 1
+    if not updates:
+        return 0
+    try:
+        hb.bulk_write(updates, ordered=False)
+        health_stats.update_one(
+            {'nowuid': nowuid},
+            {'$inc': dict({'checks': len(updates)}, **counts), '$set': {'updated_at': now}},
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"❌ 记录账号健康状态失败：nowuid={nowuid} - {e}")
+        return 0
+    return len(updates)
+
+def claim_stale_stock(nowuid: str, limit: int, max_age: int, claim_ttl: int = 600, leixing: str = '协议号'):
+    """认领一批待巡检的在售账号：从未检测或上次检测早于 max_age 秒，最久未检测的优先
+
+    认领只打标记不改 state，账号仍可正常出售；多个巡检进程不会重复检测同一批账号。
+
+    Returns:
+        (token, docs)
+    """
+    token = uuid.uuid4().hex
+    now = datetime.now()
+    query = {
+        'nowuid': nowuid,
+        'state': 0,
+        'leixing': leixing,
+        '$and': [
+            {'$or': [{'health.checked_at': {'$exists': False}},
+                     {'health.checked_at': {'$lt': now - timedelta(seconds=max_age)}}]},
+            {'$or': [{'sweep_expire': {'$exists': False}}, {'sweep_expire': {'$lt': now}}]}
+        ]
+    }
+    try:
+        candidates = list(hb.find(query, {'_id': 1}).sort('health.checked_at', 1).limit(limit))
+        if not candidates:
+            return token, []
+        hb.update_many(
+            dict(query, _id={'$in': [doc['_id'] for doc in candidates]}),
+            {'$set': {'sweep_token': token, 'sweep_expire': now + timedelta(seconds=claim_ttl)}}
+        )
+        return token, list(hb.find({'sweep_token': token}))
+    except Exception as e:
+        logging.error(f"❌ 认领巡检库存失败：nowuid={nowuid} - {e}")
+        return token, []
+
+def finish_health_sweep(nowuid: str, token: str, results: dict) -> int:
+    """写回巡检结果，把仍在售的封禁/冻结账号移入隔离状态
+
+    Returns:
+        int: 隔离的账号数量
+    """
+    record_account_health(nowuid, results)
+    quarantined = 0
+    try:
+        bad_ids = [item['db_id'] for status in QUARANTINE_STATUSES
+                   for item in results.get(status, []) if item.get('db_id') is not None]
+        if bad_ids:
+            # 检测期间已被买走（预留/售出）的账号不动，由购买流程自行处理
+            quarantined = hb.update_many(
+                {'_id': {'$in': bad_ids}, 'state': 0},
+                {'$set': {'state': STOCK_STATE_QUARANTINED, 'quarantined_at': datetime.now()}}
+            ).modified_count
+            stock_counter_inc(nowuid, available=-quarantined)
+        hb.update_many({'sweep_token': token}, {'$unset': {'sweep_token': '', 'sweep_expire': ''}})
+    except Exception as e:
+        logging.error(f"❌ 写回巡检结果失败：nowuid={nowuid} - {e}")
+    return quarantined
+
+def get_quarantined(nowuid: str, limit: int = 50) -> list:
+    """某商品隔离中的账号，最早隔离的在前"""
+    try:
+        return list(hb.find({'nowuid': nowuid, 'state': STOCK_STATE_QUARANTINED}).sort('quarantined_at', 1).limit(limit))
+    except Exception as e:
+        logging.error(f"❌ 查询隔离账号失败：nowuid={nowuid} - {e}")
+        return []
+
+def release_quarantined(nowuid: str, ids=None) -> int:
+    """把隔离账号放回在售库存（管理员复核后使用）
+
+    Args:
+        ids: 只放回这些账号，默认放回该商品全部隔离账号
+
+    Returns:
+        int: 放回的账号数量
+    """
+    query = {'nowuid': nowuid, 'state': STOCK_STATE_QUARANTINED}
+    if ids is not None:
+        query['_id'] = {'$in': list(ids)}
+    try:
+        released = hb.update_many(query, {'$set': {'state': 0}, '$unset': {'quarantined_at': ''}}).modified_count
+        stock_counter_inc(nowuid, available=released)
+        if released:
+            logging.info(f"♻️ 隔离账号放回库存：nowuid={nowuid}, 数量={released}")
+        return released
+    except Exception as e:
+        logging.error(f"❌ 放回隔离账号失败：nowuid={nowuid} - {e}")
+        return 0
+
+def get_health_stats(nowuid: str = None, limit: int = 20) -> list:
+    """各商品的检测质量统计，按检测次数降序
+
+    Returns:
+        [{'nowuid', 'checks', 'normal', 'banned', 'frozen', 'unknown', 'bad_rate', 'quarantined'}, ...]
+        bad_rate 为封禁 + 冻结占检测次数的比例，quarantined 为当前隔离中的账号数
+    """
+    query = {'nowuid': nowuid} if nowuid else {}
+    stats = []
+    try:
+        for doc in health_stats.find(query).sort('checks', -1).limit(limit):
+            item = {'nowuid': doc['nowuid'], 'checks': doc.get('checks', 0)}
+            for status in HEALTH_STATUSES:
+                item[status] = doc.get(status, 0)
+            item['bad_rate'] = (item['banned'] + item['frozen']) / item['checks'] if item['checks'] else 0.0
+            stats.append(item)
+        quarantined = {row['_id']: row['count'] for row in hb.aggregate([
+            {'$match': {'state': STOCK_STATE_QUARANTINED, 'nowuid': {'$in': [item['nowuid'] for item in stats]}}},
+            {'$group': {'_id': '$nowuid', 'count': {'$sum': 1}}}
+        ])}
+        for item in stats:
+            item['quarantined'] = quarantined.get(item['nowuid'], 0)
+    except Exception as e:
+        logging.error(f"❌ 查询账号健康统计失败：{e}")
+    return stats
+
+# ✅ 新增：实用工具函数
+def get_product_stock(nowuid: str) -> int:
+    """获取商品库存数量"""
+    return get_stock_counts(nowuid)['available']
+
 def get_user_info(user_id: int) -> dict:
     """获取用户信息"""
     try:
@@ -725,6 +1642,7 @@ def create_agent_order_data(order_id, agent_bot_id, customer_id, original_nowuid
             'delivery_content': '',                 # 发货内容
         })
         logging.info(f"✅ 创建代理订单：order_id={order_id}, agent_bot_id={agent_bot_id}")
+        record_sale(original_nowuid, quantity)
         return True
     except Exception as e:
         logging.error(f"❌ 创建代理订单失败：{e}")
@@ -930,11 +1848,7 @@ def get_agent_product_price(agent_bot_id, original_nowuid):
 
 def get_real_time_stock(original_nowuid):
     """获取实时库存（从总部）"""
-    try:
-        return hb.count_documents({'nowuid': original_nowuid, 'state': 0})
-    except Exception as e:
-        logging.error(f"❌ 获取实时库存失败：{e}")
-        return 0
+    return get_stock_counts(original_nowuid)['available']
 
 def generate_agent_bot_id():
     """生成代理机器人唯一ID"""
@@ -0,0 +1,232 @@
+"""
+商品搜索引擎
+基于商品目录快照构建的内存倒排索引：商品名 / 英文翻译 / 国家名 / 区号，
+按库存状态排序返回，搜索路径不访问 ejfl / fenlei / hb
+"""
+
+import re
+import time
+import logging
+import threading
+import unicodedata
+
+from mongo import fyb, get_catalog, get_stock_map
+
+
+# ================================ 国家 / 区号映射 ================================
+
+# 区号 -> (中文名, 英文名...)
+DIAL_CODE_COUNTRIES = {
+    '+1': ('美国', '加拿大', 'usa', 'us', 'united states', 'america', 'canada'),
+    '+7': ('俄罗斯', 'russia', 'ru'),
+    '+20': ('埃及', 'egypt'),
+    '+27': ('南非', 'south africa'),
+    '+30': ('希腊', 'greece'),
+    '+31': ('荷兰', 'netherlands', 'holland'),
+    '+32': ('比利时', 'belgium'),
+    '+33': ('法国', 'france'),
+    '+34': ('西班牙', 'spain'),
+    '+36': ('匈牙利', 'hungary'),
+    '+39': ('意大利', 'italy'),
+    '+40': ('罗马尼亚', 'romania'),
+    '+41': ('瑞士', 'switzerland'),
+    '+43': ('奥地利', 'austria'),
+    '+44': ('英国', 'uk', 'united kingdom', 'britain', 'england'),
+    '+45': ('丹麦', 'denmark'),
+    '+46': ('瑞典', 'sweden'),
+    '+47': ('挪威', 'norway'),
+    '+48': ('波兰', 'poland'),
+    '+49': ('德国', 'germany'),
+    '+52': ('墨西哥', 'mexico'),
+    '+54': ('阿根廷', 'argentina'),
+    '+55': ('巴西', 'brazil'),
+    '+60': ('马来西亚', 'malaysia'),
+    '+61': ('澳大利亚', '澳洲', 'australia'),
+    '+62': ('印尼', '印度尼西亚', 'indonesia'),
+    '+63': ('菲律宾', 'philippines'),
+    '+64': ('新西兰', 'new zealand'),
+    '+65': ('新加坡', 'singapore'),
+    '+66': ('泰国', 'thailand'),
+    '+81': ('日本', 'japan'),
+    '+82': ('韩国', 'korea', 'south korea'),
+    '+84': ('越南', 'vietnam'),
+    '+86': ('中国', 'china'),
+    '+90': ('土耳其', 'turkey', 'turkiye'),
+    '+91': ('印度', 'india'),
+    '+92': ('巴基斯坦', 'pakistan'),
+    '+95': ('缅甸', 'myanmar', 'burma'),
+    '+234': ('尼日利亚', 'nigeria'),
+    '+351': ('葡萄牙', 'portugal'),
+    '+358': ('芬兰', 'finland'),
+    '+380': ('乌克兰', 'ukraine'),
+    '+420': ('捷克', 'czech'),
+    '+852': ('香港', 'hong kong', 'hk'),
+    '+855': ('柬埔寨', 'cambodia'),
+    '+856': ('老挝', 'laos'),
+    '+880': ('孟加拉', 'bangladesh'),
+    '+886': ('台湾', 'taiwan'),
+    '+966': ('沙特', 'saudi arabia', 'saudi'),
+    '+971': ('阿联酋', 'uae', 'united arab emirates'),
+    '+972': ('以色列', 'israel'),
+}
+
+# 国家名（中文 / 英文小写）-> 区号
+COUNTRY_MAP = {name: code for code, names in DIAL_CODE_COUNTRIES.items() for name in names}
+
+_DIAL_CODE_RE = re.compile(r'\+\s*(\d{1,4})')
+_DIAL_QUERY_RE = re.compile(r'^\+?\s*(\d{1,4})$')
+# 需要完整单词匹配的英文别名，避免 'us' 命中 'russia'
+_ASCII_ALIAS_RE = re.compile(r'^[a-z ]+$')
+
+
+def normalize(text: str) -> str:
+    """全角转半角、小写、合并空白"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def resolve_dial_code(query: str):
+    """把 '+54' / '54' / '阿根廷' / 'Argentina' 解析为区号，无法解析返回 None"""
+    q = normalize(query)
+    match = _DIAL_QUERY_RE.match(q)
+    if match:
+        return f'+{match.group(1)}'
+    return COUNTRY_MAP.get(q)
+
+
+def _dial_codes_in(text: str) -> set:
+    """从标准化后的商品名中提取区号（显式 +区号 以及国家名）"""
+    codes = {f'+{m}' for m in _DIAL_CODE_RE.findall(text)}
+    for name, code in COUNTRY_MAP.items():
+        if _ASCII_ALIAS_RE.match(name):
+            if re.search(rf'\b{re.escape(name)}\b', text):
+                codes.add(code)
+        elif name in text:
+            codes.add(code)
+    return codes
+
+
+def _grams(text: str) -> set:
+    """单字 + 相邻双字，用于子串查询的候选集召回"""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+# ================================ 倒排索引 ================================
+
+class ProductSearchIndex:
+    """商品名倒排索引，随商品目录快照版本重建"""
+
+    def __init__(self, catalog, translations: dict):
+        self.version = catalog.version
+        self.built_at = time.time()
+        self.products = catalog.listed_products()
+        self.texts = []
+        self.by_dial_code = {}
+        self.by_gram = {}
+
+        for idx, product in enumerate(self.products):
+            name = product.get('projectname', '')
+            text = normalize(name)
+            translated = translations.get(name)
+            if translated:
+                text = f'{text}\n{normalize(translated)}'
+            codes = _dial_codes_in(text)
+            # 把区号对应的国家名也并入可搜索文本，'阿根廷' 可以搜到只写了 '+54' 的商品
+            aliases = ' '.join(n for code in codes for n in DIAL_CODE_COUNTRIES.get(code, ()))
+            if aliases:
+                text = f'{text}\n{aliases}'
+            self.texts.append(text)
+            for code in codes:
+                self.by_dial_code.setdefault(code, set()).add(idx)
+            for gram in _grams(text):
+                self.by_gram.setdefault(gram, set()).add(idx)
+
+    def match(self, query: str) -> dict:
+        """返回 {商品下标: 匹配得分}，得分越高越相关"""
+        q = normalize(query)
+        if not q:
+            return {}
+
+        code = resolve_dial_code(q)
+        if code and code in self.by_dial_code:
+            return {idx: 2 for idx in self.by_dial_code[code]}
+
+        query_grams = {q} if len(q) == 1 else {q[i:i + 2] for i in range(len(q) - 1)}
+        candidates = None
+        for gram in query_grams:
+            docs = self.by_gram.get(gram)
+            if not docs:
+                return {}
+            candidates = set(docs) if candidates is None else candidates & docs
+            if not candidates:
+                return {}
+
+        result = {}
+        for idx in candidates or ():
+            text = self.texts[idx]
+            if q in text:
+                name = normalize(self.products[idx].get('projectname', ''))
+                result[idx] = 1 + (name == q) + name.startswith(q)
+        return result
+
+
+_index_lock = threading.Lock()
+_index = None
+# 翻译包会随时新增，超过该时间即使目录未变也重建一次
+SEARCH_INDEX_MAX_AGE = 600
+
+
+def _load_translations(names) -> dict:
+    try:
+        return {doc['text']: doc.get('fanyi', '') for doc in fyb.find({'text': {'$in': list(names)}},
+                                                                       {'text': 1, 'fanyi': 1, '_id': 0})}
+    except Exception as e:
+        logging.error(f"❌ 读取商品翻译失败：{e}")
+        return {}
+
+
+def get_search_index() -> ProductSearchIndex:
+    global _index
+    catalog = get_catalog()
+    index = _index
+    if index is not None and index.version == catalog.version and time.time() - index.built_at < SEARCH_INDEX_MAX_AGE:
+        return index
+    with _index_lock:
+        if _index is None or _index.version != catalog.version or time.time() - _index.built_at >= SEARCH_INDEX_MAX_AGE:
+            names = {p.get('projectname', '') for p in catalog.products}
+            _index = ProductSearchIndex(catalog, _load_translations(names))
+            logging.info(f"🔎 商品搜索索引已重建：{len(_index.products)} 个商品，{len(_index.by_dial_code)} 个区号")
+        return _index
+
+
+def search_products(query: str, limit: int = 10, in_stock_only: bool = False) -> list:
+    """搜索商品
+
+    Args:
+        query: 关键词 / 区号 / 国家名（中英文）
+        limit: 返回数量上限，None 表示全部
+        in_stock_only: 只返回有库存的商品
+
+    Returns:
+        list: [(商品文档, 库存), ...]，有库存的排在前面，快照文档只读
+    """
+    index = get_search_index()
+    matches = index.match(query)
+    if not matches:
+        return []
+
+    stock_map = get_stock_map([index.products[idx]['nowuid'] for idx in matches])
+    results = []
+    for idx, score in matches.items():
+        product = index.products[idx]
+        stock = stock_map.get(product['nowuid'], 0)
+        if in_stock_only and stock <= 0:
+            continue
+        results.append((stock <= 0, -score, idx, product, stock))
+
+    # 有库存优先，其次匹配度，最后保持目录排序
+    results.sort(key=lambda r: r[:3])
+    results = [(product, stock) for _, _, _, product, stock in results]
+    return results if limit is None else results[:limit]
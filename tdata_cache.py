@@ -0,0 +1,569 @@
+"""
+TData 转换缓存
+按 session 文件内容的哈希缓存 opentele 转换出的 tdata 目录（压缩为 zip 分片），
+TData 订单发货时直接把缓存分片拼进订单压缩包，买家不再等待现场转换；
+协议号入库后和热销商品在后台预先转换，未命中的账号发货时现场转换并写入缓存；
+转换在常驻的进程池中执行（每个进程一个事件循环），不受 GIL 限制
+"""
+
+import os
+import re
+import time
+import queue
+import shutil
+import signal
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+import zipfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from account_pack import DeliveryArtifact, resolve_account_blob, write_blob_zip
+from account_store import open_account
+from mongo import (
+    hb, get_top_sellers,
+    ACCOUNT_STORE_DIR, TDATA_CACHE_DIR, TDATA_CONVERT_WORKERS, TDATA_CONVERT_QUEUE, TDATA_CONVERT_TIMEOUT, TDATA_BACKGROUND_QUEUE,
+    TDATA_WARM_TOP, TDATA_WARM_PER_PRODUCT
+)
+
+# opentele 为可选依赖，未安装时只能读取已有缓存，不能转换
+try:
+    from opentele.tl import TelegramClient as OpenTeleClient
+    from opentele.api import UseCurrentSession
+    TDATA_AVAILABLE = True
+except ImportError:
+    TDATA_AVAILABLE = False
+
+
+TDATA_CACHE_DIR_NAME = 'TData缓存'
+# 进程池异常退出后重建时的启动方式：forkserver / spawn 从干净的进程创建转换进程，不继承运行中的线程和锁
+RESTART_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# 转换前只保留 Telethon 认识的表，多余的表会让 opentele 读取失败
+_SESSION_TABLES = {'sessions', 'entities', 'sent_files', 'update_state', 'version'}
+
+_HASH_BUFFER = 1024 * 1024
+
+
+# ================================ 缓存路径 ================================
+
+# (路径, 大小, 修改时间) -> 哈希，避免每次发货重复读取整个 session 文件
+_digest_memo = {}
+_digest_lock = threading.Lock()
+
+
+def session_digest(session_file: str) -> str:
+    """session 文件内容的 sha256"""
+    stat = os.stat(session_file)
+    key = (session_file, stat.st_size, stat.st_mtime_ns)
+    with _digest_lock:
+        digest = _digest_memo.get(key)
+    if digest:
+        return digest
+
+    sha = hashlib.sha256()
+    with open(session_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_BUFFER), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    with _digest_lock:
+        if len(_digest_memo) > 100000:
+            _digest_memo.clear()
+        _digest_memo[key] = digest
+    return digest
+
+
+def tdata_cache_path(session_file: str, digest: str = None) -> str:
+    """缓存分片路径：{缓存目录}/{哈希前两位}/{哈希}.zip
+
+    未配置 TDATA_CACHE_DIR 时，缓存目录与账号存储（或旧库存的协议号目录）同级：
+    ./账号存储/ab/cd/xxx.session、./协议号/{nowuid}/xxx.session -> ./TData缓存/
+    """
+    digest = digest or session_digest(session_file)
+    cache_dir = TDATA_CACHE_DIR
+    if not cache_dir:
+        session_file = os.path.abspath(session_file)
+        root = os.path.abspath(ACCOUNT_STORE_DIR)
+        if not session_file.startswith(root + os.sep):
+            root = os.path.dirname(os.path.dirname(session_file))
+        cache_dir = os.path.join(os.path.dirname(root), TDATA_CACHE_DIR_NAME)
+    return os.path.join(cache_dir, digest[:2], digest + '.zip')
+
+
+def get_cached_tdata(session_file: str):
+    """已缓存的 tdata 分片路径，未缓存返回 None"""
+    try:
+        path = tdata_cache_path(session_file)
+    except OSError:
+        return None
+    return path if os.path.exists(path) else None
+
+
+# ================================ 转换 ================================
+
+# 转换进程内常驻的事件循环（进程池 initializer 中创建）；不在转换进程中时为 None
+_worker_loop = None
+
+
+def _init_worker():
+    global _worker_loop
+    # Ctrl+C 由主进程处理，转换进程随进程池退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+
+
+def convert_session(session_file: str, work_dir: str, timeout: float = None):
+    """用 opentele 把 session 转换为 tdata 目录
+
+    Returns:
+        str: work_dir 下的 tdata 目录，未授权 / 超时 / 失败返回 None
+    """
+    name = os.path.splitext(os.path.basename(session_file))[0]
+
+    # 在副本上清理多余的表，不改动库存中的原始文件
+    clean_session_base = os.path.join(work_dir, 'clean')
+    clean_session_path = clean_session_base + '.session'
+    shutil.copy2(session_file, clean_session_path)
+    try:
+        conn = sqlite3.connect(clean_session_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        current_tables = {row[0] for row in cursor.fetchall()}
+        for table in (current_tables - _SESSION_TABLES):
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.commit()
+        conn.close()
+    except Exception as db_err:
+        logging.warning(f"⚠️ {name} 清理session表失败: {db_err}")
+
+    async def do_convert():
+        client = None
+        try:
+            # OpenTeleClient 会自动加 .session 后缀，所以传不带后缀的路径
+            client = OpenTeleClient(clean_session_base)
+
+            await asyncio.wait_for(client.connect(), timeout=15)
+
+            is_auth = await asyncio.wait_for(client.is_user_authorized(), timeout=5)
+            if not is_auth:
+                logging.warning(f"⚠️ {name} Session未授权，跳过转换")
+                return None
+
+            tdata_path = os.path.join(work_dir, 'tdata')
+            tdesk = await client.ToTDesktop(flag=UseCurrentSession)
+            tdesk.SaveTData(tdata_path)
+            return tdata_path
+        except Exception as e:
+            logging.error(f"⚠️ {name} 转换内部错误: {e}")
+            return None
+        finally:
+            if client:
+                try:
+                    await asyncio.wait_for(client.disconnect(), timeout=5)
+                except Exception:
+                    pass
+
+    timeout = timeout or TDATA_CONVERT_TIMEOUT
+    # 转换进程复用常驻事件循环，在其他进程中调用时临时创建
+    loop = _worker_loop
+    owns_loop = loop is None
+    if owns_loop:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(asyncio.wait_for(do_convert(), timeout=timeout))
+    except asyncio.TimeoutError:
+        logging.error(f"转换 {name} 超时({timeout}秒)")
+        return None
+    finally:
+        # 取消本次转换遗留的任务，常驻循环继续给下一个账号使用
+        try:
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        except Exception:
+            pass
+        if owns_loop:
+            try:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            except Exception:
+                pass
+            loop.close()
+            asyncio.set_event_loop(None)
+
+
+def build_tdata_blob(session_file: str):
+    """转换并写入缓存，已缓存时直接返回
+
+    Returns:
+        str: 缓存分片路径，转换失败或 opentele 不可用时返回 None
+    """
+    digest = session_digest(session_file)
+    path = tdata_cache_path(session_file, digest)
+    if os.path.exists(path):
+        return path
+    if not TDATA_AVAILABLE:
+        return None
+
+    work_dir = tempfile.mkdtemp(prefix=f"tdata_{digest[:12]}_")
+    try:
+        tdata_path = convert_session(session_file, work_dir)
+        if not tdata_path:
+            return None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再替换，发货线程不会读到写了一半的分片
+        tmp_path = os.path.join(work_dir, 'tdata.zip')
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for dirpath, _, files in os.walk(tdata_path):
+                for file in files:
+                    file_path = os.path.join(dirpath, file)
+                    zipf.write(file_path, os.path.relpath(file_path, tdata_path))
+        staged_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.move(tmp_path, staged_path)
+        os.replace(staged_path, path)
+        return path
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _convert_job(session_file: str):
+    """在转换进程中执行，返回 (缓存分片路径或 None, 转换耗时秒)"""
+    started = time.time()
+    try:
+        path = get_cached_tdata(session_file) or build_tdata_blob(session_file)
+    except Exception as e:
+        logging.error(f"转换 {session_file} 失败: {e}")
+        path = None
+    return path, time.time() - started
+
+
+# ================================ 转换服务 ================================
+
+class TDataConverter:
+    """TData 转换服务
+
+    常驻的转换进程池，每个进程一个事件循环；
+    已提交到进程池的任务数不超过 queue_size（有界队列），超出时提交方等待；
+    后台预转换先进入排队队列，由送料线程提交，最多同时占用 workers 个名额，
+    订单现场转换不会排在大批入库任务后面。
+    """
+
+    def __init__(self, workers: int = None, queue_size: int = None, job_timeout: int = None):
+        self.workers = workers or TDATA_CONVERT_WORKERS
+        self.queue_size = queue_size or TDATA_CONVERT_QUEUE or self.workers * 4
+        self.job_timeout = job_timeout or TDATA_CONVERT_TIMEOUT
+        self.executor = self._new_executor()
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._background_slots = threading.BoundedSemaphore(self.workers)
+        self._background = queue.Queue(maxsize=TDATA_BACKGROUND_QUEUE)
+        self._background_names = set()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._finished_at = deque(maxlen=10000)
+        self._stats = {
+            'submitted': 0, 'completed': 0, 'failed': 0, 'timeouts': 0, 'dropped': 0,
+            'convert_seconds': 0.0, 'wait_seconds': 0.0
+        }
+
+    def _new_executor(self, method: str = 'fork'):
+        # 启动时用 fork：转换进程不需要重新导入机器人模块和连接数据库
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method),
+                                   initializer=_init_worker)
+
+    def start(self):
+        # 在机器人其他线程启动之前一次性 fork 出全部转换进程
+        wait([self.executor.submit(os.getpid) for _ in range(self.workers)])
+        threading.Thread(target=self._feed, name='tdata-feeder', daemon=True).start()
+        logging.info(f"✅ TData转换进程已启动：{self.workers} 个，队列上限 {self.queue_size}")
+
+    # ---------------- 提交 ----------------
+
+    def submit(self, session_file: str, background: bool = False):
+        """提交一个转换任务，同一个文件排队期间复用同一个 Future；队列满时等待"""
+        with self._lock:
+            future = self._futures.get(session_file)
+        if future is not None:
+            if background:
+                self._background_slots.release()
+            return future
+
+        self._slots.acquire()
+        queued_at = time.time()
+        try:
+            with self._lock:
+                future = self._futures.get(session_file)
+                if future is None:
+                    try:
+                        future = self.executor.submit(_convert_job, session_file)
+                    except BrokenProcessPool:
+                        # 此时发货、巡检等线程都在运行，fork 可能复制到被其他线程持有的锁，改用不复制本进程的启动方式
+                        logging.error(f"❌ TData转换进程池异常退出，以 {RESTART_START_METHOD} 方式重新创建")
+                        self.executor.shutdown(wait=False)
+                        self.executor = self._new_executor(RESTART_START_METHOD)
+                        future = self.executor.submit(_convert_job, session_file)
+                    self._futures[session_file] = future
+                    self._stats['submitted'] += 1
+                    created = True
+                else:
+                    created = False
+        except Exception:
+            self._slots.release()
+            if background:
+                self._background_slots.release()
+            raise
+
+        if created:
+            future.add_done_callback(lambda f: self._done(session_file, f, queued_at, background))
+        else:
+            self._slots.release()
+            if background:
+                self._background_slots.release()
+        return future
+
+    def _done(self, session_file, future, queued_at, background):
+        self._slots.release()
+        if background:
+            self._background_slots.release()
+        finished = time.time()
+        try:
+            path, seconds = future.result()
+        except Exception as e:
+            logging.error(f"❌ TData转换任务异常：{session_file} - {e}")
+            path, seconds = None, 0.0
+        with self._lock:
+            self._futures.pop(session_file, None)
+            self._stats['completed' if path else 'failed'] += 1
+            self._stats['convert_seconds'] += seconds
+            self._stats['wait_seconds'] += max(0.0, finished - queued_at - seconds)
+            self._finished_at.append(finished)
+
+    def convert(self, session_files) -> dict:
+        """转换一批 session 文件并等待完成（订单现场转换）
+
+        Returns:
+            dict: {session 文件: 缓存分片路径}，失败或超时的文件不在其中
+        """
+        session_files = list(dict.fromkeys(session_files))
+        futures = {session_file: self.submit(session_file) for session_file in session_files}
+        # 每个进程依次处理，整体等待时间按轮数估算
+        rounds = (len(session_files) + self.workers - 1) // self.workers
+        deadline = time.time() + self.job_timeout * max(1, rounds) + 10
+
+        converted = {}
+        for session_file, future in futures.items():
+            try:
+                path, _ = future.result(timeout=max(0.0, deadline - time.time()))
+            except FutureTimeoutError:
+                logging.error(f"转换 {session_file} 等待超时")
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                continue
+            except Exception as e:
+                logging.error(f"转换 {session_file} 失败: {e}")
+                continue
+            if path:
+                converted[session_file] = path
+        return converted
+
+    def enqueue(self, session_file: str) -> bool:
+        """加入后台预转换队列，队列已满时丢弃（发货时会现场转换）"""
+        with self._lock:
+            if session_file in self._background_names:
+                return False
+            self._background_names.add(session_file)
+        try:
+            self._background.put_nowait(session_file)
+            return True
+        except queue.Full:
+            with self._lock:
+                self._background_names.discard(session_file)
+                self._stats['dropped'] += 1
+            return False
+
+    def _feed(self):
+        while True:
+            session_file = self._background.get()
+            with self._lock:
+                self._background_names.discard(session_file)
+            try:
+                if not os.path.exists(session_file) or get_cached_tdata(session_file):
+                    continue
+                self._background_slots.acquire()
+                self.submit(session_file, background=True)
+            except Exception as e:
+                logging.error(f"❌ 提交TData预转换失败：{session_file} - {e}")
+
+    # ---------------- 指标 ----------------
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            in_flight = len(self._futures)
+            finished_at = list(self._finished_at)
+        done = stats['completed'] + stats['failed']
+        now = time.time()
+        stats.update({
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'in_flight': in_flight,
+            'background_pending': self._background.qsize(),
+            'avg_convert_seconds': stats['convert_seconds'] / done if done else 0.0,
+            'avg_wait_seconds': stats['wait_seconds'] / done if done else 0.0,
+            'per_minute': sum(1 for t in finished_at if now - t <= 60),
+            'uptime': now - self._started_at
+        })
+        return stats
+
+
+tdata_converter = None
+_converter_lock = threading.Lock()
+
+
+def start_tdata_converter(workers: int = None):
+    """创建并启动本进程的 TData 转换服务，opentele 不可用时返回 None
+
+    应在机器人启动其他线程之前调用（转换进程通过 fork 创建；运行中进程池异常退出时改用 RESTART_START_METHOD 重建）
+    """
+    global tdata_converter
+    if not TDATA_AVAILABLE:
+        return None
+    with _converter_lock:
+        if tdata_converter is None:
+            tdata_converter = TDataConverter(workers=workers)
+            tdata_converter.start()
+        return tdata_converter
+
+
+def format_tdata_converter_stats() -> str:
+    """TData 转换服务指标（HTML），未启动时返回空字符串"""
+    if tdata_converter is None:
+        return ''
+    stats = tdata_converter.stats()
+    return "\n".join([
+        "<b>🗂️ TData转换</b>",
+        f"• 进程数: {stats['workers']}，队列上限: {stats['queue_size']}",
+        f"• 处理中: {stats['in_flight']}，后台排队: {stats['background_pending']}",
+        f"• 成功: {stats['completed']}，失败: {stats['failed']}，等待超时: {stats['timeouts']}，丢弃: {stats['dropped']}",
+        f"• 最近1分钟: {stats['per_minute']} 个",
+        f"• 平均转换耗时: {stats['avg_convert_seconds']:.1f}s，平均排队: {stats['avg_wait_seconds']:.1f}s",
+    ])
+
+
+# ================================ 订单打包 ================================
+
+def tdata_folder_name(phone: str) -> str:
+    """TData 订单压缩包中每个账号的目录名"""
+    return re.sub(r'[^\w\-]', '', phone.replace('+', ''))
+
+
+def tdata_order_artifact(accounts: list, filename: str, roots) -> DeliveryArtifact:
+    """生成 TData 格式的订单压缩包
+
+    每个账号一个目录：{手机号}/tdata/... + 原始 session / json。
+    优先使用缓存分片，未命中的账号并发现场转换（并写入缓存），转换失败的账号不打包。
+
+    Args:
+        accounts: 检测结果中的账号列表 [{'phone'(账号名), 'nowuid', 'session'(不带后缀), 'json'}, ...]
+        roots: 协议号源目录，用于定位账号的预打包分片
+
+    Returns:
+        DeliveryArtifact: artifact.count 为成功打包的账号数，调用方负责关闭
+    """
+    tdata_blobs = {}
+    missing = []
+    for account in accounts:
+        session_file = account['session'] + '.session'
+        if not os.path.exists(session_file):
+            logging.warning(f"⚠️ {account['phone']} session文件不存在: {session_file}")
+            continue
+        cached = get_cached_tdata(session_file)
+        if cached:
+            tdata_blobs[account['phone']] = cached
+        else:
+            missing.append(account)
+
+    logging.info(f"🗂️ TData缓存命中 {len(tdata_blobs)}/{len(accounts)}，现场转换 {len(missing)} 个")
+    if missing:
+        converter = start_tdata_converter()
+        converted = converter.convert([account['session'] + '.session' for account in missing]) if converter else {}
+        for account in missing:
+            path = converted.get(account['session'] + '.session')
+            if path:
+                tdata_blobs[account['phone']] = path
+            else:
+                logging.warning(f"❌ {account['phone']} 转换失败")
+
+    blobs = []
+    count = 0
+    for account in accounts:
+        tdata_blob = tdata_blobs.get(account['phone'])
+        if not tdata_blob:
+            continue
+        account_blob = resolve_account_blob('协议号', roots, account['nowuid'], account['phone'])
+        if not account_blob:
+            continue
+        folder_name = tdata_folder_name(account['phone'])
+        blobs.append((tdata_blob, f"{folder_name}/tdata/"))
+        blobs.append((account_blob, f"{folder_name}/"))
+        count += 1
+
+    artifact = DeliveryArtifact(filename)
+    artifact.count = count
+    try:
+        write_blob_zip(blobs, artifact.file)
+    except Exception:
+        artifact.close()
+        raise
+    return artifact
+
+
+# ================================ 后台预转换 ================================
+
+def enqueue_tdata_conversion(session_files) -> int:
+    """把协议号 session 文件提交给后台预转换（入库后调用），返回新提交的数量"""
+    converter = start_tdata_converter()
+    if converter is None:
+        return 0
+    submitted = 0
+    for session_file in dict.fromkeys(session_files):
+        if converter.enqueue(session_file):
+            submitted += 1
+    if submitted:
+        logging.info(f"🗂️ 已提交TData预转换：{submitted} 个账号")
+    return submitted
+
+
+def warm_popular_tdata(roots, top: int = None, per_product: int = None) -> int:
+    """为热销协议号商品的在售库存预转换 TData（定时调用）"""
+    if not TDATA_AVAILABLE:
+        return 0
+    if isinstance(roots, str):
+        roots = [roots]
+    submitted = 0
+    for nowuid, _ in get_top_sellers('7d', top or TDATA_WARM_TOP):
+        try:
+            docs = hb.find({'nowuid': nowuid, 'state': 0, 'leixing': '协议号'},
+                           {'nowuid': 1, 'projectname': 1, 'leixing': 1, 'files': 1}) \
+                .limit(per_product or TDATA_WARM_PER_PRODUCT)
+            session_files = [open_account(doc, roots).session for doc in docs]
+            submitted += enqueue_tdata_conversion([path for path in session_files if path])
+        except Exception as e:
+            logging.error(f"❌ 热销商品预转换失败：nowuid={nowuid} - {e}")
+
+    if tdata_converter is not None:
+        stats = tdata_converter.stats()
+        logging.info(f"🗂️ TData转换：处理中 {stats['in_flight']}，后台排队 {stats['background_pending']}，"
+                     f"最近1分钟 {stats['per_minute']} 个，平均耗时 {stats['avg_convert_seconds']:.1f}s，"
+                     f"失败 {stats['failed']}，等待超时 {stats['timeouts']}")
+    return submitted